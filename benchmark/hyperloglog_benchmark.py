@@ -20,6 +20,17 @@ def run_perf(card, p):
     return duration
 
 
+def run_perf_batch(card, p):
+    h = HyperLogLog(p=p)
+    logging.info("HyperLogLog using p = %d with update_batch" % p)
+    data = [int_bytes(i) for i in range(card)]
+    start = time.time()
+    h.update_batch(data)
+    duration = time.time() - start
+    logging.info("Digested %d hashes in %.4f sec" % (card, duration))
+    return duration
+
+
 def run_acc(size, seed, p):
     logging.info("HyperLogLog using p = %d " % p)
     h = HyperLogLog(p=p)
@@ -38,6 +49,7 @@ output = "hyperloglog_benchmark.png"
 logging.info("> Running performance tests")
 card = 5000
 run_times = [run_perf(card, p) for p in ps]
+batch_run_times = [run_perf_batch(card, p) for p in ps]
 
 logging.info("> Running accuracy tests")
 size = 5000
@@ -49,7 +61,9 @@ matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 fig, axe = plt.subplots(1, 2, sharex=True, figsize=(10, 4))
 ax = axe[1]
-ax.plot(ps, run_times, marker='+')
+ax.plot(ps, run_times, marker='+', label="update")
+ax.plot(ps, batch_run_times, marker='+', label="update_batch")
+ax.legend()
 ax.set_xlabel("P values")
 ax.set_ylabel("Running time (sec)")
 ax.ticklabel_format(axis='y', style='sci', scilimits=(-2,2))
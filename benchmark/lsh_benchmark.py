@@ -4,13 +4,14 @@ from sklearn.datasets import fetch_20newsgroups
 import numpy as np
 import scipy.stats
 from datasketch import MinHashLSH, MinHash
+from datasketch.exact_join import ExactSimilaritySearch
 from lshforest_benchmark import bootstrap_data, _compute_jaccard
 
 
 def benchmark_lsh(num_perm, threshold, index_data, query_data):
     print("Building LSH index")
     lsh = MinHashLSH(threshold, num_perm)
-    for key, minhash in z:xip(index_data.keys, index_data.minhashes[num_perm]):
+    for key, minhash in zip(index_data.keys, index_data.minhashes[num_perm]):
         lsh.insert(key, minhash)
     print("Querying")
     times = []
@@ -45,15 +46,13 @@ def benchmark_linearscan(num_perm, threshold, index_data, query_data):
 
 
 def benchmark_ground_truth(threshold, index_data, query_data):
+    index = ExactSimilaritySearch(index_data.sets, threshold,
+            keys=index_data.keys)
     times = []
     results = []
     for q in query_data.sets:
         start = time.clock()
-        result = []
-        for key, a in zip(index_data.keys, index_data.sets):
-            j = _compute_jaccard(q, a)
-            if j >= threshold:
-                result.append([key, j])
+        result = [[key, j] for key, j in index.query(q)]
         duration = time.clock() - start
         results.append(sorted(result, key=lambda x : x[1], reverse=True))
         times.append(duration)
@@ -72,7 +71,7 @@ if __name__ == "__main__":
               "ground_truth_times" : None, "ground_truth_results" : None}
 
     index_data, query_data = bootstrap_data(num_perms, 1000, 500, 
-             scipy.stats.(10, 500))
+             scipy.stats.randint(10, 500))
 
     threshold = 0.9
 
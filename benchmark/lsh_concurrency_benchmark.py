@@ -0,0 +1,66 @@
+'''
+Benchmark the query throughput of a concurrent MinHashLSH with multiple
+query threads running alongside one writer thread.
+'''
+import time, argparse, sys, threading
+import numpy as np
+from datasketch import MinHashLSH, MinHash
+
+
+def bootstrap_minhashes(num_perm, n, set_size):
+    minhashes = []
+    for i in range(n):
+        m = MinHash(num_perm)
+        for j in np.random.randint(0, n * set_size, set_size):
+            m.update(str(j).encode("utf8"))
+        minhashes.append(m)
+    return minhashes
+
+
+def benchmark_throughput(lsh, minhashes, num_readers, duration, write_interval):
+    num_indexed = len(lsh.keys)
+    counts = [0 for _ in range(num_readers)]
+    done = threading.Event()
+
+    def reader(i):
+        while not done.is_set():
+            lsh.query(minhashes[counts[i] % num_indexed])
+            counts[i] += 1
+
+    def writer():
+        key = num_indexed
+        while not done.is_set():
+            lsh.insert(key, minhashes[key])
+            lsh.remove(key)
+            time.sleep(write_interval)
+            key = num_indexed + (key - num_indexed + 1) % \
+                    (len(minhashes) - num_indexed)
+
+    threads = [threading.Thread(target=reader, args=(i,))
+               for i in range(num_readers)]
+    threads.append(threading.Thread(target=writer))
+    for t in threads:
+        t.start()
+    time.sleep(duration)
+    done.set()
+    for t in threads:
+        t.join()
+    return sum(counts) / float(duration)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num-perm", type=int, default=128)
+    parser.add_argument("--n", type=int, default=10000)
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--write-interval", type=float, default=0.001)
+    args = parser.parse_args(sys.argv[1:])
+
+    minhashes = bootstrap_minhashes(args.num_perm, args.n, 50)
+    lsh = MinHashLSH(threshold=0.5, num_perm=args.num_perm, concurrent=True)
+    for key, m in enumerate(minhashes[:args.n // 2]):
+        lsh.insert(key, m)
+    for num_readers in [1, 2, 4, 8]:
+        qps = benchmark_throughput(lsh, minhashes, num_readers,
+                args.duration, args.write_interval)
+        print("%d reader threads: %.2f queries per second" % (num_readers, qps))
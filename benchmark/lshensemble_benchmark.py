@@ -0,0 +1,79 @@
+'''
+Benchmark the containment search of MinHashLSHEnsemble against a linear
+scan estimating the containment of the query in every indexed set, using
+sets with skewed sizes.
+'''
+import time, argparse, sys
+import numpy as np
+from datasketch import MinHashLSHEnsemble, MinHash
+
+
+def bootstrap_sets(n, max_size, universe):
+    sizes = np.minimum(np.random.zipf(1.5, n) * 10, max_size)
+    return [set(np.random.randint(0, universe, size)) for size in sizes]
+
+
+def get_minhash(s, num_perm):
+    m = MinHash(num_perm)
+    for v in s:
+        m.update(str(v).encode("utf8"))
+    return m
+
+
+def _minhash_containment(q, x, q_size, x_size):
+    j = q.jaccard(x)
+    return j * (q_size + x_size) / (1.0 + j) / q_size
+
+
+def benchmark_linear_scan(queries, minhashes, sizes, threshold):
+    results = []
+    start = time.time()
+    for q, q_size in queries:
+        results.append([i for i, (m, size) in enumerate(zip(minhashes, sizes))
+            if _minhash_containment(q, m, q_size, size) >= threshold])
+    return results, time.time() - start
+
+
+def benchmark_lshensemble(queries, index):
+    results = []
+    start = time.time()
+    for q, q_size in queries:
+        results.append(index.query(q, q_size))
+    return results, time.time() - start
+
+
+def recall(results, ground_truth):
+    found = sum(len(set(r) & set(g)) for r, g in zip(results, ground_truth))
+    return float(found) / max(1, sum(len(g) for g in ground_truth))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num-perm", type=int, default=128)
+    parser.add_argument("--n", type=int, default=10000)
+    parser.add_argument("--num-queries", type=int, default=100)
+    parser.add_argument("--threshold", type=float, default=0.5)
+    parser.add_argument("--num-part", type=int, default=16)
+    args = parser.parse_args(sys.argv[1:])
+
+    sets = bootstrap_sets(args.n, 5000, args.n * 10)
+    sizes = [len(s) for s in sets]
+    minhashes = [get_minhash(s, args.num_perm) for s in sets]
+    index = MinHashLSHEnsemble(threshold=args.threshold,
+            num_perm=args.num_perm, num_part=args.num_part)
+    start = time.time()
+    index.index(zip(range(args.n), minhashes, sizes))
+    print("Indexing time: %.2f seconds" % (time.time() - start))
+
+    # Query with subsets of the indexed sets
+    queries = []
+    for i in np.random.randint(0, args.n, args.num_queries):
+        subset = list(sets[i])[:max(1, len(sets[i]) // 2)]
+        queries.append((get_minhash(subset, args.num_perm), len(subset)))
+    exact, scan_time = benchmark_linear_scan(queries, minhashes, sizes,
+            args.threshold)
+    found, ensemble_time = benchmark_lshensemble(queries, index)
+    print("Linear scan: %.2f ms per query" %
+            (scan_time * 1000.0 / args.num_queries))
+    print("LSH Ensemble: %.2f ms per query, recall %.3f of linear scan" %
+            (ensemble_time * 1000.0 / args.num_queries, recall(found, exact)))
@@ -139,6 +139,35 @@ def benchmark_ground_truth(k, index_data, query_data):
     return times, results
 
 
+def benchmark_parallel_query(num_perm, l, n, num_threads, num_queries, k):
+    '''
+    Measure the query latency of a forest with random signatures, searching
+    the prefix trees sequentially and in a thread pool.
+    '''
+    minhashes = [MinHash(num_perm, hashvalues=np.random.randint(0, 2**32,
+        num_perm, dtype=np.uint64)) for _ in range(n + num_queries)]
+    forest = MinHashLSHForest(num_perm=num_perm, l=l)
+    for key, minhash in enumerate(minhashes[:n]):
+        forest.add(key, minhash)
+    forest.index()
+    parallel = MinHashLSHForest(num_perm=num_perm, l=l,
+            num_threads=num_threads)
+    parallel.hashtables, parallel.keys, parallel._snapshot = \
+            forest.hashtables, forest.keys, forest._snapshot
+    queries = minhashes[n:]
+    for name, index in (("sequential", forest),
+            ("%d threads" % num_threads, parallel)):
+        start = time.time()
+        for q in queries:
+            index.query(q, k)
+        single = (time.time() - start) / len(queries)
+        start = time.time()
+        index.query_batch(queries, k)
+        batch = (time.time() - start) / len(queries)
+        print("%s: query %.3f ms, query_batch %.3f ms per query" %
+                (name, single * 1000.0, batch * 1000.0))
+
+
 def _compute_jaccard(x, y):
     if len(x) == 0 or len(y) == 0:
         return 0.0
@@ -152,8 +181,20 @@ def _compute_jaccard(x, y):
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--output", type=str, default="lshforest_benchmark.json")
+    parser.add_argument("--parallel", action="store_true",
+            help="Only benchmark the query latency with a thread pool")
+    parser.add_argument("--num-perm", type=int, default=256)
+    parser.add_argument("--l", type=int, default=32)
+    parser.add_argument("--n", type=int, default=1000000)
+    parser.add_argument("--num-threads", type=int, default=8)
+    parser.add_argument("--num-queries", type=int, default=1000)
     args = parser.parse_args(sys.argv[1:])
 
+    if args.parallel:
+        benchmark_parallel_query(args.num_perm, args.l, args.n,
+                args.num_threads, args.num_queries, 10)
+        sys.exit(0)
+
     num_perms = [32, 64, 96, 128, 160, 192, 224, 256]
     l = 8
     k = 10
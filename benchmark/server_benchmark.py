@@ -0,0 +1,108 @@
+'''
+Load generator for the MinHash LSH query server in `datasketch.server`.
+It starts a server over a MinHash LSH index in a background thread, unless
+an existing server is given, and runs concurrent clients against it.
+'''
+import time, argparse, sys, json, asyncio, threading
+import numpy as np
+from datasketch import MinHashLSH, MinHash, LeanMinHash
+from datasketch.server import QueryServer
+
+
+def bootstrap_payloads(num_perm, n, set_size):
+    minhashes = []
+    payloads = []
+    for i in range(n):
+        m = MinHash(num_perm)
+        for j in np.random.randint(0, n * set_size, set_size):
+            m.update(str(j).encode("utf8"))
+        minhashes.append(m)
+        lm = LeanMinHash(m)
+        buf = bytearray(lm.bytesize())
+        lm.serialize(buf)
+        payloads.append(bytes(buf))
+    return minhashes, payloads
+
+
+def start_server(lsh, batch_window):
+    loop = asyncio.new_event_loop()
+    server = QueryServer(lsh, port=0, batch_window=batch_window)
+    loop.run_until_complete(server.start())
+    thread = threading.Thread(target=loop.run_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+async def client(host, port, payloads, deadline, latencies):
+    reader, writer = await asyncio.open_connection(host, port)
+    i = np.random.randint(len(payloads))
+    while time.time() < deadline:
+        body = payloads[i % len(payloads)]
+        start = time.time()
+        writer.write(("POST /query HTTP/1.1\r\nContent-Length: %d\r\n\r\n"
+            % len(body)).encode('latin-1') + body)
+        await writer.drain()
+        length = 0
+        while True:
+            line = await reader.readline()
+            if line == b'\r\n':
+                break
+            if line.lower().startswith(b'content-length'):
+                length = int(line.split(b':')[1])
+        await reader.readexactly(length)
+        latencies.append(time.time() - start)
+        i += 1
+    writer.close()
+
+
+async def run_clients(host, port, payloads, concurrency, duration):
+    latencies = []
+    deadline = time.time() + duration
+    await asyncio.gather(*[client(host, port, payloads, deadline, latencies)
+                           for _ in range(concurrency)])
+    return latencies
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=None,
+            help="Use an existing server instead of starting one")
+    parser.add_argument("--num-perm", type=int, default=128)
+    parser.add_argument("--n", type=int, default=10000)
+    parser.add_argument("--batch-window", type=float, default=0.002)
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--output", type=str, default="server_benchmark.json")
+    args = parser.parse_args(sys.argv[1:])
+
+    minhashes, payloads = bootstrap_payloads(args.num_perm, args.n, 50)
+    server = None
+    port = args.port
+    if port is None:
+        lsh = MinHashLSH(threshold=0.5, num_perm=args.num_perm)
+        for key, m in enumerate(minhashes):
+            lsh.insert(key, m)
+        server = start_server(lsh, args.batch_window)
+        port = server.port
+
+    output = {"concurrency" : [], "throughput" : [],
+              "latency_p50" : [], "latency_p99" : []}
+    for concurrency in [1, 4, 16, 64]:
+        loop = asyncio.new_event_loop()
+        latencies = loop.run_until_complete(run_clients(args.host, port,
+            payloads, concurrency, args.duration))
+        loop.close()
+        throughput = len(latencies) / args.duration
+        p50, p99 = np.percentile(latencies, [50, 99])
+        print("%d clients: %.2f requests per second, p50 %.4f s, p99 %.4f s"
+                % (concurrency, throughput, p50, p99))
+        output["concurrency"].append(concurrency)
+        output["throughput"].append(throughput)
+        output["latency_p50"].append(p50)
+        output["latency_p99"].append(p99)
+    if server is not None:
+        print("Server stats:", server.stats())
+
+    with open(args.output, 'w') as f:
+        json.dump(output, f)
@@ -12,7 +12,10 @@ from datasketch.b_bit_minhash import bBitMinHash
 from datasketch.lsh import MinHashLSH
 from datasketch.weighted_minhash import WeightedMinHash, WeightedMinHashGenerator
 from datasketch.lshforest import MinHashLSHForest
+from datasketch.shared_lshforest import SharedMinHashLSHForest
 from datasketch.lean_minhash import LeanMinHash
+from datasketch.shared_lsh import SharedMinHashLSH
+from datasketch.lshensemble import MinHashLSHEnsemble
 
 # Alias
 WeightedMinHashLSH = MinHashLSH
@@ -0,0 +1,201 @@
+'''
+This module implements exact Jaccard similarity search and self-join over
+raw sets, using the prefix, length and positional filters of
+`AllPairs <https://dl.acm.org/citation.cfm?id=1242591>`_ and
+`PPJoin <https://dl.acm.org/citation.cfm?id=1367497>`_.
+They produce the ground truth for the approximate indexes and verify
+their candidates exactly.
+'''
+import math
+from collections import defaultdict, Counter
+
+
+def _ceil(x):
+    # Tolerate the rounding error of products such as 0.9 * 10
+    return int(math.ceil(x - 1e-9))
+
+
+def _token_ranks(sets):
+    '''
+    Rank the tokens by increasing document frequency, so the prefixes of
+    the sorted sets consist of rare tokens and produce few candidates.
+    '''
+    freq = Counter()
+    for s in sets:
+        freq.update(s)
+    return dict((token, rank) for rank, token in
+            enumerate(sorted(freq, key=freq.get)))
+
+
+def _check_threshold(threshold):
+    if threshold > 1.0 or threshold <= 0.0:
+        raise ValueError("threshold must be in (0.0, 1.0]")
+
+
+class ExactSimilaritySearch(object):
+    '''
+    An exact index for finding the sets with Jaccard similarities
+    to a query set at or above a threshold.
+    Only the prefixes of the indexed sets are placed in an inverted index,
+    and the candidates are pruned using their sizes and the positions of
+    the first shared tokens before the Jaccard similarities are computed.
+
+    Args:
+        sets (list): The sets to be indexed. Empty sets are never returned.
+        threshold (float): The Jaccard similarity threshold in (0.0, 1.0].
+        keys (list, optional): The keys of the sets. By default, the keys are
+            the positions of the sets in the list.
+    '''
+
+    def __init__(self, sets, threshold, keys=None):
+        _check_threshold(threshold)
+        if keys is None:
+            keys = list(range(len(sets)))
+        if len(keys) != len(sets):
+            raise ValueError("The number of keys must be equal to the \
+                    number of sets")
+        self.threshold = threshold
+        self.keys = keys
+        self._positions = dict((key, i) for i, key in enumerate(keys))
+        self._ranks = _token_ranks(sets)
+        self._sets = [sorted(self._ranks[token] for token in s)
+                for s in sets]
+        self._index = defaultdict(list)
+        for i, x in enumerate(self._sets):
+            if len(x) == 0:
+                continue
+            for j in range(len(x) - _ceil(threshold * len(x)) + 1):
+                self._index[x[j]].append((i, j))
+
+    def _sorted(self, s):
+        # Tokens not in the indexed sets get distinct negative ranks,
+        # so they come first and never match
+        unknown = 0
+        ranks = []
+        for token in s:
+            if token in self._ranks:
+                ranks.append(self._ranks[token])
+            else:
+                unknown -= 1
+                ranks.append(unknown)
+        return sorted(ranks)
+
+    def query(self, s):
+        '''
+        Retrieve the keys of the sets with Jaccard similarities to the
+        query set at or above the threshold.
+
+        Args:
+            s (iterable): The query set.
+
+        Returns:
+            `list` of `(key, jaccard)` tuples.
+        '''
+        q = self._sorted(set(s))
+        if len(q) == 0:
+            return []
+        candidates = _probe(q, self._index, self._sets, self.threshold,
+                _ceil(self.threshold * len(q)), len(q) / self.threshold)
+        return [(self.keys[i], j) for i, j in
+                _verify(q, candidates, self._sets, self.threshold)]
+
+    def verify(self, s, keys):
+        '''
+        Compute the exact Jaccard similarities between the query set and
+        the sets of the given keys, e.g., the candidates returned by
+        :class:`datasketch.MinHashLSH`, keeping only those at or above
+        the threshold.
+
+        Args:
+            s (iterable): The query set.
+            keys (iterable): The keys of the indexed sets to verify.
+
+        Returns:
+            `list` of `(key, jaccard)` tuples.
+        '''
+        q = set(self._sorted(set(s)))
+        result = []
+        for key in keys:
+            x = self._sets[self._positions[key]]
+            overlap = len(q.intersection(x))
+            if overlap == 0:
+                continue
+            jaccard = float(overlap) / (len(q) + len(x) - overlap)
+            if jaccard >= self.threshold - 1e-9:
+                result.append((key, jaccard))
+        return result
+
+
+def all_pairs(sets, threshold):
+    '''
+    Find all pairs of sets with Jaccard similarities at or above a
+    threshold. The sets are processed in increasing order of size, and
+    every set is probed against the prefixes of the sets before it, before
+    its own prefix is indexed.
+
+    Args:
+        sets (list): The input sets. Empty sets never appear in a pair.
+        threshold (float): The Jaccard similarity threshold in (0.0, 1.0].
+
+    Returns:
+        `list` of `(i, j, jaccard)` tuples with `i < j` being the positions
+        of the sets in the list.
+    '''
+    _check_threshold(threshold)
+    ranks = _token_ranks(sets)
+    sorted_sets = [sorted(ranks[token] for token in s) for s in sets]
+    order = sorted((i for i, x in enumerate(sorted_sets) if len(x) > 0),
+            key=lambda i : len(sorted_sets[i]))
+    index = defaultdict(list)
+    # The indexed sets are never larger than the probing set, so a shorter
+    # prefix is enough to guarantee their overlap
+    index_ratio = 2.0 * threshold / (1.0 + threshold)
+    result = []
+    for i in order:
+        x = sorted_sets[i]
+        candidates = _probe(x, index, sorted_sets, threshold,
+                _ceil(threshold * len(x)), len(x))
+        for j, jaccard in _verify(x, candidates, sorted_sets, threshold):
+            result.append((min(i, j), max(i, j), jaccard))
+        for p in range(len(x) - _ceil(index_ratio * len(x)) + 1):
+            index[x[p]].append((i, p))
+    return result
+
+
+def _probe(q, index, sets, threshold, min_size, max_size):
+    '''
+    Probe the inverted index with the prefix of the sorted query set,
+    applying the length and positional filters.
+
+    Returns:
+        dict: The positions of the candidate sets.
+    '''
+    overlaps = dict()
+    pruned = set()
+    ratio = threshold / (1.0 + threshold)
+    for i in range(len(q) - _ceil(threshold * len(q)) + 1):
+        for x, j in index.get(q[i], ()):
+            if x in pruned:
+                continue
+            size = len(sets[x])
+            if size < min_size or size > max_size:
+                continue
+            required = _ceil(ratio * (len(q) + size))
+            overlap = overlaps.get(x, 0)
+            if overlap + 1 + min(len(q) - i - 1, size - j - 1) < required:
+                pruned.add(x)
+                overlaps.pop(x, None)
+                continue
+            overlaps[x] = overlap + 1
+    return overlaps
+
+
+def _verify(q, candidates, sets, threshold):
+    q = set(q)
+    result = []
+    for x in candidates:
+        overlap = len(q.intersection(sets[x]))
+        jaccard = float(overlap) / (len(q) + len(sets[x]) - overlap)
+        if jaccard >= threshold - 1e-9:
+            result.append((x, jaccard))
+    return result
@@ -15,6 +15,53 @@ if not hasattr(int, 'bit_length'):
     _bit_length = lambda bits : len(bin(bits)) - 2 if bits > 0 else 0
 
 
+def _bit_length_array(bits):
+    '''
+    Get the bit lengths of an array of unsigned integers of up to 64 bits,
+    using a binary search over the shift amounts.
+    '''
+    bits = bits.copy()
+    length = np.zeros(len(bits), dtype=np.int64)
+    for shift in (32, 16, 8, 4, 2, 1):
+        mask = bits >= (np.uint64(1) << np.uint64(shift))
+        length[mask] += shift
+        bits[mask] >>= np.uint64(shift)
+    return length + (bits > 0)
+
+
+# The flags set in the serialized precision byte for the packed register
+# encodings and the sparse representation of HyperLogLog++
+_packed6_flag = 0x40
+_packed4_flag = 0x20
+_sparse_flag = 0x80
+
+
+def _pack6(reg):
+    '''
+    Pack an array of 6-bit unsigned integers, 4 values into every 3 bytes.
+    '''
+    bits = np.unpackbits(reg.astype(np.uint8)[:, np.newaxis], axis=1)
+    return np.packbits(bits[:, 2:].ravel())
+
+
+def _unpack6(packed, count):
+    bits = np.unpackbits(packed)[:count * 6].reshape(count, 6)
+    bits = np.hstack([np.zeros((count, 2), dtype=np.uint8), bits])
+    return np.packbits(bits, axis=1).ravel()
+
+
+def _write(buf, offset, a):
+    '''
+    Copy an array into a writable buffer at the offset, and return the
+    offset after it.
+    '''
+    if len(a) == 0:
+        return offset
+    out = np.frombuffer(buf, dtype=a.dtype, count=len(a), offset=offset)
+    out[:] = a
+    return offset + a.nbytes
+
+
 class HyperLogLog(object):
     '''
     The HyperLogLog data sketch for estimating
@@ -102,6 +149,41 @@ class HyperLogLog(object):
         # Update the register
         self.reg[reg_index] = max(self.reg[reg_index], self._get_rank(bits))
 
+    def update_batch(self, b):
+        '''
+        Update the HyperLogLog with many data values in bytes. The
+        register indexes and ranks of all values are computed with array
+        operations, and the resulting state is the same as calling
+        :func:`datasketch.HyperLogLog.update` on every value.
+
+        Args:
+            b (iterable): An iterable of values of type `bytes`.
+
+        Example:
+            To update with many string values:
+
+            .. code-block:: python
+
+                hyperloglog.update_batch(s.encode('utf-8') for s in data)
+        '''
+        hv = self._hash_batch(b)
+        if len(hv) == 0:
+            return
+        reg_index = (hv & np.uint64(self.m - 1)).astype(np.intp)
+        bits = hv >> np.uint64(self.p)
+        ranks = self.max_rank - _bit_length_array(bits) + 1
+        if np.any(ranks <= 0):
+            raise ValueError("Hash value overflow, maximum size is %d\
+                    bits" % self.max_rank)
+        np.maximum.at(self.reg, reg_index, ranks.astype(self.reg.dtype))
+
+    def _hash_batch(self, b):
+        # Digest the hash objects into one buffer of little-endian integers
+        buf = b''.join([self.hashobj(v).digest()[:self._hash_range_byte]
+            for v in b])
+        return np.frombuffer(buf, dtype=np.dtype(self._struct_fmt_str)
+                ).astype(np.uint64)
+
     def count(self):
         '''
         Estimate the cardinality of the data values seen so far.
@@ -218,58 +300,128 @@ class HyperLogLog(object):
         h = cls(reg=reg)
         return h
 
-    def bytesize(self):
-        # Since p is no larger than 64, use 8 bits
+    def bytesize(self, bits=8):
+        '''
+        Get the size of the buffer needed to serialize this HyperLogLog.
+
+        Args:
+            bits (int, optional): The register encoding, see
+                :func:`datasketch.HyperLogLog.serialize`.
+
+        Returns:
+            int: The size in number of bytes.
+        '''
+        # Since p is no larger than 16, use 8 bits, leaving the high bits
+        # for the flags of the register encoding
         p_size = struct.calcsize('B')
-        # Each register value is no larger than 64, use 8 bits
-        # TODO: is there a way to use 5 bits instead of 8 bits
-        # to store integer in Python?
-        reg_val_size = struct.calcsize('B')
-        return p_size + reg_val_size * self.m
-
-    def serialize(self, buf):
-        if len(buf) < self.bytesize():
+        if bits == 8:
+            return p_size + self.m
+        if bits == 6:
+            return p_size + self.m * 6 // 8
+        if bits == 4:
+            overflow = np.count_nonzero(self.reg - self.reg.min() >= 15)
+            return struct.calcsize('<BBI') + self.m // 2 + \
+                    struct.calcsize('<HB') * overflow
+        raise ValueError("bits must be 8, 6 or 4")
+
+    def serialize(self, buf, bits=8):
+        '''
+        Serialize this HyperLogLog into a writable buffer.
+
+        Args:
+            buf (buffer): The writable buffer, which must have at least
+                :func:`datasketch.HyperLogLog.bytesize` bytes.
+            bits (int, optional): The register encoding. With 8, every
+                register takes one byte. With 6, the registers are
+                bit-packed, taking 25% less space. With 4, every register
+                is stored as a 4-bit offset from the minimum register, and
+                the registers that do not fit are stored in an overflow
+                table, taking about half the space. The packed encodings
+                require the registers to be in [0, 63] and [0, 255]
+                respectively.
+        '''
+        if len(buf) < self.bytesize(bits):
             raise ValueError("The buffer does not have enough space\
                     for holding this HyperLogLog.")
-        fmt = 'B%dB' % self.m
-        struct.pack_into(fmt, buf, 0, self.p, *self.reg)
+        if bits == 8:
+            fmt = 'B%dB' % self.m
+            struct.pack_into(fmt, buf, 0, self.p, *self.reg)
+            return
+        # Never truncate the registers that do not fit the packed encodings
+        max_value = 63 if bits == 6 else 255
+        if self.reg.min() < 0 or self.reg.max() > max_value:
+            raise ValueError("The registers must be in [0, %d] for the \
+                    %d-bit encoding" % (max_value, bits))
+        reg = self.reg.astype(np.uint8)
+        if bits == 6:
+            struct.pack_into('B', buf, 0, self.p | _packed6_flag)
+            _write(buf, struct.calcsize('B'), _pack6(reg))
+            return
+        base = reg.min()
+        offsets = reg - base
+        overflow = np.nonzero(offsets >= 15)[0]
+        offsets[overflow] = 15
+        struct.pack_into('<BBI', buf, 0, self.p | _packed4_flag,
+                int(base), len(overflow))
+        offset = struct.calcsize('<BBI')
+        offset = _write(buf, offset, (offsets[0::2] << 4) | offsets[1::2])
+        table = np.zeros(len(overflow), dtype=[('index', '<u2'),
+            ('value', 'u1')])
+        table['index'] = overflow
+        table['value'] = reg[overflow]
+        _write(buf, offset, table)
 
     @classmethod
-    def deserialize(cls, buf):
-        size = struct.calcsize('B')
+    def _read_registers(cls, buf):
+        '''
+        Read the precision and the registers from a buffer created by
+        :func:`datasketch.HyperLogLog.serialize` with any encoding.
+        '''
         try:
-            p = struct.unpack_from('B', buf, 0)[0]
+            flag_p = struct.unpack_from('B', buf, 0)[0]
         except TypeError:
-            p = struct.unpack_from('B', buffer(buf), 0)[0]
+            buf = buffer(buf)
+            flag_p = struct.unpack_from('B', buf, 0)[0]
+        p = flag_p & 0x1f
+        m = 1 << p
+        offset = struct.calcsize('B')
+        if flag_p & _packed6_flag:
+            packed = np.frombuffer(buf, dtype=np.uint8, count=m * 6 // 8,
+                    offset=offset)
+            return p, _unpack6(packed, m).astype(np.int8)
+        if flag_p & _packed4_flag:
+            _, base, size = struct.unpack_from('<BBI', buf, 0)
+            offset = struct.calcsize('<BBI')
+            packed = np.frombuffer(buf, dtype=np.uint8, count=m // 2,
+                    offset=offset)
+            reg = np.empty((m,), dtype=np.uint8)
+            reg[0::2] = packed >> 4
+            reg[1::2] = packed & 15
+            reg += base
+            table = np.frombuffer(buf, dtype=[('index', '<u2'),
+                ('value', 'u1')], count=size, offset=offset + m // 2)
+            reg[table['index']] = table['value']
+            return p, reg.astype(np.int8)
+        return p, np.frombuffer(buf, dtype=np.uint8, count=m,
+                offset=offset).astype(np.int8)
+
+    @classmethod
+    def deserialize(cls, buf):
+        p, reg = cls._read_registers(buf)
         h = cls(p)
-        offset = size
-        try:
-            h.reg = np.array(struct.unpack_from('%dB' % h.m,
-                buf, offset), dtype=np.int8)
-        except TypeError:
-            h.reg = np.array(struct.unpack_from('%dB' % h.m,
-                buffer(buf), offset), dtype=np.int8)
+        h.reg = reg
         return h
 
     def __getstate__(self):
+        # Keep pickling in the 8-bit encoding, which older releases can read
         buf = bytearray(self.bytesize())
         self.serialize(buf)
         return buf
 
     def __setstate__(self, buf):
-        size = struct.calcsize('B')
-        try:
-            p = struct.unpack_from('B', buf, 0)[0]
-        except TypeError:
-            p = struct.unpack_from('B', buffer(buf), 0)[0]
+        p, reg = self._read_registers(buf)
         self.__init__(p=p)
-        offset = size
-        try:
-            self.reg = np.array(struct.unpack_from('%dB' % self.m,
-                buf, offset), dtype=np.int8)
-        except TypeError:
-            self.reg = np.array(struct.unpack_from('%dB' % self.m,
-                buffer(buf), offset), dtype=np.int8)
+        self.reg = reg
 
 
 class HyperLogLogPlusPlus(HyperLogLog):
@@ -280,15 +432,156 @@ class HyperLogLogPlusPlus(HyperLogLog):
 
     1. Use 64 bits instead of 32 bits for hash function
     2. A new small-cardinality estimation scheme
-    3. Sparse representation (not implemented here)
+    3. Sparse representation
 
     This class has the same set of methods as 
     :class:`datasketch.HyperLogLog`.
+
+    In the sparse representation, the registers are not allocated. Instead,
+    the sketch keeps a sorted array of `(index, rank)` pairs encoded as
+    32-bit integers, with the index taken at the higher precision
+    `sparse_p`, and new values are buffered in a small array of at most 64
+    pairs before being merged into the sorted array. Estimation uses linear
+    counting at the higher precision. Once the array grows beyond a quarter of the number of
+    registers (i.e., it would take more space than the registers), the
+    sketch is converted to the dense representation, which has exactly the
+    same registers as a sketch that has been dense from the beginning.
+
+    Args:
+        p (int, optional): The precision parameter. It is ignored if
+            the `reg` is given.
+        reg (numpy.array, optional): The internal state.
+            This argument is for initializing the HyperLogLog from
+            an existing one, which is always dense.
+        hashobj (optional): The hash function used.
+        sparse (bool, optional): Start with the sparse representation.
+        sparse_p (int, optional): The precision of the sparse
+            representation, in the range `(p, 26]`.
     '''
 
+    __slots__ = ('sparse_p', '_use_sparse', '_sparse', '_tmp', '_num_tmp')
+
     _hash_range_bit = 64
     _hash_range_byte = 8
     _struct_fmt_str = '<Q'
+    # The maximum number of new pairs buffered before being merged into the
+    # sorted array of the sparse representation
+    _max_tmp_size = 64
+
+    def __init__(self, p=8, reg=None, hashobj=sha1, sparse=False,
+            sparse_p=25):
+        super(HyperLogLogPlusPlus, self).__init__(p=p, reg=reg,
+                hashobj=hashobj)
+        self._use_sparse = sparse and reg is None
+        if self._use_sparse:
+            # The encoded index and 6-bit rank must fit in 32 bits
+            if not (self.p < sparse_p <= 26):
+                raise ValueError("sparse_p=%d should be in range (%d : 26]"
+                        % (sparse_p, self.p))
+            self.reg = None
+        self.sparse_p = sparse_p
+        self._sparse = np.zeros((0,), dtype=np.uint32)
+        self._clear_tmp()
+
+    def _clear_tmp(self):
+        # The buffer is allocated by the first update in the sparse
+        # representation
+        self._tmp = None
+        self._num_tmp = 0
+
+    def _buffered(self):
+        '''
+        Get the buffered pairs not yet merged into the sorted array.
+        '''
+        if self._num_tmp == 0:
+            return np.zeros((0,), dtype=np.uint32)
+        return self._tmp[:self._num_tmp]
+
+    def is_sparse(self):
+        '''
+        Returns:
+            bool: True if the sketch is using the sparse representation.
+        '''
+        return self.reg is None
+
+    def _max_sparse_size(self):
+        return max(self.m // 4, 1)
+
+    def update(self, b):
+        if self.reg is not None:
+            return super(HyperLogLogPlusPlus, self).update(b)
+        hv = struct.unpack(self._struct_fmt_str,
+                self.hashobj(b).digest()[:self._hash_range_byte])[0]
+        index = hv & ((1 << self.sparse_p) - 1)
+        rank = self._hash_range_bit - self.sparse_p - \
+                _bit_length(hv >> self.sparse_p) + 1
+        if self._tmp is None:
+            self._tmp = np.empty((min(self._max_tmp_size,
+                self._max_sparse_size()),), dtype=np.uint32)
+        self._tmp[self._num_tmp] = (index << 6) | rank
+        self._num_tmp += 1
+        if self._num_tmp == len(self._tmp):
+            self._flush()
+
+    def update_batch(self, b):
+        if self.reg is not None:
+            return super(HyperLogLogPlusPlus, self).update_batch(b)
+        hv = self._hash_batch(b)
+        if len(hv) == 0:
+            return
+        sp = np.uint64(self.sparse_p)
+        index = hv & ((np.uint64(1) << sp) - np.uint64(1))
+        ranks = self._hash_range_bit - self.sparse_p - \
+                _bit_length_array(hv >> sp) + 1
+        self._merge_sparse(((index << np.uint64(6)) |
+            ranks.astype(np.uint64)).astype(np.uint32))
+
+    def _merge_sparse(self, encoded):
+        '''
+        Merge the encoded pairs and the buffered ones into the sorted
+        array, keeping the maximum rank of every index, and convert to the
+        dense representation if the array becomes too large.
+        '''
+        encoded = np.sort(np.concatenate([self._sparse, encoded,
+            self._buffered()]))
+        self._num_tmp = 0
+        if len(encoded) > 0:
+            # The pairs are sorted by index and then by rank, so the last
+            # pair of every index has the maximum rank
+            index = encoded >> np.uint32(6)
+            encoded = encoded[np.append(index[1:] != index[:-1], True)]
+        self._sparse = encoded
+        if len(self._sparse) > self._max_sparse_size():
+            self.reg = self._sparse_registers()
+            self._sparse = np.zeros((0,), dtype=np.uint32)
+            self._clear_tmp()
+
+    def _flush(self):
+        if self.reg is None and self._num_tmp > 0:
+            self._merge_sparse(np.zeros((0,), dtype=np.uint32))
+
+    def _sparse_registers(self):
+        '''
+        Compute the dense registers from the sparse representation.
+        '''
+        reg = np.zeros((self.m,), dtype=np.int8)
+        encoded = np.concatenate([self._sparse,
+            self._buffered()]).astype(np.uint64)
+        index = encoded >> np.uint64(6)
+        ranks = (encoded & np.uint64(63)).astype(np.int64)
+        # If the hash bits above the sparse index are all zero, the rank at
+        # precision p is determined by the extra bits of the sparse index
+        zero = ranks == self._hash_range_bit - self.sparse_p + 1
+        ranks[zero] = self.max_rank + 1 - \
+                _bit_length_array(index[zero] >> np.uint64(self.p))
+        np.maximum.at(reg, (index & np.uint64(self.m - 1)).astype(np.intp),
+                ranks.astype(np.int8))
+        return reg
+
+    def _registers(self):
+        if self.reg is None:
+            return self._sparse_registers()
+        return self.reg
 
     def _get_threshold(self, p):
         return _thresholds[p - 4]
@@ -300,6 +593,11 @@ class HyperLogLogPlusPlus(HyperLogLog):
         return np.mean(bias_vector[nearest_neighbors])
 
     def count(self):
+        self._flush()
+        if self.reg is None:
+            # Linear counting at the precision of the sparse representation
+            m = 1 << self.sparse_p
+            return m * np.log(m / float(m - len(self._sparse)))
         num_zero = self.m - np.count_nonzero(self.reg)
         if num_zero > 0:
             # linear counting
@@ -312,3 +610,119 @@ class HyperLogLogPlusPlus(HyperLogLog):
             return e - self._estimate_bias(e, self.p)
         else:
             return e
+
+    def merge(self, other):
+        if self.m != other.m or self.p != other.p:
+            raise ValueError("Cannot merge HyperLogLog with different\
+                    precisions.")
+        # Flushing may convert the other HyperLogLog++ to dense, so it
+        # must come before choosing how to merge
+        other._flush()
+        if self.reg is None and other.reg is None and \
+                self.sparse_p == other.sparse_p:
+            self._merge_sparse(other._sparse)
+            return
+        self.reg = np.maximum(self._registers(), other._registers())
+        self._sparse = np.zeros((0,), dtype=np.uint32)
+        self._clear_tmp()
+
+    def digest(self, hashobj=None):
+        return copy.copy(self._registers())
+
+    def copy(self):
+        '''
+        Create a copy of the current HyperLogLog++, keeping its
+        representation.
+
+        Returns:
+            datasketch.HyperLogLogPlusPlus:
+        '''
+        h = HyperLogLogPlusPlus(p=self.p, hashobj=self.hashobj,
+                sparse=self._use_sparse, sparse_p=self.sparse_p)
+        h.reg = None if self.reg is None else self.reg.copy()
+        h._sparse = self._sparse.copy()
+        if self._num_tmp > 0:
+            h._tmp = self._tmp.copy()
+            h._num_tmp = self._num_tmp
+        return h
+
+    def is_empty(self):
+        if self.reg is None:
+            return len(self._sparse) == 0 and self._num_tmp == 0
+        return super(HyperLogLogPlusPlus, self).is_empty()
+
+    def clear(self):
+        '''
+        Reset the current HyperLogLog++ to empty, in the sparse
+        representation if it was created with one.
+        '''
+        self._sparse = np.zeros((0,), dtype=np.uint32)
+        self._clear_tmp()
+        if self._use_sparse:
+            self.reg = None
+        else:
+            super(HyperLogLogPlusPlus, self).clear()
+
+    def __len__(self):
+        return self.m
+
+    def __eq__(self, other):
+        if self.p != other.p:
+            return False
+        if self.m != other.m:
+            return False
+        return np.array_equal(self._registers(), other._registers())
+
+    @classmethod
+    def union(cls, *hyperloglogs):
+        if len(hyperloglogs) < 2:
+            raise ValueError("Cannot union less than 2 HyperLogLog\
+                    sketches")
+        m = hyperloglogs[0].m
+        if not all(h.m == m for h in hyperloglogs):
+            raise ValueError("Cannot union HyperLogLog sketches with\
+                    different precisions")
+        h = hyperloglogs[0].copy()
+        for other in hyperloglogs[1:]:
+            h.merge(other)
+        return h
+
+    def bytesize(self, bits=8):
+        self._flush()
+        if self.reg is not None:
+            return super(HyperLogLogPlusPlus, self).bytesize(bits)
+        # The register encoding does not apply to the sparse representation,
+        # which is stored as the precision with the sparse flag, the sparse
+        # precision and the number of pairs, followed by the pairs
+        return struct.calcsize('<BBI') + \
+                self._sparse.dtype.itemsize * len(self._sparse)
+
+    def serialize(self, buf, bits=8):
+        if len(buf) < self.bytesize(bits):
+            raise ValueError("The buffer does not have enough space\
+                    for holding this HyperLogLog.")
+        if self.reg is not None:
+            return super(HyperLogLogPlusPlus, self).serialize(buf, bits)
+        struct.pack_into('<BBI', buf, 0, self.p | _sparse_flag,
+                self.sparse_p, len(self._sparse))
+        _write(buf, struct.calcsize('<BBI'), self._sparse.astype('<u4'))
+
+    @classmethod
+    def deserialize(cls, buf):
+        h = cls.__new__(cls)
+        h.__setstate__(buf)
+        return h
+
+    def __setstate__(self, buf):
+        try:
+            p = struct.unpack_from('B', buf, 0)[0]
+        except TypeError:
+            buf = buffer(buf)
+            p = struct.unpack_from('B', buf, 0)[0]
+        if not p & _sparse_flag:
+            return super(HyperLogLogPlusPlus, self).__setstate__(buf)
+        _, sparse_p, size = struct.unpack_from('<BBI', buf, 0)
+        self.__init__(p=p & 0x1f, sparse=True,
+                sparse_p=sparse_p)
+        self._sparse = np.frombuffer(buf, dtype='<u4', count=size,
+                offset=struct.calcsize('<BBI')).astype(np.uint32)
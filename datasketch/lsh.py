@@ -1,4 +1,8 @@
-from collections import defaultdict
+import sys, struct, time
+from collections import defaultdict, deque, OrderedDict
+import multiprocessing
+import threading
+import numpy as np
 
 
 _integration_precision = 0.001
@@ -18,31 +22,41 @@ except ImportError:
     integrate = _integration
 
 
-def _false_positive_probability(threshold, b, r):
-    _probability = lambda s : 1 - (1 - s**float(r))**float(b)
+def _band_probability(s, r, probes):
+    '''
+    The probability that a band of `r` hash values matches, allowing one
+    mismatch at the `probes` probed positions.
+    '''
+    return s**float(r) + probes * s**float(r-1) * (1 - s)
+
+
+def _false_positive_probability(threshold, b, r, probes=0):
+    _probability = lambda s : 1 - (1 - _band_probability(s, r, probes))**float(b)
     a, err = integrate(_probability, 0.0, threshold) 
     return a
 
 
-def _false_negative_probability(threshold, b, r):
-    _probability = lambda s : 1 - (1 - (1 - s**float(r))**float(b))
+def _false_negative_probability(threshold, b, r, probes=0):
+    _probability = lambda s : 1 - (1 - (1 - _band_probability(s, r, probes))**float(b))
     a, err = integrate(_probability, threshold, 1.0)
     return a
 
 
 def _optimal_param(threshold, num_perm, false_positive_weight,
-        false_negative_weight):
+        false_negative_weight, probes=0):
     '''
     Compute the optimal `MinHashLSH` parameter that minimizes the weighted sum
     of probabilities of false positive and false negative.
+    With multi-probe querying, only bands with more hash values than
+    the number of probed positions are considered.
     '''
     min_error = float("inf")
     opt = (0, 0)
     for b in range(1, num_perm+1):
         max_r = int(num_perm / b)
-        for r in range(1, max_r+1):
-            fp = _false_positive_probability(threshold, b, r)
-            fn = _false_negative_probability(threshold, b, r)
+        for r in range(probes+1, max_r+1):
+            fp = _false_positive_probability(threshold, b, r, probes)
+            fn = _false_negative_probability(threshold, b, r, probes)
             error = fp*false_positive_weight + fn*false_negative_weight
             if error < min_error:
                 min_error = error
@@ -50,6 +64,111 @@ def _optimal_param(threshold, num_perm, false_positive_weight,
     return opt
 
 
+def tune_param(minhashes, threshold, recall=0.9, num_keys=None,
+        num_pairs=100000, seed=1):
+    '''
+    Choose the `MinHashLSH` parameter `(b, r)` from a sample of the data,
+    instead of assuming a uniform distribution of Jaccard similarities as
+    `MinHashLSH` does by default.
+    The pairwise Jaccard similarities are estimated from (a random subset
+    of) the pairs of MinHash in the sample, and used to predict the recall
+    of the sets above the threshold and the expected number of candidates
+    per query, which drives the query cost. Among the parameters meeting
+    the recall target, the one with the fewest candidates per query is
+    chosen. If none meets the target, the one with the highest recall is
+    chosen.
+
+    Args:
+        minhashes (list): The sample of MinHash (or weighted MinHash),
+            which must have the same number of permutation functions.
+        threshold (float): The Jaccard similarity threshold.
+        recall (float, optional): The target recall of the sets with
+            Jaccard similarities no less than the threshold.
+        num_keys (int, optional): The number of keys the index is expected
+            to hold, used to predict the candidates per query and the memory
+            usage. By default it is the size of the sample.
+        num_pairs (int, optional): The maximum number of pairs used to
+            estimate the similarity distribution.
+        seed (int, optional): The random seed for sampling the pairs.
+
+    Returns:
+        dict: The chosen `b` and `r`, together with the predicted `recall`,
+        the expected `candidates` per query and the approximate `bytesize`
+        of an index holding `num_keys` keys, which can be used as
+        :code:`MinHashLSH(threshold, num_perm, params=(b, r))`.
+    '''
+    if len(minhashes) < 2:
+        raise ValueError("Need at least 2 MinHash to tune the parameter")
+    if threshold > 1.0 or threshold < 0.0:
+        raise ValueError("threshold must be in [0.0, 1.0]")
+    if recall > 1.0 or recall < 0.0:
+        raise ValueError("recall must be in [0.0, 1.0]")
+    signatures = np.array([m.hashvalues for m in minhashes])
+    n, num_perm = signatures.shape[:2]
+    if num_keys is None:
+        num_keys = n
+    # Sample the pairs
+    if n * (n - 1) // 2 <= num_pairs:
+        left, right = np.triu_indices(n, 1)
+    else:
+        rng = np.random.RandomState(seed)
+        left = rng.randint(0, n, num_pairs)
+        right = (left + rng.randint(1, n, num_pairs)) % n
+    # Estimate the similarities in chunks to bound the memory usage
+    sims = []
+    chunk_size = max(1, 10000000 // signatures[0].size)
+    for start in range(0, len(left), chunk_size):
+        eq = signatures[left[start:start+chunk_size]] == \
+                signatures[right[start:start+chunk_size]]
+        if eq.ndim > 2:
+            # A weighted MinHash has a pair of values per sample
+            eq = eq.all(axis=tuple(range(2, eq.ndim)))
+        sims.append(np.count_nonzero(eq, axis=1))
+    sims, counts = np.unique(np.concatenate(sims), return_counts=True)
+    sims = sims / float(num_perm)
+    weights = counts / float(counts.sum())
+    positive = sims >= threshold
+    band_key_size = signatures[0][:1].nbytes
+    best, best_score = None, None
+    for b in range(1, num_perm+1):
+        for r in range(1, num_perm // b + 1):
+            probability = 1.0 - (1.0 - sims**r)**b
+            candidates = num_keys * float(np.sum(weights * probability))
+            if np.any(positive):
+                predicted_recall = float(np.sum((weights * probability)[positive])
+                        / np.sum(weights[positive]))
+            else:
+                # No pair above the threshold in the sample
+                predicted_recall = 1.0 - _false_negative_probability(
+                        threshold, b, r) / max(1.0 - threshold, 1e-9)
+            # Prefer meeting the recall target, then fewer candidates, then
+            # less memory
+            score = (predicted_recall < recall,
+                    candidates if predicted_recall >= recall
+                    else -predicted_recall, b)
+            if best_score is None or score < best_score:
+                best_score = score
+                best = {"b" : b, "r" : r, "recall" : predicted_recall,
+                        "candidates" : candidates,
+                        "bytesize" : _index_bytesize(num_keys, b,
+                            band_key_size * r)}
+    return best
+
+
+def _index_bytesize(num_keys, b, band_key_size):
+    '''
+    Approximate the number of bytes used by a `MinHashLSH` with `b` bands
+    holding `num_keys` keys, assuming every band key is in a bucket of its
+    own, so this is an upper bound.
+    '''
+    band_key = sys.getsizeof(b'\0' * band_key_size)
+    # The band keys of a key in `keys`
+    per_key = sys.getsizeof([None] * b) + b * band_key
+    # A dict entry, a bucket list and the band key of each bucket
+    per_bucket = 3 * _pointer_size + sys.getsizeof([None]) + band_key
+    return num_keys * (per_key + b * per_bucket)
+
+
 class MinHashLSH(object):
     '''
     The Locality Sensitive Hashing index 
@@ -74,9 +193,54 @@ class MinHashLSH(object):
             for the Jaccard similarity threshold.
             `weights` is a tuple in the format of 
             :code:`(false_positive_weight, false_negative_weight)`.
+        concurrent (bool, optional): If True, the index uses reader-writer
+            locking so that many threads can query it while another
+            thread inserts or removes keys. Queries run concurrently
+            with each other and only wait for writers.
+        bucket_cap (int, optional): The maximum number of keys taken from
+            a single bucket by a query, which bounds the worst-case query
+            cost when many near-empty or boilerplate sets land in the same
+            buckets. By default there is no cap.
+        overflow (str, optional): How a query handles a bucket with more
+            keys than `bucket_cap`. Use `'sample'` to take an evenly spaced
+            sample of `bucket_cap` keys from the bucket, or `'stop'` to skip
+            the bucket entirely, similar to a stop word.
+        ttl (float, optional): The time to live of the keys in seconds, for
+            streaming use. Keys are grouped into time slices of one tenth
+            of the `ttl` by their insert timestamps, and a whole slice is
+            removed at once when it expires, so a key lives for at most
+            10% longer than the `ttl`. Expired keys are removed when
+            inserting or when :func:`datasketch.MinHashLSH.expire` is
+            called. By default keys never expire.
+        max_size (int, optional): The maximum number of keys in the index.
+            When it is exceeded, the oldest slice of keys is removed. Without
+            `ttl`, a slice is one tenth of `max_size` keys in insertion
+            order. By default there is no limit.
+        cache_size (int, optional): The maximum number of query results
+            kept in a least-recently-used cache keyed by the band keys of
+            the query. A cached result is invalidated when a key is inserted
+            into or removed from any of its buckets. By default there is no
+            cache.
+        probes (int, optional): The number of positions at the end of each
+            band at which a query also matches buckets that differ from it
+            in exactly one hash value (multi-probe querying).
+            Each probed position raises the probability of a band
+            matching, so the parameter selection picks fewer bands for the
+            same threshold, cutting the memory used by the bucket lists.
+            The keys are bucketed by the band key without the probed hash
+            values, and a query filters the bucket by comparing the probed
+            hash values, in exchange for larger buckets to filter.
+            By default there is no probing.
+        params (tuple, optional): The LSH parameters `(b, r)`, the number
+            of bands and the number of hash values per band. If given,
+            they are used instead of optimizing for the threshold and
+            `weights`, e.g., to use the parameters chosen by
+            :func:`datasketch.lsh.tune_param`.
     '''
 
-    def __init__(self, threshold=0.9, num_perm=128, weights=(0.5,0.5)):
+    def __init__(self, threshold=0.9, num_perm=128, weights=(0.5,0.5),
+            concurrent=False, bucket_cap=None, overflow='sample', ttl=None,
+            max_size=None, cache_size=0, probes=0, params=None):
         if threshold > 1.0 or threshold < 0.0:
             raise ValueError("threshold must be in [0.0, 1.0]") 
         if num_perm < 2:
@@ -85,16 +249,110 @@ class MinHashLSH(object):
             raise ValueError("Weight must be in [0.0, 1.0]")
         if sum(weights) != 1.0:
             raise ValueError("Weights must sum to 1.0")
+        if bucket_cap is not None and bucket_cap < 1:
+            raise ValueError("bucket_cap must be positive")
+        if overflow not in ('sample', 'stop'):
+            raise ValueError("overflow must be 'sample' or 'stop'")
+        if ttl is not None and ttl <= 0:
+            raise ValueError("ttl must be positive")
+        if max_size is not None and max_size < 1:
+            raise ValueError("max_size must be positive")
+        if cache_size < 0:
+            raise ValueError("cache_size must be non-negative")
+        if probes < 0 or probes >= num_perm:
+            raise ValueError("probes must be in [0, num_perm)")
+        if params is not None:
+            b, r = params
+            if b < 1 or r <= probes or b * r > num_perm:
+                raise ValueError("The product of b and r in params must not\
+                        exceed num_perm, and r must be greater than probes")
         self.threshold = threshold
         self.h = num_perm
-        false_positive_weight, false_negative_weight = weights
-        self.b, self.r = _optimal_param(threshold, num_perm,
-                false_positive_weight, false_negative_weight)
+        if params is not None:
+            self.b, self.r = params
+        else:
+            false_positive_weight, false_negative_weight = weights
+            self.b, self.r = _optimal_param(threshold, num_perm,
+                    false_positive_weight, false_negative_weight, probes)
         self.hashtables = [defaultdict(list) for _ in range(self.b)]
         self.hashranges = [(i*self.r, (i+1)*self.r) for i in range(self.b)]
         self.keys = dict()
+        self.bucket_cap = bucket_cap
+        self.overflow = overflow
+        self.ttl = ttl
+        self.max_size = max_size
+        self._init_slices()
+        self.cache_size = cache_size
+        self.probes = probes
+        # The probed hash values of every key in all bands
+        self._probed = dict()
+        self.concurrent = concurrent
+        self._init_cache()
+        self._lock = _ReadWriteLock() if concurrent else _no_lock
+        # The number of buckets of each size across all bands, only
+        # maintained when an optional feature is used, see `_is_plain`
+        self._bucket_size_counts = None if self._is_plain() \
+                else defaultdict(int)
+
+    def _is_plain(self):
+        '''
+        Check if the index uses none of multi-probe querying, `bucket_cap`,
+        the query result cache and locking, in which case inserts, removes
+        and queries take a direct loop over the bands.
+        '''
+        return not (self.probes or self.bucket_cap is not None or
+                    self.cache_size > 0 or self.concurrent)
+
+    def _split_band_key(self, H):
+        '''
+        Split the band key `H` into the key of its bucket, which is the band
+        key without the probed hash values, and the probed hash values.
+        '''
+        n = len(H) - self.probes * (len(H) // self.r)
+        return H[:n], H[n:]
 
-    def insert(self, key, minhash):
+    def _probed_match(self, T, T2):
+        '''
+        Check if two byte strings of probed hash values differ in at most
+        one hash value.
+        '''
+        if T == T2:
+            return True
+        w = len(T) // self.probes
+        return sum(T[j:j+w] != T2[j:j+w] for j in range(0, len(T), w)) <= 1
+
+    def _keys_match(self, key1, key2, i):
+        '''
+        Check if two keys match in band `i`, allowing one mismatch at the
+        probed positions.
+        '''
+        if self.keys[key1][i] != self.keys[key2][i]:
+            return False
+        if not self.probes:
+            return True
+        T1, T2 = self._probed[key1], self._probed[key2]
+        n = len(T1) // self.b
+        return self._probed_match(T1[i*n:(i+1)*n], T2[i*n:(i+1)*n])
+
+    def _init_cache(self):
+        # The cached query results in LRU order, keyed by band keys
+        self._cache = OrderedDict()
+        # The cached band keys depending on each (band, bucket) pair
+        self._cache_deps = defaultdict(set)
+        self.cache_hits = 0
+        self.cache_misses = 0
+        # Queries holding the reader lock update the cache concurrently
+        self._cache_lock = threading.Lock() if self.concurrent else _no_lock
+
+    def _init_slices(self):
+        # The keys grouped by their insert time (or order), oldest first,
+        # as a deque of (slice_id, list of keys) tuples
+        self._slices = deque()
+        # The slice_id of every key, used to skip removed keys
+        self._key_slices = dict()
+        self._num_inserted = 0
+
+    def insert(self, key, minhash, timestamp=None):
         '''
         Insert a unique key to the index, together
         with a MinHash (or weighted MinHash) of the set referenced by 
@@ -103,18 +361,181 @@ class MinHashLSH(object):
         Args:
             key (hashable): The unique identifier of the set. 
             minhash (datasketch.MinHash): The MinHash of the set. 
+            timestamp (float, optional): The insert time in seconds used
+                with `ttl`, by default the current time. Timestamps are
+                expected to be non-decreasing, an earlier timestamp is
+                treated as the latest one seen.
         '''
         if len(minhash) != self.h:
             raise ValueError("Expecting minhash with length %d, got %d"
                     % (self.h, len(minhash)))
-        if key in self.keys:
-            raise ValueError("The given key already exists")
-        self.keys[key] = [self._H(minhash.hashvalues[start:end]) 
+        with self._lock.writer:
+            if key in self.keys:
+                raise ValueError("The given key already exists")
+            self._insert(key, minhash.hashvalues)
+            if self.ttl is not None or self.max_size is not None:
+                self._track(key, timestamp)
+
+    def _track(self, key, timestamp):
+        '''
+        Add a newly inserted key to the latest slice, and evict the
+        expired slices and the slices over capacity.
+        '''
+        if self.ttl is not None:
+            if timestamp is None:
+                timestamp = time.time()
+            slice_id = int(timestamp // (self.ttl / 10.0))
+        else:
+            slice_id = self._num_inserted // -(-self.max_size // 10)
+        self._num_inserted += 1
+        if not self._slices or slice_id > self._slices[-1][0]:
+            self._slices.append((slice_id, []))
+        slice_id, slice_keys = self._slices[-1]
+        slice_keys.append(key)
+        self._key_slices[key] = slice_id
+        if self.ttl is not None:
+            self._expire(timestamp)
+        if self.max_size is not None:
+            while len(self.keys) > self.max_size:
+                if len(self._slices) > 1:
+                    slice_id, evicted = self._slices.popleft()
+                else:
+                    # Never drop the latest slice as a whole
+                    slice_id, slice_keys = self._slices[0]
+                    n = len(self.keys) - self.max_size
+                    evicted = slice_keys[:n]
+                    del slice_keys[:n]
+                self._remove_batch(slice_id, evicted)
+
+    def expire(self, now=None):
+        '''
+        Remove the keys whose time slices have expired according to
+        the `ttl`. This is also done on every insert.
+
+        Args:
+            now (float, optional): The current time in seconds, by default
+                the current system time.
+        '''
+        if self.ttl is None:
+            raise ValueError("The index has no ttl")
+        with self._lock.writer:
+            self._expire(time.time() if now is None else now)
+
+    def _expire(self, now):
+        width = self.ttl / 10.0
+        while self._slices and \
+                (self._slices[0][0] + 1) * width + self.ttl <= now:
+            slice_id, slice_keys = self._slices.popleft()
+            self._remove_batch(slice_id, slice_keys)
+
+    def _remove_batch(self, slice_id, slice_keys):
+        '''
+        Remove a batch of keys of a slice, rebuilding each affected bucket
+        once instead of removing the keys from the buckets one by one.
+        '''
+        removing = set(key for key in slice_keys
+                       if self._key_slices.get(key) == slice_id)
+        affected = [set() for _ in range(self.b)]
+        for key in removing:
+            for i, H in enumerate(self.keys.pop(key)):
+                affected[i].add(H)
+            self._probed.pop(key, None)
+            del self._key_slices[key]
+        for i, (Hs, hashtable) in enumerate(zip(affected, self.hashtables)):
+            for H in Hs:
+                self._invalidate(i, H)
+                bucket = hashtable[H]
+                remaining = [key for key in bucket if key not in removing]
+                if self._bucket_size_counts is not None:
+                    _update_size_counts(self._bucket_size_counts,
+                            len(bucket), len(remaining))
+                if remaining:
+                    hashtable[H] = remaining
+                else:
+                    del hashtable[H]
+
+    def _insert(self, key, hashvalues):
+        Hs = [self._H(hashvalues[start:end])
                 for start, end in self.hashranges]
-        for H, hashtable in zip(self.keys[key], self.hashtables):
-            hashtable[H].append(key)
+        if self.probes:
+            # Only the bucket keys are kept in `keys`, and the probed hash
+            # values of all bands are joined into one byte string
+            Hs, Ts = zip(*[self._split_band_key(H) for H in Hs])
+            Hs = list(Hs)
+            self._probed[key] = b''.join(Ts)
+        self.keys[key] = Hs
+        counts = self._bucket_size_counts
+        if counts is None and not self._cache_deps:
+            for H, hashtable in zip(Hs, self.hashtables):
+                hashtable[H].append(key)
+            return
+        for i, (H, hashtable) in enumerate(zip(Hs, self.hashtables)):
+            bucket = hashtable[H]
+            bucket.append(key)
+            if counts is not None:
+                _update_size_counts(counts, len(bucket) - 1, len(bucket))
+            self._invalidate(i, H)
+
+    def _invalidate(self, i, H):
+        '''
+        Drop the cached query results using the bucket `H` of band `i`.
+        '''
+        if not self._cache_deps:
+            return
+        with self._cache_lock:
+            for cache_key in self._cache_deps.pop((i, H), ()):
+                if self._cache.pop(cache_key, None) is not None:
+                    self._drop_cache_deps(cache_key)
 
-    def query(self, minhash):
+    def _cache_key_deps(self, cache_key):
+        '''
+        Get the buckets that a cached query result depends on.
+        '''
+        return [(i, self._split_band_key(H)[0])
+                for i, H in enumerate(cache_key)]
+
+    def _drop_cache_deps(self, cache_key):
+        for dep in self._cache_key_deps(cache_key):
+            cache_keys = self._cache_deps.get(dep)
+            if cache_keys is None:
+                continue
+            cache_keys.discard(cache_key)
+            if not cache_keys:
+                del self._cache_deps[dep]
+
+    def _cache_get(self, cache_key):
+        with self._cache_lock:
+            value = self._cache.pop(cache_key, None)
+            if value is None:
+                self.cache_misses += 1
+                return None
+            # Move to the most recently used end
+            self._cache[cache_key] = value
+            self.cache_hits += 1
+            return value
+
+    def _cache_put(self, cache_key, value):
+        with self._cache_lock:
+            if cache_key in self._cache:
+                return
+            self._cache[cache_key] = value
+            for dep in self._cache_key_deps(cache_key):
+                self._cache_deps[dep].add(cache_key)
+            while len(self._cache) > self.cache_size:
+                old_key, _ = self._cache.popitem(last=False)
+                self._drop_cache_deps(old_key)
+
+    def cache_info(self):
+        '''
+        Returns:
+            tuple: The number of cache hits, cache misses, the maximum
+            and the current number of cached query results, in the format
+            of :code:`(hits, misses, maxsize, currsize)`.
+        '''
+        return (self.cache_hits, self.cache_misses, self.cache_size,
+                len(self._cache))
+
+    def query(self, minhash, return_overflow=False, limit=None):
         '''
         Giving the MinHash of the query set, retrieve 
         the keys that references sets with Jaccard
@@ -122,20 +543,158 @@ class MinHashLSH(object):
         
         Args:
             minhash (datasketch.MinHash): The MinHash of the query set. 
+            return_overflow (bool, optional): If True, also return the
+                bands in which the matched bucket had more keys than
+                `bucket_cap`, and was therefore sampled or skipped
+                according to `overflow`.
+            limit (int, optional): The maximum number of keys to return.
+                The bands are no longer probed once `limit` keys are found.
+
+        Returns:
+            `list` of keys, or a tuple of the `list` of keys and the `list`
+            of overflowed band indexes if `return_overflow` is True.
+        '''
+        if limit is not None and limit < 1:
+            raise ValueError("limit must be positive")
+        Hs = self._query_keys(minhash)
+        if limit is None and self._is_plain():
+            candidates = set()
+            for H, hashtable in zip(Hs, self.hashtables):
+                bucket = hashtable.get(H)
+                if bucket is not None:
+                    candidates.update(bucket)
+            if return_overflow:
+                return list(candidates), []
+            return list(candidates)
+        cached = None
+        if self.cache_size > 0:
+            cached = self._cache_get(Hs)
+        if cached is not None:
+            candidates, overflowed = cached
+        else:
+            candidates = set()
+            overflowed = []
+            complete = True
+            with self._lock.reader:
+                for bucket in self._candidate_buckets(Hs, overflowed):
+                    if limit is None:
+                        candidates.update(bucket)
+                        continue
+                    for key in bucket:
+                        candidates.add(key)
+                        if len(candidates) >= limit:
+                            break
+                    if len(candidates) >= limit:
+                        complete = False
+                        break
+                if self.cache_size > 0 and complete:
+                    # Store while holding the reader lock, so no writer can
+                    # change the buckets before the result is cached.
+                    self._cache_put(Hs, (candidates, overflowed))
+        result = list(candidates)
+        if limit is not None:
+            result = result[:limit]
+        if return_overflow:
+            return result, list(overflowed)
+        return result
+
+    def query_iter(self, minhash):
+        '''
+        Giving the MinHash of the query set, lazily generate the keys
+        that references sets with Jaccard similarities greater than
+        the threshold, one band at a time. Stopping the iteration early
+        skips the remaining bands.
+
+        Args:
+            minhash (datasketch.MinHash): The MinHash of the query set.
+
+        Returns:
+            generator: The keys, each generated once.
+        '''
+        Hs = self._query_keys(minhash)
+        seen = set()
+        for i, H in enumerate(Hs):
+            # Only hold the reader lock while collecting a band
+            with self._lock.reader:
+                keys = [key for bucket in self._band_buckets(i, H, [])
+                        for key in bucket]
+            for key in keys:
+                if key not in seen:
+                    seen.add(key)
+                    yield key
+
+    def any_match(self, minhash):
+        '''
+        Check if there is any key that references a set with Jaccard
+        similarity greater than the threshold, stopping at the first
+        matching bucket.
+
+        Args:
+            minhash (datasketch.MinHash): The MinHash of the query set.
 
         Returns:
-            `list` of keys.
+            bool: True if there is at least one candidate.
         '''
+        Hs = self._query_keys(minhash)
+        if self.cache_size > 0:
+            with self._cache_lock:
+                cached = self._cache.get(Hs)
+            if cached is not None:
+                return len(cached[0]) > 0
+        with self._lock.reader:
+            for bucket in self._candidate_buckets(Hs, []):
+                if bucket:
+                    return True
+        return False
+
+    def _query_keys(self, minhash):
         if len(minhash) != self.h:
             raise ValueError("Expecting minhash with length %d, got %d"
                     % (self.h, len(minhash)))
-        candidates = set()
-        for (start, end), hashtable in zip(self.hashranges, self.hashtables):
-            H = self._H(minhash.hashvalues[start:end])
-            if H in hashtable:
-                for key in hashtable[H]:
-                    candidates.add(key)
-        return list(candidates)
+        return tuple(self._H(minhash.hashvalues[start:end])
+                for start, end in self.hashranges)
+
+    def _candidate_buckets(self, Hs, overflowed):
+        '''
+        Get the buckets matching the band keys `Hs` in all bands, with
+        overflowed buckets sampled or skipped.
+        '''
+        for i, H in enumerate(Hs):
+            for bucket in self._band_buckets(i, H, overflowed):
+                yield bucket
+
+    def _band_buckets(self, i, H, overflowed):
+        '''
+        Get the buckets matching the band key `H` in band `i`, with
+        overflowed buckets sampled or skipped. The overflowed band is
+        appended to `overflowed`.
+        '''
+        cap = self.bucket_cap
+        for bucket in self._probe_buckets(i, H):
+            if cap is not None and len(bucket) > cap:
+                if not overflowed or overflowed[-1] != i:
+                    overflowed.append(i)
+                if self.overflow == 'stop':
+                    continue
+                bucket = bucket[::-(-len(bucket) // cap)]
+            yield bucket
+
+    def _probe_buckets(self, i, H):
+        '''
+        Get the buckets of band `i` matching the band key `H`. With
+        multi-probe querying, the bucket is filtered to the keys whose
+        band keys match `H` at all but at most one probed position.
+        '''
+        H, T = self._split_band_key(H)
+        bucket = self.hashtables[i].get(H)
+        if bucket is None:
+            return
+        if self.probes:
+            n = len(T)
+            probed = self._probed
+            bucket = [key for key in bucket if self._probed_match(T,
+                      probed[key][i*n:(i+1)*n])]
+        yield bucket
 
     def __contains__(self, key):
         '''
@@ -154,13 +713,269 @@ class MinHashLSH(object):
         Args:
             key (hashable): The unique identifier of a set.
         '''
-        if key not in self.keys:
-            raise ValueError("The given key does not exist")
-        for H, hashtable in zip(self.keys[key], self.hashtables):
-            hashtable[H].remove(key)
-            if not hashtable[H]:
-                del hashtable[H]
-        self.keys.pop(key)
+        with self._lock.writer:
+            if key not in self.keys:
+                raise ValueError("The given key does not exist")
+            Hs = self.keys.pop(key)
+            counts = self._bucket_size_counts
+            if counts is None and not self._cache_deps:
+                for H, hashtable in zip(Hs, self.hashtables):
+                    bucket = hashtable[H]
+                    bucket.remove(key)
+                    if not bucket:
+                        del hashtable[H]
+            else:
+                for i, (H, hashtable) in enumerate(zip(Hs, self.hashtables)):
+                    self._invalidate(i, H)
+                    bucket = hashtable[H]
+                    bucket.remove(key)
+                    if counts is not None:
+                        _update_size_counts(counts, len(bucket) + 1,
+                                len(bucket))
+                    if not bucket:
+                        del hashtable[H]
+            self._probed.pop(key, None)
+            self._key_slices.pop(key, None)
+
+    def self_join(self, minhashes=None):
+        '''
+        Find the pairs of keys in the index that are candidates of having
+        Jaccard similarities greater than the threshold, by walking the
+        buckets of every band once. The pairs are generated one at a time
+        and each pair is generated only once: a pair is only emitted in
+        the first band in which the two keys share a bucket.
+
+        Note:
+            The index must not be modified while iterating the pairs.
+
+        Args:
+            minhashes (dict, optional): A mapping from keys to their MinHash
+                (or weighted MinHash). If given, the candidate pairs are
+                verified and only the pairs with estimated Jaccard
+                similarities no less than the threshold are generated.
+
+        Returns:
+            generator: The pairs of keys as tuples.
+        '''
+        for i, hashtable in enumerate(self.hashtables):
+            for bucket in hashtable.values():
+                for x in range(len(bucket) - 1):
+                    key1 = bucket[x]
+                    for key2 in bucket[x+1:]:
+                        if self.probes and not self._keys_match(key1, key2,
+                                i):
+                            continue
+                        # Skip the pair if it was emitted in an earlier band
+                        if any(self._keys_match(key1, key2, j)
+                               for j in range(i)):
+                            continue
+                        if minhashes is not None and \
+                                minhashes[key1].jaccard(minhashes[key2]) < \
+                                self.threshold:
+                            continue
+                        yield key1, key2
+
+    def clusters(self, minhashes=None):
+        '''
+        Group the keys in the index into clusters of near-duplicates, which
+        are the connected components of the candidate pairs found by
+        :func:`datasketch.MinHashLSH.self_join`. An array-based union-find
+        is used to compute the connected components.
+        Without verification and multi-probe querying, the keys in each
+        bucket are merged directly and no pair is generated.
+
+        Args:
+            minhashes (dict, optional): A mapping from keys to their MinHash
+                (or weighted MinHash), used to verify the candidate pairs.
+
+        Returns:
+            `list` of clusters, each of which is a `list` of keys. Keys
+            without any near-duplicate are in clusters of their own.
+        '''
+        with self._lock.reader:
+            keys = list(self.keys)
+            ids = dict((key, i) for i, key in enumerate(keys))
+            parent = list(range(len(keys)))
+            if minhashes is None and not self.probes:
+                for hashtable in self.hashtables:
+                    for bucket in hashtable.values():
+                        first = ids[bucket[0]]
+                        for key in bucket[1:]:
+                            _union(parent, first, ids[key])
+            else:
+                for key1, key2 in self.self_join(minhashes):
+                    _union(parent, ids[key1], ids[key2])
+        groups = defaultdict(list)
+        for i, key in enumerate(keys):
+            groups[_find(parent, i)].append(key)
+        return list(groups.values())
+
+    def merge(self, other):
+        '''
+        Merge the other MinHash LSH index into this one, making this
+        index contain the keys of both.
+        The band buckets of the other index are concatenated to the
+        buckets of this one, so no signature is hashed again, and the
+        buckets only in the other index are copied as a whole.
+
+        Args:
+            other (datasketch.MinHashLSH): The other MinHash LSH index.
+                It must have the same threshold, number of permutation
+                functions, `b` and `r`, and must not share any key
+                with this index.
+        '''
+        if self.threshold != other.threshold or self.h != other.h:
+            raise ValueError("Cannot merge MinHashLSH with different\
+                    threshold or number of permutation functions")
+        if self.b != other.b or self.r != other.r:
+            raise ValueError("Cannot merge MinHashLSH with different\
+                    b and r parameters")
+        if self.probes != other.probes:
+            raise ValueError("Cannot merge MinHashLSH with different\
+                    number of probes")
+        if self._slices or other._slices:
+            raise ValueError("Cannot merge MinHashLSH with ttl or max_size")
+        with self._lock.writer:
+            if any(key in self.keys for key in other.keys):
+                raise ValueError("Cannot merge MinHashLSH with overlapping keys")
+            counts = self._bucket_size_counts
+            for i, (hashtable, other_hashtable) in enumerate(zip(
+                    self.hashtables, other.hashtables)):
+                for H, keys in other_hashtable.items():
+                    if self._cache_deps:
+                        self._invalidate(i, H)
+                    bucket = hashtable.get(H)
+                    if bucket is None:
+                        hashtable[H] = list(keys)
+                        if counts is not None:
+                            counts[len(keys)] += 1
+                    else:
+                        bucket.extend(keys)
+                        if counts is not None:
+                            _update_size_counts(counts,
+                                    len(bucket) - len(keys), len(bucket))
+            self.keys.update(other.keys)
+            self._probed.update(other._probed)
+
+    @classmethod
+    def from_partials(cls, *partials):
+        '''
+        Create a MinHash LSH index by merging partial indexes, typically
+        built over disjoint sets of keys in different processes.
+        The partial indexes are left unchanged.
+
+        Args:
+            *partials: The partial `datasketch.MinHashLSH` indexes.
+                They must have the same parameters and disjoint keys.
+
+        Returns:
+            datasketch.MinHashLSH: A new index containing all keys, with
+            the parameters of the partial indexes.
+        '''
+        if len(partials) < 1:
+            raise ValueError("Cannot create MinHashLSH from no partial index")
+        first = partials[0]
+        # The parameters are given positionally, as the number of
+        # permutation functions is named differently in the subclasses
+        lsh = cls(first.threshold, first.h, (0.5, 0.5), first.concurrent,
+                first.bucket_cap, first.overflow, first.ttl, first.max_size,
+                first.cache_size, first.probes, (first.b, first.r))
+        for partial in partials:
+            lsh.merge(partial)
+        return lsh
+
+    @classmethod
+    def build_parallel(cls, entries, processes=None, **kwargs):
+        '''
+        Build a MinHash LSH index using multiple worker processes.
+        The bands are split into disjoint groups, and each worker creates
+        the band keys and the buckets of its group of bands using array and
+        built-in bulk operations. The parent process only assembles the
+        hash tables and the keys returned by the workers.
+
+        Args:
+            entries (list): A list of `(key, minhash)` tuples, in which
+                the keys are unique.
+            processes (int, optional): The number of worker processes.
+                By default it is the number of CPUs.
+            **kwargs: The arguments of the constructor, e.g., `threshold`
+                and `num_perm`, see :class:`datasketch.MinHashLSH`.
+                `ttl` and `max_size` are not supported.
+
+        Returns:
+            datasketch.MinHashLSH: The index containing all entries.
+        '''
+        lsh = cls(**kwargs)
+        if lsh.ttl is not None or lsh.max_size is not None:
+            raise ValueError("Cannot build MinHashLSH with ttl or max_size\
+                    in parallel")
+        for _, minhash in entries:
+            if len(minhash) != lsh.h:
+                raise ValueError("Expecting minhash with length %d, got %d"
+                        % (lsh.h, len(minhash)))
+        keys = [key for key, _ in entries]
+        if len(set(keys)) != len(keys):
+            raise ValueError("The given key already exists")
+        if not entries:
+            return lsh
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        # Only send the hash values of the bands of each group to the
+        # workers, which are much cheaper to pickle than the MinHash objects.
+        signatures = np.array([minhash.hashvalues for _, minhash in entries])
+        size = -(-lsh.b // max(1, min(processes, lsh.b)))
+        groups = [(signatures[:, i*lsh.r:min(i+size, lsh.b)*lsh.r], keys,
+                   lsh.r, lsh.probes) for i in range(0, lsh.b, size)]
+        if len(groups) <= 1:
+            results = [_build_bands(group) for group in groups]
+        else:
+            pool = multiprocessing.Pool(len(groups))
+            try:
+                results = pool.map(_build_bands, groups)
+            finally:
+                pool.close()
+                pool.join()
+        bands = [band for group in results for band in group]
+        lsh.hashtables = [hashtable for _, hashtable in bands]
+        lsh.keys = dict(zip(keys, map(list, zip(*[Hs for Hs, _ in bands]))))
+        if lsh.probes:
+            # The probed hash values at the end of every band, joined
+            # in the same order as `_insert`
+            columns = [j for start, end in lsh.hashranges
+                       for j in range(end - lsh.probes, end)]
+            lsh._probed = dict(zip(keys,
+                _band_keys(signatures[:, columns]).tolist()))
+        if lsh._bucket_size_counts is not None:
+            lsh._bucket_size_counts = _count_bucket_sizes(lsh.hashtables)
+        return lsh
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # Locks cannot be pickled, they are re-created when unpickling
+        del state['_lock']
+        # The query result cache starts empty when unpickling
+        for name in ('_cache', '_cache_deps', 'cache_hits', 'cache_misses',
+                '_cache_lock'):
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        # Indexes pickled by older versions lack the attributes added since
+        for name, value in (('bucket_cap', None), ('overflow', 'sample'),
+                ('ttl', None), ('max_size', None), ('cache_size', 0),
+                ('probes', 0), ('concurrent', False)):
+            state.setdefault(name, value)
+        self.__dict__.update(state)
+        if '_slices' not in state:
+            self._init_slices()
+        if '_probed' not in state:
+            self._probed = dict()
+        self._init_cache()
+        self._lock = _ReadWriteLock() if self.concurrent else _no_lock
+        if self._is_plain():
+            self._bucket_size_counts = None
+        elif self.__dict__.get('_bucket_size_counts') is None:
+            self._bucket_size_counts = _count_bucket_sizes(self.hashtables)
 
     def is_empty(self):
         '''
@@ -169,16 +984,275 @@ class MinHashLSH(object):
         '''
         return any(len(t) == 0 for t in self.hashtables)
 
+    def stats(self, num_hot_buckets=0):
+        '''
+        Get the statistics of the index for monitoring and capacity planning.
+        The memory usage is approximated from a sample of the stored
+        objects. The bucket size distribution is maintained incrementally
+        when `concurrent`, `bucket_cap`, `cache_size` or `probes` is used,
+        so this method is cheap unless `num_hot_buckets` is given.
+        Otherwise, inserts and removes do not track it, and it is counted
+        from the buckets here.
+
+        Args:
+            num_hot_buckets (int, optional): The number of largest buckets
+                to report. Finding them scans every bucket.
+
+        Returns:
+            dict: The statistics, containing:
+
+            * `num_keys`: the number of keys.
+            * `num_buckets`: the number of buckets in each band.
+            * `bucket_size_distribution`: a dict mapping bucket sizes to the
+              number of buckets of that size across all bands.
+            * `max_bucket_size` and `mean_bucket_size`.
+            * `hot_buckets`: a list of `(band, bucket_size)` of the largest
+              buckets, sorted by size in descending order.
+            * `num_overflowed_buckets`: the number of buckets with more keys
+              than `bucket_cap`.
+            * `cache_hits` and `cache_misses`: the counters of the query
+              result cache.
+            * `bytesize`: a dict with the approximate number of bytes used
+              by `hashtables`, `keys` and, with multi-probe querying, the
+              `probed` hash values.
+        '''
+        with self._lock.reader:
+            num_buckets = [len(hashtable) for hashtable in self.hashtables]
+            counts = self._bucket_size_counts
+            if counts is None:
+                counts = _count_bucket_sizes(self.hashtables)
+            distribution = dict(counts)
+            hot_buckets = _hot_buckets(self.hashtables, num_hot_buckets)
+            bytesize = {
+                "hashtables" : sum(_hashtable_bytesize(hashtable,
+                    len(self.keys)) for hashtable in self.hashtables),
+                "keys" : _keys_bytesize(self.keys),
+                "probed" : _probed_bytesize(self._probed),
+            }
+        return {
+            "num_keys" : len(self.keys),
+            "num_buckets" : num_buckets,
+            "bucket_size_distribution" : distribution,
+            "max_bucket_size" : max(distribution) if distribution else 0,
+            "mean_bucket_size" : float(len(self.keys) * self.b) /
+                    max(sum(num_buckets), 1),
+            "hot_buckets" : hot_buckets,
+            "num_overflowed_buckets" : 0 if self.bucket_cap is None else
+                    sum(count for size, count in distribution.items()
+                        if size > self.bucket_cap),
+            "cache_hits" : self.cache_hits,
+            "cache_misses" : self.cache_misses,
+            "bytesize" : bytesize,
+        }
+
     def _H(self, hs):
         return bytes(hs.byteswap().data)
 
 
+def _find(parent, i):
+    while parent[i] != i:
+        # Path halving
+        parent[i] = parent[parent[i]]
+        i = parent[i]
+    return i
+
+
+def _union(parent, i, j):
+    i, j = _find(parent, i), _find(parent, j)
+    if i != j:
+        parent[max(i, j)] = min(i, j)
+
+
+def _update_size_counts(counts, old_size, new_size):
+    '''
+    Move a bucket from `old_size` to `new_size` in a distribution of
+    bucket sizes. A size of 0 means the bucket does not exist.
+    '''
+    if old_size > 0:
+        counts[old_size] -= 1
+        if counts[old_size] == 0:
+            del counts[old_size]
+    if new_size > 0:
+        counts[new_size] += 1
+
+
+def _count_bucket_sizes(hashtables):
+    '''
+    Get the number of buckets of each size across the hash tables.
+    '''
+    counts = defaultdict(int)
+    for hashtable in hashtables:
+        for bucket in hashtable.values():
+            counts[len(bucket)] += 1
+    return counts
+
+
+def _hot_buckets(hashtables, n):
+    if n <= 0:
+        return []
+    sizes = [(len(bucket), i) for i, hashtable in enumerate(hashtables)
+             for bucket in hashtable.values()]
+    sizes.sort(reverse=True)
+    return [(i, size) for size, i in sizes[:n]]
+
+
+_pointer_size = struct.calcsize('P')
+
+
+def _hashtable_bytesize(hashtable, num_entries):
+    '''
+    Approximate the number of bytes used by a hash table of buckets, using
+    the first bucket as a sample.
+    '''
+    size = sys.getsizeof(hashtable)
+    for H in hashtable:
+        size += len(hashtable) * (sys.getsizeof(H) + sys.getsizeof([]))
+        break
+    return size + num_entries * _pointer_size
+
+
+def _keys_bytesize(keys):
+    '''
+    Approximate the number of bytes used by the keys and their band keys,
+    using the first key as a sample.
+    '''
+    size = sys.getsizeof(keys)
+    for key, Hs in keys.items():
+        size += len(keys) * (sys.getsizeof(key) + sys.getsizeof(Hs) +
+                sum(sys.getsizeof(H) for H in Hs))
+        break
+    return size
+
+
+def _probed_bytesize(probed):
+    '''
+    Approximate the number of bytes used by the probed hash values, using
+    the first key as a sample. The keys are counted in `_keys_bytesize`.
+    '''
+    size = sys.getsizeof(probed)
+    for T in probed.values():
+        size += len(probed) * sys.getsizeof(T)
+        break
+    return size
+
+
+class _ReadWriteLock(object):
+    '''
+    A writer-preferring reader-writer lock. Use the `reader` and `writer`
+    attributes as context managers.
+    '''
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writing = False
+        self._waiting_writers = 0
+        self.reader = _LockContext(self.acquire_read, self.release_read)
+        self.writer = _LockContext(self.acquire_write, self.release_write)
+
+    def acquire_read(self):
+        with self._cond:
+            while self._writing or self._waiting_writers > 0:
+                self._cond.wait()
+            self._readers += 1
+
+    def release_read(self):
+        with self._cond:
+            self._readers -= 1
+            if self._readers == 0:
+                self._cond.notify_all()
+
+    def acquire_write(self):
+        with self._cond:
+            self._waiting_writers += 1
+            while self._writing or self._readers > 0:
+                self._cond.wait()
+            self._waiting_writers -= 1
+            self._writing = True
+
+    def release_write(self):
+        with self._cond:
+            self._writing = False
+            self._cond.notify_all()
+
+
+class _LockContext(object):
+
+    def __init__(self, acquire, release):
+        self._acquire = acquire
+        self._release = release
+
+    def __enter__(self):
+        self._acquire()
+
+    def __exit__(self, *args):
+        self._release()
+
+
+class _NoLock(object):
+    '''
+    Used in place of `_ReadWriteLock` when the index is not concurrent.
+    '''
+
+    def __init__(self):
+        self.reader = self
+        self.writer = self
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *args):
+        pass
+
+_no_lock = _NoLock()
+
+
+def _band_keys(hashvalues):
+    '''
+    Get the band keys of the hash values of many MinHash in one band, with
+    one row per MinHash, as an array of the same bytes as `MinHashLSH._H`.
+    A void dtype is used, which keeps the trailing null bytes.
+    '''
+    band = np.ascontiguousarray(hashvalues.byteswap())
+    band = band.reshape(len(band), -1)
+    return band.view('V%d' % (band.shape[1] * band.itemsize)).ravel()
+
+
+def _build_bands(args):
+    '''
+    Build the hash tables of a group of bands, given the hash values of all
+    entries in these bands and their keys, used by the worker processes of
+    :func:`datasketch.MinHashLSH.build_parallel`. The band keys of the
+    entries and the hash table are returned for every band.
+    '''
+    signatures, keys, r, probes = args
+    results = []
+    for start in range(0, signatures.shape[1], r):
+        band = _band_keys(signatures[:, start:start+r-probes])
+        Hs = band.tolist()
+        # Create every bucket with a single key, then replace the buckets
+        # shared by several keys, in the order of the entries
+        hashtable = defaultdict(list, zip(Hs, map(list, zip(keys))))
+        _, inverse, sizes = np.unique(band, return_inverse=True,
+                return_counts=True)
+        positions = np.nonzero(sizes[inverse] > 1)[0]
+        positions = positions[np.argsort(inverse[positions], kind='mergesort')]
+        bounds = np.nonzero(np.diff(inverse[positions]))[0] + 1
+        for p in np.split(positions, bounds):
+            if len(p) > 0:
+                hashtable[Hs[p[0]]] = [keys[j] for j in p.tolist()]
+        results.append((Hs, hashtable))
+    return results
+
+
 class WeightedMinHashLSH(MinHashLSH):
     '''
     The classic MinHash LSH adapted for Weighted MinHash
     '''
 
-    def __init__(self, threshold=0.9, sample_size=128, weights=(0.5,0.5)):
+    def __init__(self, threshold=0.9, sample_size=128, weights=(0.5,0.5),
+            concurrent=False, bucket_cap=None, overflow='sample', ttl=None,
+            max_size=None, cache_size=0, probes=0, params=None):
         '''
         Create an empty `WeightedMinHashLSH` index that accepts 
         WeightedMinHash objects
@@ -192,5 +1266,14 @@ class WeightedMinHashLSH(MinHashLSH):
         for the Jaccard similarity threshold.
         `weights` is a tuple in the format of 
         (false_positive_weight, false_negative_weight).
+
+        Set `concurrent` to True to enable reader-writer locking, and
+        use `bucket_cap` and `overflow` to bound the number of keys taken
+        from a single bucket by a query. Use `ttl` and `max_size` to evict
+        keys in batches for streaming use, `cache_size` to cache
+        query results, `probes` for multi-probe querying, and `params`
+        to set `(b, r)` directly.
         '''
-        super(WeightedMinHashLSH, self).__init__(threshold, sample_size, weights)
+        super(WeightedMinHashLSH, self).__init__(threshold, sample_size, weights,
+                concurrent, bucket_cap, overflow, ttl, max_size, cache_size,
+                probes, params)
@@ -0,0 +1,192 @@
+'''
+This module implements the LSH Ensemble index for containment search.
+'''
+import numpy as np
+from datasketch.lsh import MinHashLSH
+
+
+def _containment_probabilities(threshold, x, q, num_perm, rs, num_points=100):
+    '''
+    Compute the false positive and false negative probabilities of
+    containment search for every `(b, r)` with `r` in `rs`, given the
+    indexed set size `x` and the query set size `q`.
+
+    Returns:
+        list: Tuples of `(fp, fn, b, r)`.
+    '''
+    # Midpoints of the integration intervals of containment
+    step = 1.0 / num_points
+    c = (np.arange(num_points) + 0.5) * step
+    # The Jaccard similarity given containment c of the query in a set of
+    # size x
+    s = c * q / (q + x - c * q)
+    below = c < threshold
+    result = []
+    for r in rs:
+        bs = np.arange(1, num_perm // r + 1)
+        # The probability of becoming a candidate for every b (rows) and
+        # every containment (columns)
+        p = 1.0 - (1.0 - s ** r)[np.newaxis, :] ** bs[:, np.newaxis]
+        fps = np.sum(p[:, below], axis=1) * step
+        fns = np.sum(1.0 - p[:, ~below], axis=1) * step
+        result.extend(zip(fps, fns, bs, [r] * len(bs)))
+    return result
+
+
+class MinHashLSHEnsemble(object):
+    '''
+    The `LSH Ensemble <http://www.vldb.org/pvldb/vol9/p1185-zhu.pdf>`_
+    index for containment search: finding the indexed sets that contain
+    at least a given fraction of the query set, e.g., for joinable table
+    discovery. The containment of the query set Q in an indexed set X is
+    :math:`|Q \\cap X| / |Q|`.
+
+    The keys are partitioned by the cardinalities of their sets into
+    partitions of equal number of keys. Every partition holds `m`
+    MinHash LSH indexes with different numbers of hash values per band
+    `r`, and at query time the number of bands `b` and `r` used in each
+    partition are tuned for the containment threshold, the query set size
+    and the upper bound of the set sizes in the partition.
+
+    Note:
+        An LSH Ensemble uses approximately `m` times the memory of a MinHash
+        LSH holding the same keys. The index is built once using
+        :func:`datasketch.MinHashLSHEnsemble.index`.
+
+    Args:
+        threshold (float): The containment threshold between 0.0 and 1.0.
+        num_perm (int, optional): The number of permutation functions used
+            by the MinHash to be indexed.
+        num_part (int, optional): The number of partitions by set size.
+        m (int, optional): The number of MinHash LSH indexes in every
+            partition, which use 1 to `m` hash values per band.
+        weights (tuple, optional): Used to adjust the relative importance of
+            minimizing false positive and false negative when tuning the
+            parameters, in the format of
+            :code:`(false_positive_weight, false_negative_weight)`.
+    '''
+
+    def __init__(self, threshold=0.9, num_perm=128, num_part=16, m=8,
+            weights=(0.5,0.5)):
+        if threshold > 1.0 or threshold < 0.0:
+            raise ValueError("threshold must be in [0.0, 1.0]")
+        if num_perm < 2:
+            raise ValueError("Too few permutation functions")
+        if num_part < 1:
+            raise ValueError("num_part must be positive")
+        if m < 1 or m > num_perm:
+            raise ValueError("m must be in [1, num_perm]")
+        if any(w < 0.0 or w > 1.0 for w in weights):
+            raise ValueError("Weight must be in [0.0, 1.0]")
+        if sum(weights) != 1.0:
+            raise ValueError("Weights must sum to 1.0")
+        self.threshold = threshold
+        self.h = num_perm
+        self.num_part = num_part
+        self.m = m
+        self.weights = weights
+        self.rs = list(range(1, m + 1))
+        # The upper bounds of set sizes and the indexes of the partitions
+        self.uppers = []
+        self.indexes = []
+        self.keys = dict()
+        self._param_cache = dict()
+
+    def index(self, entries):
+        '''
+        Index all sets given their keys, MinHash and sizes.
+        It can be called only once.
+
+        Args:
+            entries (iterable): An iterable of `(key, minhash, size)` tuples,
+                in which the key is unique, the minhash is the MinHash of
+                the set and the size is the exact (or estimated)
+                cardinality of the set.
+        '''
+        if self.keys:
+            raise ValueError("Cannot call index again on a non-empty index")
+        entries = list(entries)
+        if len(set(e[0] for e in entries)) != len(entries):
+            raise ValueError("The given keys are not unique")
+        for key, minhash, size in entries:
+            if len(minhash) != self.h:
+                raise ValueError("Expecting minhash with length %d, got %d"
+                        % (self.h, len(minhash)))
+            if size <= 0:
+                raise ValueError("Set size must be positive")
+        entries.sort(key=lambda e : e[2])
+        part_size = max(1, -(-len(entries) // self.num_part))
+        for start in range(0, len(entries), part_size):
+            partition = entries[start:start+part_size]
+            indexes = dict((r, MinHashLSH(self.threshold, self.h,
+                params=(self.h // r, r))) for r in self.rs)
+            for key, minhash, size in partition:
+                self.keys[key] = size
+                for lsh in indexes.values():
+                    lsh.insert(key, minhash)
+            self.uppers.append(partition[-1][2])
+            self.indexes.append(indexes)
+
+    def query(self, minhash, size):
+        '''
+        Giving the MinHash and size of the query set, retrieve the keys
+        that references sets containing at least `threshold` fraction of
+        the query set.
+
+        Args:
+            minhash (datasketch.MinHash): The MinHash of the query set.
+            size (int): The cardinality of the query set.
+
+        Returns:
+            `list` of keys.
+        '''
+        if len(minhash) != self.h:
+            raise ValueError("Expecting minhash with length %d, got %d"
+                    % (self.h, len(minhash)))
+        if size <= 0:
+            raise ValueError("Query set size must be positive")
+        candidates = set()
+        for upper, indexes in zip(self.uppers, self.indexes):
+            # Sets smaller than threshold * size cannot qualify
+            if upper < self.threshold * size:
+                continue
+            b, r = self._get_param(upper, size)
+            lsh = indexes[r]
+            for (start, end), hashtable in zip(lsh.hashranges[:b],
+                    lsh.hashtables):
+                H = lsh._H(minhash.hashvalues[start:end])
+                if H in hashtable:
+                    candidates.update(hashtable[H])
+        return list(candidates)
+
+    def _get_param(self, upper, size):
+        '''
+        Get the optimal `(b, r)` for a partition with the upper bound of set
+        sizes `upper` and the query set size.
+        '''
+        cache_key = (upper, size)
+        if cache_key not in self._param_cache:
+            false_positive_weight, false_negative_weight = self.weights
+            _, _, b, r = min(_containment_probabilities(self.threshold,
+                upper, size, self.h, self.rs),
+                key=lambda x : x[0] * false_positive_weight +
+                    x[1] * false_negative_weight)
+            self._param_cache[cache_key] = (int(b), r)
+        return self._param_cache[cache_key]
+
+    def __contains__(self, key):
+        '''
+        Args:
+            key (hashable): The unique identifier of a set.
+
+        Returns:
+            bool: True only if the key exists in the index.
+        '''
+        return key in self.keys
+
+    def is_empty(self):
+        '''
+        Returns:
+            bool: Check if the index is empty.
+        '''
+        return len(self.keys) == 0
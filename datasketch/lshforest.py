@@ -1,5 +1,10 @@
+import sys, bisect
 from collections import deque, defaultdict
-from datasketch.minhash import hashvalue_byte_size
+from multiprocessing.pool import ThreadPool
+import numpy as np
+from datasketch.minhash import hashvalue_byte_size, _max_hash
+from datasketch.lsh import _update_size_counts, _hot_buckets, \
+        _hashtable_bytesize, _keys_bytesize
 
 
 class MinHashLSHForest(object):
@@ -14,19 +19,44 @@ class MinHashLSHForest(object):
         The MinHash LSH Forest also works with weighted Jaccard similarity
         and weighted MinHash without modification.
 
+    Note:
+        Queries can run in any number of threads while one thread calls
+        :func:`datasketch.MinHashLSHForest.add`,
+        :func:`datasketch.MinHashLSHForest.remove` and
+        :func:`datasketch.MinHashLSHForest.index`, without locks.
+        The index builds new sorted arrays to the side and publishes them
+        in one assignment, so each query searches a consistent snapshot.
+
     Args:
         num_perm (int, optional): The number of permutation functions used
             by the MinHash to be indexed. For weighted MinHash, this
             is the number of samples (`num_sample`).
         l (int, optional): The number of prefix trees as described in the
             paper.
+        store_signatures (bool, optional): Whether to keep a compact copy of
+            the indexed hash values of every key, so the query results can
+            be ranked by estimated Jaccard similarity. MinHash values are
+            stored as 32-bit integers.
+        num_threads (int, optional): The number of threads used by
+            :func:`datasketch.MinHashLSHForest.query_batch` to search the
+            prefix trees in parallel. With more than one thread, every
+            prefix tree is searched for the whole batch in a thread pool,
+            which pays off for large indexes with many trees, and the
+            results are merged in the same order as the sequential search.
+            :func:`datasketch.MinHashLSHForest.query` always searches
+            sequentially, stopping as soon as k keys are found. Use
+            :func:`datasketch.MinHashLSHForest.close` to shut down the
+            thread pool.
     '''
 
-    def __init__(self, num_perm=128, l=8):
+    def __init__(self, num_perm=128, l=8, store_signatures=False,
+            num_threads=1):
         if l <= 0 or num_perm <= 0:
             raise ValueError("num_perm and l must be positive")
         if l > num_perm:
             raise ValueError("l cannot be greater than num_perm")
+        if num_threads < 1:
+            raise ValueError("num_threads must be positive")
         # Number of prefix trees
         self.l = l
         # Maximum depth of the prefix tree
@@ -34,8 +64,86 @@ class MinHashLSHForest(object):
         self.hashtables = [defaultdict(list) for _ in range(self.l)]
         self.hashranges = [(i*self.k, (i+1)*self.k) for i in range(self.l)]
         self.keys = dict()
-        # This is the sorted array implementation for the prefix trees
-        self.sorted_hashtables = [[] for _ in range(self.l)]
+        # The number of buckets of each size across all prefix trees
+        self._bucket_size_counts = defaultdict(int)
+        # This is the sorted array implementation for the prefix trees,
+        # using fixed-width byte strings so prefixes are searched in NumPy
+        self._snapshot = _Snapshot([np.array([], dtype='S%d' %
+            (self.k * hashvalue_byte_size)) for _ in range(self.l)], self.l)
+        # The band keys of removed buckets still in the sorted arrays or
+        # the delta runs, cleaned up by index
+        self._tombstones = [set() for _ in range(self.l)]
+        self.store_signatures = store_signatures
+        # The signatures in rows of a growing array and the row of each key,
+        # replaced together when the array is reallocated
+        self._signatures = (None, dict())
+        self._num_rows = 0
+        self.num_threads = num_threads
+        self._init_pool()
+
+    def _init_pool(self):
+        self._pool = ThreadPool(self.num_threads) if self.num_threads > 1 \
+                else None
+
+    def close(self):
+        '''
+        Shut down the thread pool used by
+        :func:`datasketch.MinHashLSHForest.query_batch` when `num_threads`
+        is greater than one. Later batch queries search the prefix trees
+        sequentially. It must not be called while batch queries are
+        running.
+        '''
+        pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    def __del__(self):
+        pool = getattr(self, '_pool', None)
+        if pool is not None:
+            pool.close()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # Thread pools cannot be pickled, it is re-created when unpickling
+        del state['_pool']
+        return state
+
+    def __setstate__(self, state):
+        # Forests pickled by older versions lack the attributes added since
+        if '_snapshot' not in state:
+            # The sorted band keys were kept as lists or arrays, which may
+            # lag behind the hash tables, so build the arrays again
+            state.pop('sorted_hashtables', None)
+            state.pop('_delta', None)
+            width = state['k'] * hashvalue_byte_size
+            for Hs in state['keys'].values():
+                width = len(Hs[0])
+                break
+            state['_snapshot'] = _Snapshot([np.array(sorted(hashtable),
+                dtype='S%d' % width) for hashtable in state['hashtables']],
+                state['l'])
+            state['_tombstones'] = [set() for _ in range(state['l'])]
+        if '_bucket_size_counts' not in state:
+            counts = defaultdict(int)
+            for hashtable in state['hashtables']:
+                for bucket in hashtable.values():
+                    counts[len(bucket)] += 1
+            state['_bucket_size_counts'] = counts
+        for name, value in (('store_signatures', False),
+                ('_signatures', (None, dict())), ('_num_rows', 0),
+                ('num_threads', 1)):
+            state.setdefault(name, value)
+        self.__dict__.update(state)
+        self._init_pool()
+
+    @property
+    def sorted_hashtables(self):
+        '''
+        The sorted arrays of band keys of the prefix trees, as of the last
+        call of :func:`datasketch.MinHashLSHForest.index`.
+        '''
+        return self._snapshot.sorted_hashtables
 
     def add(self, key, minhash):
         '''
@@ -43,7 +151,8 @@ class MinHashLSHForest(object):
         with a MinHash (or weighted MinHash) of the set referenced by the key.
 
         Note:
-            The key won't be searchbale until the 
+            The key is searchable right away from a small sorted delta run,
+            which is merged into the main sorted arrays when the
             :func:`datasketch.MinHashLSHForest.index` method is called.
 
         Args:
@@ -54,84 +163,399 @@ class MinHashLSHForest(object):
             raise ValueError("The num_perm of MinHash out of range")
         if key in self.keys:
             raise ValueError("The given key has already been added")
+        if self.store_signatures:
+            self._store_signature(key, minhash.hashvalues[:self.k*self.l])
         self.keys[key] = [self._H(minhash.hashvalues[start:end]) 
                 for start, end in self.hashranges]
-        for H, hashtable in zip(self.keys[key], self.hashtables):
-            hashtable[H].append(key)
+        for H, hashtable, delta, tombstones in zip(self.keys[key],
+                self.hashtables, self._snapshot.delta, self._tombstones):
+            bucket = hashtable[H]
+            bucket.append(key)
+            if len(bucket) == 1:
+                if H in tombstones:
+                    # The band key is still in the sorted array or delta run
+                    tombstones.remove(H)
+                else:
+                    delta.append(H)
+            _update_size_counts(self._bucket_size_counts,
+                    len(bucket) - 1, len(bucket))
+
+    def _store_signature(self, key, hashvalues):
+        signatures, rows = self._signatures
+        if signatures is None:
+            # MinHash values never exceed 32 bits
+            dtype = np.uint32 if hashvalues.dtype == np.uint64 \
+                    else hashvalues.dtype
+            signatures = np.empty((16,) + hashvalues.shape, dtype=dtype)
+            self._signatures = (signatures, rows)
+        if signatures.dtype == np.uint32 and np.any(hashvalues > _max_hash):
+            raise ValueError("Hash values must not exceed 32 bits when \
+                    storing signatures")
+        row = self._num_rows
+        if row == len(signatures):
+            # The array may have been compacted to no rows by index
+            signatures = np.concatenate([signatures, np.empty(
+                (max(16, len(signatures)),) + signatures.shape[1:],
+                dtype=signatures.dtype)])
+            rows = dict(rows)
+            self._signatures = (signatures, rows)
+        signatures[row] = hashvalues
+        rows[key] = row
+        self._num_rows += 1
+
+    def remove(self, key):
+        '''
+        Remove the key from the index. The key is no longer returned by
+        queries right away, while the band keys of the emptied buckets are
+        left in the sorted arrays as tombstones until the next call of
+        :func:`datasketch.MinHashLSHForest.index`.
+
+        Args:
+            key (hashable): The unique identifier of a set.
+        '''
+        if key not in self.keys:
+            raise ValueError("The given key does not exist")
+        for H, hashtable, tombstones in zip(self.keys.pop(key),
+                self.hashtables, self._tombstones):
+            bucket = hashtable[H]
+            bucket.remove(key)
+            _update_size_counts(self._bucket_size_counts,
+                    len(bucket) + 1, len(bucket))
+            if len(bucket) == 0:
+                del hashtable[H]
+                tombstones.add(H)
+        self._signatures[1].pop(key, None)
 
     def index(self):
         '''
-        Index all the keys added so far and make them searchable.
-        '''
-        for i, hashtable in enumerate(self.hashtables):
-            self.sorted_hashtables[i] = [H for H in hashtable.keys()]
-            self.sorted_hashtables[i].sort()
-
-    def _query(self, minhash, r, b):
-        if r > self.k or r <=0 or b > self.l or b <= 0:
-            raise ValueError("parameter outside range")
-        # Generate prefixes of concatenated hash values
-        hps = [self._H(minhash.hashvalues[start:start+r]) 
-                for start, _ in self.hashranges]
-        # Caculate the string length of each original hash value
-        prefix_size = hashvalue_byte_size * r
-        for ht, hp, hashtable in zip(self.sorted_hashtables, hps, self.hashtables):
-            i = self._binary_search(len(ht), lambda x : ht[x][:prefix_size] >= hp)
-            if i < len(ht) and ht[i][:prefix_size] == hp:
-                j = i
-                while j < len(ht) and ht[j][:prefix_size] == hp:
-                    for key in hashtable[ht[j]]:
-                        yield key
-                    j += 1
-
-    def query(self, minhash, k):
+        Merge the keys added since the last call into the sorted arrays,
+        and clean up the tombstones of the removed keys.
+        Only the new and removed band keys are located by binary search,
+        and the arrays are copied around them in one pass, so the cost is
+        proportional to the number of keys changed instead of sorting
+        every array again.
+        The new arrays are published together in one assignment, so
+        queries running meanwhile keep using the previous ones.
+        '''
+        snapshot = self._snapshot
+        sorted_hashtables = []
+        for ht, delta, tombstones in zip(snapshot.sorted_hashtables,
+                snapshot.delta, self._tombstones):
+            if len(tombstones) > 0:
+                dead = np.array(list(tombstones), dtype=ht.dtype)
+                positions = np.searchsorted(ht, dead)
+                found = positions < len(ht)
+                found[found] = ht[positions[found]] == dead[found]
+                ht = np.delete(ht, positions[found])
+            delta = sorted(H for H in delta if H not in tombstones)
+            if len(delta) > 0:
+                if len(ht) == 0:
+                    ht = np.array(delta, dtype='S%d' % len(delta[0]))
+                else:
+                    delta = np.array(delta, dtype=ht.dtype)
+                    ht = np.insert(ht, np.searchsorted(ht, delta), delta)
+            sorted_hashtables.append(ht)
+        signatures, rows = self._signatures
+        if self._num_rows > len(rows):
+            # Compact the signatures of the remaining keys
+            keys = list(rows)
+            self._signatures = (signatures[[rows[key] for key in keys]],
+                    dict((key, row) for row, key in enumerate(keys)))
+            self._num_rows = len(keys)
+        self._snapshot = _Snapshot(sorted_hashtables, self.l)
+        for tombstones in self._tombstones:
+            tombstones.clear()
+
+    def query(self, minhash, k, ranked=False, overfetch=2):
         '''
         Return the approximate top-k keys that have the highest 
         Jaccard similarities to the query set.
+        The prefix is shortened one hash value at a time, and the matched
+        range of every prefix tree is widened in place, so each band key
+        is visited only once.
 
         Args:
             minhash (datasketch.MinHash): The MinHash of the query set.
             k (int): The maximum number of keys to return.
+            ranked (bool, optional): Whether to rank the keys by their
+                estimated Jaccard similarities, which requires
+                `store_signatures`. The similarities of `overfetch` times
+                `k` candidates are computed in one pass and the top-k are
+                returned.
+            overfetch (int, optional): The over-fetch factor of the
+                candidates when `ranked` is True.
 
         Returns:
-            `list` of at most k keys.
+            `list` of at most k keys, or `list` of at most k
+            `(key, jaccard)` tuples sorted by Jaccard similarity in
+            descending order when `ranked` is True.
         '''
         if k <= 0:
             raise ValueError("k must be positive")
         if len(minhash) < self.k*self.l:
             raise ValueError("The num_perm of MinHash out of range")
+        if not ranked:
+            return self._candidates(minhash, k)
+        if not self.store_signatures:
+            raise ValueError("Ranked query requires store_signatures")
+        if overfetch < 1:
+            raise ValueError("overfetch must be at least 1")
+        signatures, rows = self._signatures
+        candidates = [(key, rows.get(key)) for key in
+                self._candidates(minhash, k * overfetch)]
+        # Skip the keys removed meanwhile
+        candidates = [(key, row) for key, row in candidates if row is not None]
+        if len(candidates) == 0:
+            return []
+        signatures = signatures[[row for _, row in candidates]]
+        equal = signatures == minhash.hashvalues[:self.k*self.l]
+        jaccards = np.mean(equal.reshape(len(candidates), self.k*self.l, -1)
+                .all(axis=2), axis=1)
+        top = np.argsort(-jaccards, kind='mergesort')[:k]
+        return [(candidates[i][0], float(jaccards[i])) for i in top]
+
+    def query_batch(self, minhashes, k):
+        '''
+        Return the approximate top-k keys for each of a batch of query
+        sets, the same as calling :func:`datasketch.MinHashLSHForest.query`
+        on each of them.
+        The prefixes of all queries are computed as arrays, and every prefix
+        tree is searched with the sorted prefixes of the whole batch at
+        once, instead of one binary search per query.
+
+        Args:
+            minhashes (list): The MinHash of the query sets.
+            k (int): The maximum number of keys to return for each query.
+
+        Returns:
+            `list` of `list` of at most k keys, one for each query.
+        '''
+        if k <= 0:
+            raise ValueError("k must be positive")
+        if any(len(minhash) < self.k*self.l for minhash in minhashes):
+            raise ValueError("The num_perm of MinHash out of range")
+        if len(minhashes) == 0:
+            return []
+        return self._batch_candidates(minhashes, k)
+
+    def _batch_candidates(self, minhashes, k):
+        snapshot = self._snapshot
+        hashvalues = np.array([minhash.hashvalues[:self.k*self.l]
+            for minhash in minhashes])
+        runs = list(zip(snapshot.sorted_hashtables,
+            snapshot.get_sorted_delta()))
+        tasks = [(ht, delta, hashvalues[:, start:end])
+                for (start, end), (ht, delta) in zip(self.hashranges, runs)]
+        pool = self._pool
+        if pool is not None:
+            bounds = pool.map(self._tree_bounds, tasks)
+        else:
+            bounds = [self._tree_bounds(task) for task in tasks]
+        bounds = np.array(bounds)
+        # The number of band keys newly in range for every query, prefix
+        # length from k down to 1 and prefix tree, so each query only visits
+        # the non-empty ones
+        i, j, d, e = bounds[:, 0], bounds[:, 1], bounds[:, 2], bounds[:, 3]
+        added = (i[:, 2:] - i[:, 1:-1]) + (j[:, 1:-1] - j[:, 2:]) + \
+                (d[:, 2:] - d[:, 1:-1]) + (e[:, 1:-1] - e[:, 2:])
+        added = added.transpose(2, 1, 0)[:, ::-1, :]
+        return [self._first_k(self._batch_band_keys(runs, bounds[..., q],
+            added[q]), k) for q in range(len(minhashes))]
+
+    def _tree_bounds(self, task):
+        '''
+        Search a prefix tree for every prefix length of a batch of queries.
+
+        Returns:
+            numpy.array: The matched ranges of the sorted array and the delta
+            run of every query, for prefix length r in row r, and the
+            initial empty ranges at the full band keys in row k + 1.
+        '''
+        ht, delta, hashvalues = task
+        n = len(hashvalues)
+        # The bytes of the band keys of all queries, one row each
+        band = np.ascontiguousarray(hashvalues).byteswap()
+        band = band.reshape(n, -1).view(np.uint8)
+        dtype = 'S%d' % band.shape[1]
+        delta = np.array(delta, dtype=dtype)
+        bound = np.empty((4, self.k + 2, n), dtype=np.int64)
+        for r in range(1, self.k + 1):
+            lower = band.copy()
+            lower[:, hashvalue_byte_size*r:] = 0
+            upper = band.copy()
+            upper[:, hashvalue_byte_size*r:] = 0xff
+            lower = lower.view(dtype).ravel()
+            upper = upper.view(dtype).ravel()
+            bound[0, r] = _searchsorted(ht, lower, 'left')
+            bound[1, r] = _searchsorted(ht, upper, 'right')
+            bound[2, r] = _searchsorted(delta, lower, 'left')
+            bound[3, r] = _searchsorted(delta, upper, 'right')
+        bound[0, self.k + 1] = bound[1, self.k + 1] = bound[0, self.k]
+        bound[2, self.k + 1] = bound[3, self.k + 1] = bound[2, self.k]
+        return bound
+
+    def _batch_band_keys(self, runs, bounds, added):
+        '''
+        Yield the tree and band key newly in range for a query of a batch,
+        in the same order as :func:`_band_keys`.
+        '''
+        for r, t in zip(*np.nonzero(added)):
+            r = self.k - r
+            ht, delta = runs[t]
+            (i, i2), (j, j2), (d, d2), (e, e2) = bounds[t, :, r:r+2].tolist()
+            width = ht.dtype.itemsize
+            for H in ht[i:i2].tolist() + ht[j2:j].tolist():
+                yield t, H.ljust(width, b'\x00')
+            for H in delta[d:d2] + delta[e2:e]:
+                yield t, H
+
+    def _candidates(self, minhash, k):
+        return self._first_k(self._band_keys(minhash), k)
+
+    def _first_k(self, band_keys, k):
+        '''
+        Collect the keys in the buckets of the band keys until k distinct
+        keys are found.
+        '''
         results = set()
-        r = self.k
-        while r > 0: 
-            for key in self._query(minhash, r, self.l):
+        for t, H in band_keys:
+            # Copy the bucket as it may be changed by another thread
+            for key in tuple(self.hashtables[t].get(H, ())):
                 results.add(key)
                 if len(results) >= k:
-                    break
-            r -= 1
+                    return list(results)
         return list(results)
 
-    def _binary_search(self, n, func):
+    def _band_keys(self, minhash):
         '''
-        https://golang.org/src/sort/search.go?s=2247:2287#L49
+        Yield the tree and band key newly in range as the prefix shortens,
+        for every prefix tree.
         '''
-        i, j = 0, n
-        while i < j:
-            h = int(i + (j - i) / 2)
-            if not func(h):
-                i = h + 1
-            else:
-                j = h
-        return i
+        snapshot = self._snapshot
+        deltas = snapshot.get_sorted_delta()
+        Hs = [self._H(minhash.hashvalues[start:end])
+                for start, end in self.hashranges]
+        # The matched ranges of the sorted arrays for all prefix lengths,
+        # searched at once in every prefix tree
+        ranges = [self._prefix_ranges(ht, H)
+                for ht, H in zip(snapshot.sorted_hashtables, Hs)]
+        # Start from empty ranges of the delta runs at the positions of the
+        # full band keys, which are inside the matched ranges of every prefix
+        bounds = []
+        for H, delta in zip(Hs, deltas):
+            d = bisect.bisect_left(delta, H)
+            bounds.append([d, d])
+        for p in range(1, self.k + 1):
+            prefix_size = hashvalue_byte_size * (self.k + 1 - p)
+            # The largest band key with each prefix
+            suffix = b'\xff' * (len(Hs[0]) - prefix_size)
+            for t, (H, ht, delta, (starts, ends), bound) in enumerate(zip(Hs,
+                    snapshot.sorted_hashtables, deltas, ranges, bounds)):
+                i, i2, j, j2 = starts[p-1], starts[p], ends[p-1], ends[p]
+                if i2 < i or j < j2:
+                    # NumPy strips the trailing null bytes of the band keys
+                    width = ht.dtype.itemsize
+                    for B in ht[i2:i].tolist() + ht[j:j2].tolist():
+                        yield t, B.ljust(width, b'\x00')
+                if delta:
+                    hp = H[:prefix_size]
+                    d, e = bound
+                    d2 = bisect.bisect_left(delta, hp, 0, d)
+                    e2 = bisect.bisect_right(delta, hp + suffix, e)
+                    bound[:] = [d2, e2]
+                    for B in delta[d2:d] + delta[e:e2]:
+                        yield t, B
+
+    def _prefix_ranges(self, ht, H):
+        '''
+        Find the matched ranges of the sorted array for the prefixes of the
+        band key `H` from k hash values down to one, with two searches.
+
+        Returns:
+            tuple: The lists of the starts and the ends of the ranges, in
+            which the first entries are the empty range at `H` and the entry
+            p is for the prefix of k + 1 - p hash values.
+        '''
+        width = len(H)
+        prefix_sizes = [hashvalue_byte_size * r for r in range(self.k, 0, -1)]
+        # NumPy pads the shorter lower bounds with null bytes
+        lower = np.array([H] + [H[:size] for size in prefix_sizes],
+                dtype=ht.dtype)
+        upper = np.array([H[:size] + b'\xff' * (width - size)
+                for size in prefix_sizes], dtype=ht.dtype)
+        starts = np.searchsorted(ht, lower, side='left').tolist()
+        ends = [starts[0]] + np.searchsorted(ht, upper, side='right').tolist()
+        return starts, ends
 
     def is_empty(self):
         '''
         Check whether there is any searchable keys in the index.
-        Note that keys won't be searchable until `index` is called.
 
         Returns:
             bool: True if there is no searchable key in the index.
         '''
-        return any(len(t) == 0 for t in self.sorted_hashtables)
+        return len(self.keys) == 0
+
+    def stats(self, num_hot_buckets=0):
+        '''
+        Get the statistics of the index for monitoring and capacity planning.
+        The bucket size distribution is maintained incrementally, and
+        the memory usage is approximated from a sample of the stored
+        objects, so this method is cheap unless `num_hot_buckets` is
+        given.
+
+        Args:
+            num_hot_buckets (int, optional): The number of largest buckets
+                to report. Finding them scans every bucket.
+
+        Returns:
+            dict: The statistics, containing:
+
+            * `num_keys`: the number of keys added.
+            * `num_buckets`: the number of buckets in each prefix tree.
+            * `num_indexed`: the number of buckets merged into the sorted
+              array of each prefix tree, which lags behind `num_buckets`
+              until :func:`datasketch.MinHashLSHForest.index` is called.
+            * `num_delta`: the number of buckets in the delta run of each
+              prefix tree waiting to be merged.
+            * `num_tombstones`: the number of removed buckets in each prefix
+              tree waiting to be cleaned up.
+            * `bucket_size_distribution`: a dict mapping bucket sizes to the
+              number of buckets of that size across all prefix trees.
+            * `max_bucket_size` and `mean_bucket_size`.
+            * `hot_buckets`: a list of `(tree, bucket_size)` of the largest
+              buckets, sorted by size in descending order.
+            * `bytesize`: a dict with the approximate number of bytes used
+              by `hashtables`, `keys`, `signatures` and `sorted_hashtables`.
+        '''
+        num_buckets = [len(hashtable) for hashtable in self.hashtables]
+        distribution = dict(self._bucket_size_counts)
+        snapshot = self._snapshot
+        signatures, _ = self._signatures
+        return {
+            "num_keys" : len(self.keys),
+            "num_buckets" : num_buckets,
+            "num_indexed" : [len(t) for t in snapshot.sorted_hashtables],
+            "num_delta" : [len(delta) for delta in snapshot.delta],
+            "num_tombstones" : [len(t) for t in self._tombstones],
+            "bucket_size_distribution" : distribution,
+            "max_bucket_size" : max(distribution) if distribution else 0,
+            "mean_bucket_size" : float(len(self.keys) * self.l) /
+                    max(sum(num_buckets), 1),
+            "hot_buckets" : _hot_buckets(self.hashtables, num_hot_buckets),
+            "bytesize" : {
+                "hashtables" : sum(_hashtable_bytesize(hashtable,
+                    len(self.keys)) for hashtable in self.hashtables),
+                "keys" : _keys_bytesize(self.keys),
+                "signatures" : signatures.nbytes
+                    if signatures is not None else 0,
+                # The band keys in the delta runs are shared with the
+                # hash tables, so only count the lists themselves.
+                "sorted_hashtables" : sum(t.nbytes
+                    for t in snapshot.sorted_hashtables) +
+                    sum(sys.getsizeof(delta) for delta in snapshot.delta),
+            },
+        }
 
     def _H(self, hs):
         return bytes(hs.byteswap().data)
@@ -142,3 +566,70 @@ class MinHashLSHForest(object):
             bool: True only if the key has been added to the index.
         '''
         return key in self.keys
+
+
+class _Snapshot(object):
+    '''
+    The sorted arrays of the prefix trees, together with the delta runs of
+    the band keys added after they were built. Only the delta runs grow,
+    by appending, until the snapshot is replaced as a whole.
+    '''
+
+    def __init__(self, sorted_hashtables, l):
+        self.sorted_hashtables = sorted_hashtables
+        self.delta = [[] for _ in range(l)]
+        # The sorted copies of the delta runs, replaced rather than changed
+        # in place as queries may be using them
+        self._sorted_delta = [[] for _ in range(l)]
+
+    def __getstate__(self):
+        # The sorted copies of the delta runs are sorted again when needed
+        return (self.sorted_hashtables, self.delta)
+
+    def __setstate__(self, state):
+        if isinstance(state, dict):
+            # Pickled with the sorted copies as attributes
+            state = (state['sorted_hashtables'], state['delta'])
+        self.sorted_hashtables, self.delta = state
+        self._sorted_delta = [[] for _ in self.delta]
+
+    def get_sorted_delta(self):
+        '''
+        Get the sorted copies of the delta runs. Only the band keys
+        appended since the last call are sorted into a copy of the previous
+        sorted copy, instead of sorting the whole delta runs again.
+        '''
+        sorted_delta = self._sorted_delta
+        if any(len(s) != len(delta) for s, delta in zip(sorted_delta,
+                self.delta)):
+            sorted_delta = [s if len(s) == len(delta) else
+                    _merge_sorted(s, delta[len(s):])
+                    for s, delta in zip(sorted_delta, self.delta)]
+            self._sorted_delta = sorted_delta
+        return sorted_delta
+
+
+def _merge_sorted(a, new):
+    '''
+    Get a sorted list of the sorted list and the new values. A few values
+    are inserted into a copy of the list by binary search, which only
+    moves pointers, otherwise the sorted list is one run for Timsort to
+    merge with the new values.
+    '''
+    if len(new) > 64:
+        return sorted(a + new)
+    merged = list(a)
+    for x in new:
+        bisect.insort(merged, x)
+    return merged
+
+
+def _searchsorted(a, v, side):
+    '''
+    Find the positions of the values in the sorted array, searching with
+    the values in sorted order for better locality.
+    '''
+    order = np.argsort(v, kind='mergesort')
+    positions = np.empty(len(v), dtype=np.int64)
+    positions[order] = np.searchsorted(a, v[order], side=side)
+    return positions
@@ -0,0 +1,279 @@
+'''
+This module implements an optional local HTTP server for querying a
+:class:`datasketch.MinHashLSH` (or any index with a `query` method)
+over the network.
+Concurrent requests are coalesced into batches within a small time window,
+and each batch is handed to a worker thread in one call, off the event loop.
+The index is still queried once per request in that call, except that
+identical signatures in a batch are looked up once, so batching saves the
+hops to the worker thread rather than the work of the index.
+
+It requires Python 3.5 or above, and is not imported by the `datasketch`
+package by default.
+
+The server understands two requests:
+
+* `POST /query` with a serialized :class:`datasketch.LeanMinHash` as the
+  body, see :func:`datasketch.LeanMinHash.serialize`. The response is a JSON
+  list of the keys returned by the index, so the keys must be JSON
+  serializable.
+* `GET /stats` returns the throughput and latency statistics as JSON.
+'''
+import asyncio, collections, json, struct, time
+import numpy as np
+from datasketch.lean_minhash import LeanMinHash
+
+
+class QueryServer(object):
+    '''
+    An asyncio HTTP front-end over an index with request micro-batching.
+
+    Example:
+        .. code-block:: python
+
+            server = QueryServer(lsh, port=8080)
+            loop = asyncio.get_event_loop()
+            loop.run_until_complete(server.start())
+            loop.run_forever()
+
+    Args:
+        index: The index to be queried, e.g., :class:`datasketch.MinHashLSH`.
+            The index is only queried from one thread at a time.
+        host (str, optional): The address to listen on.
+        port (int, optional): The port to listen on. Use 0 to pick any free
+            port, the actual port is available as `port` after
+            :func:`QueryServer.start`.
+        batch_window (float, optional): The time in seconds to wait for more
+            requests to join a batch after the first one arrives.
+        max_batch_size (int, optional): The maximum number of requests in a
+            batch.
+        latency_window (int, optional): The number of most recent requests
+            used for the latency statistics.
+        max_body_size (int, optional): The maximum size of a request body in
+            bytes. Larger requests are answered with `413 Payload Too Large`
+            without reading the body, and the connection is closed.
+    '''
+
+    def __init__(self, index, host='127.0.0.1', port=8080, batch_window=0.002,
+            max_batch_size=256, latency_window=10000, max_body_size=1 << 20):
+        if batch_window < 0:
+            raise ValueError("batch_window must be non-negative")
+        if max_batch_size < 1:
+            raise ValueError("max_batch_size must be positive")
+        if max_body_size < 0:
+            raise ValueError("max_body_size must be non-negative")
+        self.index = index
+        self.host = host
+        self.port = port
+        self.batch_window = batch_window
+        self.max_batch_size = max_batch_size
+        self.max_body_size = max_body_size
+        self._server = None
+        self._batcher_task = None
+        self._queue = None
+        self._start_time = None
+        self._num_requests = 0
+        self._num_batches = 0
+        self._num_lookups = 0
+        self._latencies = collections.deque(maxlen=latency_window)
+
+    async def start(self):
+        '''
+        Start listening for requests in the running event loop.
+        '''
+        loop = asyncio.get_event_loop()
+        self._queue = asyncio.Queue()
+        self._batcher_task = loop.create_task(self._batcher())
+        self._server = await asyncio.start_server(self._handle,
+                self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        self._start_time = time.time()
+
+    async def close(self):
+        '''
+        Stop listening and cancel the pending batches.
+        '''
+        self._server.close()
+        await self._server.wait_closed()
+        self._batcher_task.cancel()
+        try:
+            await self._batcher_task
+        except asyncio.CancelledError:
+            pass
+
+    async def query(self, minhash):
+        '''
+        Query the index through the batcher, as done for every
+        `POST /query` request.
+
+        Args:
+            minhash (datasketch.MinHash): The MinHash of the query set.
+
+        Returns:
+            `list` of keys returned by the index.
+        '''
+        start = time.time()
+        future = asyncio.get_event_loop().create_future()
+        await self._queue.put((minhash, future))
+        try:
+            return await future
+        finally:
+            self._num_requests += 1
+            self._latencies.append(time.time() - start)
+
+    def stats(self):
+        '''
+        Returns:
+            dict: The number of requests, batches and index lookups, the
+            average batch size, the throughput in requests per second since
+            the server started, and the latency percentiles in seconds of
+            the most recent requests.
+        '''
+        elapsed = time.time() - self._start_time if self._start_time else 0.0
+        latencies = np.array(self._latencies) if self._latencies \
+                else np.zeros(1)
+        return {
+            "requests" : self._num_requests,
+            "batches" : self._num_batches,
+            "lookups" : self._num_lookups,
+            "average_batch_size" : float(self._num_requests) /
+                    max(self._num_batches, 1),
+            "throughput" : self._num_requests / elapsed if elapsed > 0
+                    else 0.0,
+            "latency_p50" : float(np.percentile(latencies, 50)),
+            "latency_p99" : float(np.percentile(latencies, 99)),
+            "latency_max" : float(np.max(latencies)),
+        }
+
+    async def _batcher(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            batch = [await self._queue.get()]
+            if self.batch_window > 0 and \
+                    self._queue.qsize() < self.max_batch_size - 1:
+                await asyncio.sleep(self.batch_window)
+            while len(batch) < self.max_batch_size and \
+                    not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            try:
+                results = await loop.run_in_executor(None, self._lookup,
+                        [minhash for minhash, _ in batch])
+            except asyncio.CancelledError:
+                for _, future in batch:
+                    future.cancel()
+                raise
+            except Exception as e:
+                # Fail the requests of this batch only, and keep serving
+                results = [(None, e)] * len(batch)
+            self._num_batches += 1
+            for (_, future), (result, error) in zip(batch, results):
+                if future.done():
+                    continue
+                if error is not None:
+                    future.set_exception(error)
+                else:
+                    future.set_result(result)
+
+    def _lookup(self, minhashes):
+        '''
+        Query the index for a batch of MinHash, one query per distinct
+        signature, as the index has no batch query.
+        '''
+        cache = dict()
+        results = []
+        for minhash in minhashes:
+            signature = minhash.hashvalues.tobytes()
+            if signature not in cache:
+                try:
+                    cache[signature] = (self.index.query(minhash), None)
+                except Exception as e:
+                    cache[signature] = (None, e)
+                self._num_lookups += 1
+            results.append(cache[signature])
+        return results
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path = request_line.decode('latin-1').split()[:2]
+                headers = dict()
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                size = int(headers.get('content-length', 0))
+                if size > self.max_body_size:
+                    # The body is left unread, so the connection cannot be
+                    # used for more requests
+                    await self._respond(writer, "413 Payload Too Large",
+                            {"error" : "The request body must be at most "
+                                "%d bytes" % self.max_body_size})
+                    break
+                body = await reader.readexactly(size)
+                status, payload = await self._route(method, path, body)
+                await self._respond(writer, status, payload)
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def _respond(self, writer, status, payload):
+        try:
+            data = json.dumps(payload)
+        except (TypeError, ValueError) as e:
+            # The keys returned by the index are not JSON serializable
+            status = "500 Internal Server Error"
+            data = json.dumps({"error" : repr(e)})
+        data = data.encode('utf-8')
+        writer.write(("HTTP/1.1 %s\r\nContent-Type: application/json"
+            "\r\nContent-Length: %d\r\n\r\n" % (status, len(data))
+            ).encode('latin-1') + data)
+        await writer.drain()
+
+    async def _route(self, method, path, body):
+        if method == 'GET' and path == '/stats':
+            return "200 OK", self.stats()
+        if method == 'POST' and path == '/query':
+            try:
+                minhash = LeanMinHash.deserialize(body)
+            except (struct.error, ValueError):
+                return "400 Bad Request", {"error" : "Invalid LeanMinHash"}
+            try:
+                return "200 OK", await self.query(minhash)
+            except asyncio.CancelledError:
+                raise
+            except ValueError as e:
+                return "400 Bad Request", {"error" : str(e)}
+            except Exception as e:
+                return "500 Internal Server Error", {"error" : repr(e)}
+        return "404 Not Found", {"error" : "Unknown request"}
+
+
+def serve(index, host='127.0.0.1', port=8080, **kwargs):
+    '''
+    Run a :class:`QueryServer` over the index until interrupted.
+
+    Args:
+        index: The index to be queried.
+        host (str, optional): The address to listen on.
+        port (int, optional): The port to listen on.
+        **kwargs: Other arguments of :class:`QueryServer`.
+    '''
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    server = QueryServer(index, host=host, port=port, **kwargs)
+    loop.run_until_complete(server.start())
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        loop.run_until_complete(server.close())
+        loop.close()
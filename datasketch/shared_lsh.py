@@ -0,0 +1,233 @@
+'''
+This module implements a read-only MinHash LSH index stored in a flat
+buffer, which can be placed in shared memory or a memory-mapped file
+and queried from many processes without copying.
+'''
+import struct, pickle, mmap
+import numpy as np
+
+
+class SharedMinHashLSH(object):
+    '''
+    A read-only view of a built :class:`datasketch.MinHashLSH` stored in
+    a flat buffer made of NumPy arrays only.
+    Since the buffer contains no Python objects, forked query workers
+    attached to the same shared memory segment or memory-mapped file do
+    not touch its pages for reference counting, so the memory used by N
+    workers stays close to one copy of the index.
+
+    The buffer is created using :func:`SharedMinHashLSH.serialize`, which
+    writes into any writable buffer, such as a `bytearray`, a `mmap.mmap`
+    or the `buf` of a `multiprocessing.shared_memory.SharedMemory`.
+
+    Example:
+        To share an index through a file in `/dev/shm`:
+
+        .. code-block:: python
+
+            SharedMinHashLSH.dump(lsh, "/dev/shm/index")
+            # In every worker process
+            view = SharedMinHashLSH.load("/dev/shm/index")
+            result = view.query(minhash)
+
+    Args:
+        buf (buffer): The buffer holding the serialized index. It is
+            used without copying.
+    '''
+
+    # threshold as float64
+    # num_perm, b, r, band key size, number of buckets, number of
+    # postings, number of keys and the size of the key table as int64
+    _header_fmt = '<dqqqqqqqq'
+
+    def __init__(self, buf):
+        self._buf = buf
+        header_size = struct.calcsize(self._header_fmt)
+        self.threshold, self.h, self.b, self.r, key_size, num_buckets, \
+                num_postings, num_keys, key_table_size = \
+                struct.unpack(self._header_fmt, bytes(buf[:header_size]))
+        self.hashranges = [(i*self.r, (i+1)*self.r) for i in range(self.b)]
+        offset = header_size
+        self._band_offsets, offset = self._attach(buf, offset,
+                np.int64, self.b + 1)
+        self._bucket_keys, offset = self._attach(buf, offset,
+                np.dtype('S%d' % key_size), num_buckets)
+        self._bucket_offsets, offset = self._attach(buf, offset,
+                np.int64, num_buckets + 1)
+        self._postings, offset = self._attach(buf, offset,
+                np.int64, num_postings)
+        self._key_offsets, offset = self._attach(buf, offset,
+                np.int64, num_keys + 1)
+        self._key_table, offset = self._attach(buf, offset,
+                np.uint8, key_table_size)
+
+    @staticmethod
+    def _attach(buf, offset, dtype, count):
+        dtype = np.dtype(dtype)
+        a = np.frombuffer(buf, dtype=dtype, count=count, offset=offset)
+        return a, offset + _aligned(dtype.itemsize * count)
+
+    @classmethod
+    def _flatten(cls, lsh):
+        '''
+        Convert a MinHash LSH index into the header values and the list of
+        flat arrays in the order they are stored in the buffer.
+        '''
+        if lsh.probes:
+            raise ValueError("Cannot export MinHashLSH with multi-probe\
+                    querying")
+        key_ids = dict((key, i) for i, key in enumerate(lsh.keys))
+        key_size = lsh.r * 8
+        for Hs in lsh.keys.values():
+            key_size = len(Hs[0])
+            break
+        band_offsets = [0]
+        bucket_keys = []
+        bucket_offsets = [0]
+        postings = []
+        for hashtable in lsh.hashtables:
+            for H in sorted(hashtable.keys()):
+                bucket_keys.append(H)
+                postings.extend(key_ids[key] for key in hashtable[H])
+                bucket_offsets.append(len(postings))
+            band_offsets.append(len(bucket_keys))
+        key_offsets = [0]
+        key_table = []
+        for key in lsh.keys:
+            key_table.append(pickle.dumps(key, protocol=2))
+            key_offsets.append(key_offsets[-1] + len(key_table[-1]))
+        key_table = b''.join(key_table)
+        header = (lsh.threshold, lsh.h, lsh.b, lsh.r, key_size,
+                len(bucket_keys), len(postings), len(key_ids), len(key_table))
+        arrays = [np.array(band_offsets, dtype=np.int64),
+                np.array(bucket_keys, dtype='S%d' % key_size),
+                np.array(bucket_offsets, dtype=np.int64),
+                np.array(postings, dtype=np.int64),
+                np.array(key_offsets, dtype=np.int64),
+                np.frombuffer(key_table, dtype=np.uint8)]
+        return header, arrays
+
+    @classmethod
+    def bytesize(cls, lsh):
+        '''
+        Get the size of the buffer needed to hold the given index.
+
+        Args:
+            lsh (datasketch.MinHashLSH): The index to be exported.
+
+        Returns:
+            int: The size in number of bytes.
+        '''
+        _, arrays = cls._flatten(lsh)
+        return struct.calcsize(cls._header_fmt) + \
+                sum(_aligned(a.nbytes) for a in arrays)
+
+    @classmethod
+    def serialize(cls, lsh, buf):
+        '''
+        Export a built MinHash LSH index into a writable buffer.
+
+        Args:
+            lsh (datasketch.MinHashLSH): The index to be exported.
+            buf (buffer): The writable buffer, which must have at least
+                :func:`SharedMinHashLSH.bytesize` bytes.
+        '''
+        header, arrays = cls._flatten(lsh)
+        size = struct.calcsize(cls._header_fmt) + \
+                sum(_aligned(a.nbytes) for a in arrays)
+        if len(buf) < size:
+            raise ValueError("The buffer does not have enough space\
+                    for holding this MinHashLSH.")
+        struct.pack_into(cls._header_fmt, buf, 0, *header)
+        offset = struct.calcsize(cls._header_fmt)
+        for a in arrays:
+            out = np.frombuffer(buf, dtype=a.dtype, count=len(a),
+                    offset=offset)
+            out[:] = a
+            offset += _aligned(a.nbytes)
+
+    @classmethod
+    def dump(cls, lsh, path):
+        '''
+        Export a built MinHash LSH index into a file, which can be
+        attached using :func:`SharedMinHashLSH.load`.
+
+        Args:
+            lsh (datasketch.MinHashLSH): The index to be exported.
+            path (str): The path of the file, e.g., in `/dev/shm`.
+        '''
+        buf = bytearray(cls.bytesize(lsh))
+        cls.serialize(lsh, buf)
+        with open(path, 'wb') as f:
+            f.write(buf)
+
+    @classmethod
+    def load(cls, path):
+        '''
+        Attach a read-only view to a file created by
+        :func:`SharedMinHashLSH.dump` using a shared memory map.
+
+        Args:
+            path (str): The path of the file.
+
+        Returns:
+            datasketch.SharedMinHashLSH: The read-only index.
+        '''
+        with open(path, 'rb') as f:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls(buf)
+
+    def query(self, minhash):
+        '''
+        Giving the MinHash of the query set, retrieve
+        the keys that references sets with Jaccard
+        similarities greater than the threshold.
+
+        Args:
+            minhash (datasketch.MinHash): The MinHash of the query set.
+
+        Returns:
+            `list` of keys.
+        '''
+        if len(minhash) != self.h:
+            raise ValueError("Expecting minhash with length %d, got %d"
+                    % (self.h, len(minhash)))
+        candidates = set()
+        for i, (start, end) in enumerate(self.hashranges):
+            H = self._H(minhash.hashvalues[start:end])
+            lo, hi = self._band_offsets[i], self._band_offsets[i+1]
+            bucket_keys = self._bucket_keys[lo:hi]
+            j = np.searchsorted(bucket_keys, H, side='left')
+            if j == np.searchsorted(bucket_keys, H, side='right'):
+                continue
+            bucket = lo + j
+            candidates.update(self._postings[
+                self._bucket_offsets[bucket]:self._bucket_offsets[bucket+1]
+                ].tolist())
+        return [self._get_key(i) for i in candidates]
+
+    def _get_key(self, i):
+        start, end = self._key_offsets[i], self._key_offsets[i+1]
+        return pickle.loads(self._key_table[start:end].tobytes())
+
+    def __len__(self):
+        '''
+        Returns:
+            int: The number of keys in the index.
+        '''
+        return len(self._key_offsets) - 1
+
+    def is_empty(self):
+        '''
+        Returns:
+            bool: Check if the index is empty.
+        '''
+        return len(self) == 0
+
+    def _H(self, hs):
+        return bytes(hs.byteswap().data)
+
+
+def _aligned(size):
+    # Keep every array 8-byte aligned in the buffer
+    return (size + 7) & ~7
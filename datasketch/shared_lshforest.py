@@ -0,0 +1,236 @@
+'''
+This module implements a read-only MinHash LSH Forest stored in a flat
+buffer, which can be persisted to a file and loaded instantly using a
+memory map.
+'''
+import struct, pickle, mmap
+import numpy as np
+from datasketch.minhash import hashvalue_byte_size
+from datasketch.shared_lsh import _aligned
+
+
+class SharedMinHashLSHForest(object):
+    '''
+    A read-only view of a :class:`datasketch.MinHashLSHForest` stored in
+    a flat buffer made of NumPy arrays only.
+    Every prefix tree is one sorted array of band keys with one entry per
+    indexed key, together with a parallel array of key ids, and the keys
+    themselves are stored once in a key table. Unlike the forest, the band
+    keys are not kept again as dict keys, and loading a file only maps it
+    into memory.
+
+    The buffer is created using :func:`SharedMinHashLSHForest.serialize`,
+    which writes into any writable buffer, or
+    :func:`SharedMinHashLSHForest.dump`, which writes into a file.
+
+    Example:
+        .. code-block:: python
+
+            SharedMinHashLSHForest.dump(forest, "forest.bin")
+            # Later, or in another process
+            view = SharedMinHashLSHForest.load("forest.bin")
+            result = view.query(minhash, 10)
+
+    Args:
+        buf (buffer): The buffer holding the serialized forest. It is
+            used without copying.
+    '''
+
+    # l, k, band key size, number of keys and the size of the key table
+    # as int64
+    _header_fmt = '<qqqqq'
+
+    def __init__(self, buf):
+        self._buf = buf
+        header_size = struct.calcsize(self._header_fmt)
+        self.l, self.k, key_size, num_keys, key_table_size = \
+                struct.unpack(self._header_fmt, bytes(buf[:header_size]))
+        self.hashranges = [(i*self.k, (i+1)*self.k) for i in range(self.l)]
+        offset = header_size
+        self._band_keys = []
+        self._key_ids = []
+        for _ in range(self.l):
+            band_keys, offset = self._attach(buf, offset,
+                    np.dtype('S%d' % key_size), num_keys)
+            key_ids, offset = self._attach(buf, offset, np.int64, num_keys)
+            self._band_keys.append(band_keys)
+            self._key_ids.append(key_ids)
+        self._key_offsets, offset = self._attach(buf, offset,
+                np.int64, num_keys + 1)
+        self._key_table, offset = self._attach(buf, offset,
+                np.uint8, key_table_size)
+
+    @staticmethod
+    def _attach(buf, offset, dtype, count):
+        dtype = np.dtype(dtype)
+        a = np.frombuffer(buf, dtype=dtype, count=count, offset=offset)
+        return a, offset + _aligned(dtype.itemsize * count)
+
+    @classmethod
+    def _flatten(cls, forest):
+        '''
+        Convert a MinHash LSH Forest into the header values and the list of
+        flat arrays in the order they are stored in the buffer.
+        '''
+        key_ids = dict((key, i) for i, key in enumerate(forest.keys))
+        key_size = forest.k * hashvalue_byte_size
+        for Hs in forest.keys.values():
+            key_size = len(Hs[0])
+            break
+        arrays = []
+        for hashtable in forest.hashtables:
+            band_keys = []
+            ids = []
+            for H in sorted(hashtable.keys()):
+                for key in hashtable[H]:
+                    band_keys.append(H)
+                    ids.append(key_ids[key])
+            arrays.append(np.array(band_keys, dtype='S%d' % key_size))
+            arrays.append(np.array(ids, dtype=np.int64))
+        key_offsets = [0]
+        key_table = []
+        for key in forest.keys:
+            key_table.append(pickle.dumps(key, protocol=2))
+            key_offsets.append(key_offsets[-1] + len(key_table[-1]))
+        key_table = b''.join(key_table)
+        header = (forest.l, forest.k, key_size, len(key_ids), len(key_table))
+        arrays.append(np.array(key_offsets, dtype=np.int64))
+        arrays.append(np.frombuffer(key_table, dtype=np.uint8))
+        return header, arrays
+
+    @classmethod
+    def bytesize(cls, forest):
+        '''
+        Get the size of the buffer needed to hold the given forest.
+
+        Args:
+            forest (datasketch.MinHashLSHForest): The forest to be exported.
+
+        Returns:
+            int: The size in number of bytes.
+        '''
+        _, arrays = cls._flatten(forest)
+        return struct.calcsize(cls._header_fmt) + \
+                sum(_aligned(a.nbytes) for a in arrays)
+
+    @classmethod
+    def serialize(cls, forest, buf):
+        '''
+        Export a MinHash LSH Forest into a writable buffer. All keys added
+        to the forest are exported, whether
+        :func:`datasketch.MinHashLSHForest.index` has been called or not.
+
+        Args:
+            forest (datasketch.MinHashLSHForest): The forest to be exported.
+            buf (buffer): The writable buffer, which must have at least
+                :func:`SharedMinHashLSHForest.bytesize` bytes.
+        '''
+        header, arrays = cls._flatten(forest)
+        size = struct.calcsize(cls._header_fmt) + \
+                sum(_aligned(a.nbytes) for a in arrays)
+        if len(buf) < size:
+            raise ValueError("The buffer does not have enough space\
+                    for holding this MinHashLSHForest.")
+        struct.pack_into(cls._header_fmt, buf, 0, *header)
+        offset = struct.calcsize(cls._header_fmt)
+        for a in arrays:
+            out = np.frombuffer(buf, dtype=a.dtype, count=len(a),
+                    offset=offset)
+            out[:] = a
+            offset += _aligned(a.nbytes)
+
+    @classmethod
+    def dump(cls, forest, path):
+        '''
+        Export a MinHash LSH Forest into a file, which can be loaded using
+        :func:`SharedMinHashLSHForest.load`.
+
+        Args:
+            forest (datasketch.MinHashLSHForest): The forest to be exported.
+            path (str): The path of the file.
+        '''
+        buf = bytearray(cls.bytesize(forest))
+        cls.serialize(forest, buf)
+        with open(path, 'wb') as f:
+            f.write(buf)
+
+    @classmethod
+    def load(cls, path):
+        '''
+        Attach a read-only view to a file created by
+        :func:`SharedMinHashLSHForest.dump` using a shared memory map,
+        so only the pages touched by queries are read from the disk.
+
+        Args:
+            path (str): The path of the file.
+
+        Returns:
+            datasketch.SharedMinHashLSHForest: The read-only forest.
+        '''
+        with open(path, 'rb') as f:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls(buf)
+
+    def query(self, minhash, k):
+        '''
+        Return the approximate top-k keys that have the highest
+        Jaccard similarities to the query set, the same as
+        :func:`datasketch.MinHashLSHForest.query`.
+
+        Args:
+            minhash (datasketch.MinHash): The MinHash of the query set.
+            k (int): The maximum number of keys to return.
+
+        Returns:
+            `list` of at most k keys.
+        '''
+        if k <= 0:
+            raise ValueError("k must be positive")
+        if len(minhash) < self.k*self.l:
+            raise ValueError("The num_perm of MinHash out of range")
+        Hs = [self._H(minhash.hashvalues[start:end])
+                for start, end in self.hashranges]
+        # Start from empty ranges at the positions of the full band keys,
+        # and widen them as the prefix shortens
+        bounds = []
+        for H, band_keys in zip(Hs, self._band_keys):
+            i = np.searchsorted(band_keys, H, side='left')
+            bounds.append((i, i))
+        results = set()
+        for r in range(self.k, 0, -1):
+            prefix_size = hashvalue_byte_size * r
+            suffix = b'\xff' * (hashvalue_byte_size * (self.k - r))
+            for t, (H, band_keys, key_ids) in enumerate(zip(Hs,
+                    self._band_keys, self._key_ids)):
+                i, j = bounds[t]
+                hp = H[:prefix_size]
+                i2 = np.searchsorted(band_keys[:i], hp, side='left')
+                j2 = j + np.searchsorted(band_keys[j:], hp + suffix,
+                        side='right')
+                bounds[t] = (i2, j2)
+                for key_id in key_ids[i2:i].tolist() + key_ids[j:j2].tolist():
+                    results.add(key_id)
+                    if len(results) >= k:
+                        return [self._get_key(i) for i in results]
+        return [self._get_key(i) for i in results]
+
+    def _get_key(self, i):
+        start, end = self._key_offsets[i], self._key_offsets[i+1]
+        return pickle.loads(self._key_table[start:end].tobytes())
+
+    def __len__(self):
+        '''
+        Returns:
+            int: The number of keys in the forest.
+        '''
+        return len(self._key_offsets) - 1
+
+    def is_empty(self):
+        '''
+        Returns:
+            bool: Check if the forest is empty.
+        '''
+        return len(self) == 0
+
+    def _H(self, hs):
+        return bytes(hs.byteswap().data)
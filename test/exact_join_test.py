@@ -0,0 +1,61 @@
+import unittest
+import random
+from datasketch.exact_join import ExactSimilaritySearch, all_pairs
+
+
+def _jaccard(a, b):
+    return float(len(a & b)) / len(a | b)
+
+
+class TestExactJoin(unittest.TestCase):
+
+    def _sets(self):
+        random.seed(1)
+        population = [str(i) for i in range(60)]
+        sets = [set(random.sample(population, random.randint(1, 20)))
+                for _ in range(200)]
+        # Add near duplicates
+        sets.extend(set(list(s)[1:]) | set(["x"]) for s in sets[:50])
+        sets.append(set())
+        return sets
+
+    def test_all_pairs(self):
+        sets = self._sets()
+        for threshold in (0.3, 0.6, 0.9, 1.0):
+            expected = set((i, j) for i in range(len(sets))
+                    for j in range(i + 1, len(sets))
+                    if sets[i] and sets[j] and
+                    _jaccard(sets[i], sets[j]) >= threshold)
+            result = all_pairs(sets, threshold)
+            self.assertEqual(set((i, j) for i, j, _ in result), expected)
+            for i, j, jaccard in result:
+                self.assertAlmostEqual(jaccard, _jaccard(sets[i], sets[j]))
+        self.assertRaises(ValueError, all_pairs, sets, 0.0)
+
+    def test_query(self):
+        sets = self._sets()
+        keys = ["key%d" % i for i in range(len(sets))]
+        index = ExactSimilaritySearch(sets, 0.5, keys=keys)
+        queries = sets[:20] + [set(["y", "z"]), set(["1", "2", "y"]), set()]
+        for q in queries:
+            expected = set(key for key, x in zip(keys, sets)
+                    if q and x and _jaccard(q, x) >= 0.5)
+            self.assertEqual(set(key for key, _ in index.query(q)), expected)
+        self.assertRaises(ValueError, ExactSimilaritySearch, sets, 0.5,
+                keys[:10])
+
+    def test_verify(self):
+        sets = self._sets()
+        index = ExactSimilaritySearch(sets, 0.5)
+        q = sets[0]
+        result = dict(index.verify(q, range(len(sets))))
+        self.assertEqual(set(result), set(k for k, _ in index.query(q)))
+        self.assertAlmostEqual(result[0], 1.0)
+        keys = ["k%d" % i for i in range(len(sets))]
+        index = ExactSimilaritySearch(sets, 0.5, keys)
+        self.assertEqual(dict(index.verify(q, keys)),
+                dict(("k%d" % i, j) for i, j in result.items()))
+
+
+if __name__ == "__main__":
+    unittest.main()
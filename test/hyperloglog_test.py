@@ -55,6 +55,24 @@ class TestHyperLogLog(unittest.TestCase):
         h.update(0x000000f5)
         self.assertEqual(h.reg[5], self._class._hash_range_bit - 4 - 3)
 
+    def test_update_batch(self):
+        h1 = self._class(4, hashobj=FakeHash)
+        h2 = self._class(4, hashobj=FakeHash)
+        values = [0b00011111, 0xfffffff1, 0x000000f5, 0xfffffff5]
+        for v in values:
+            h1.update(v)
+        h2.update_batch(values)
+        self.assertTrue(np.array_equal(h1.reg, h2.reg))
+        h1 = self._class(8)
+        h2 = self._class(8)
+        data = [("item-%d" % i).encode("utf8") for i in range(5000)]
+        for v in data:
+            h1.update(v)
+        h2.update_batch(data)
+        self.assertTrue(np.array_equal(h1.reg, h2.reg))
+        h2.update_batch([])
+        self.assertTrue(np.array_equal(h1.reg, h2.reg))
+
     def test_merge(self):
         h1 = self._class(4, hashobj=FakeHash)
         h2 = self._class(4, hashobj=FakeHash)
@@ -93,6 +111,29 @@ class TestHyperLogLog(unittest.TestCase):
         self.assertEqual(hd.m, h.m)
         self.assertTrue(all(i == j for i, j in zip(h.reg, hd.reg)))
 
+    def test_serialize_packed(self):
+        h = self._class(8)
+        h.update_batch([("item-%d" % i).encode("utf8") for i in range(5000)])
+        # Force a register into the overflow table of the 4-bit encoding
+        h.reg[3] = 28
+        for bits, size in ((8, h.m + 1), (6, h.m * 6 // 8 + 1)):
+            self.assertEqual(h.bytesize(bits), size)
+            buf = bytearray(h.bytesize(bits))
+            h.serialize(buf, bits)
+            self.assertEqual(self._class.deserialize(buf), h)
+        buf = bytearray(h.bytesize(4))
+        self.assertLess(len(buf), h.m // 2 + 20)
+        h.serialize(buf, 4)
+        self.assertEqual(self._class.deserialize(buf), h)
+        self.assertRaises(ValueError, h.bytesize, 5)
+        # Registers out of range are rejected rather than truncated
+        h.reg[3] = 64
+        buf = bytearray(h.bytesize(6))
+        self.assertRaises(ValueError, h.serialize, buf, 6)
+        h.reg[3] = -1
+        buf = bytearray(h.bytesize(4))
+        self.assertRaises(ValueError, h.serialize, buf, 4)
+
     def test_pickle(self):
         h = self._class(4, hashobj=FakeHash)
         h.update(123)
@@ -103,6 +144,16 @@ class TestHyperLogLog(unittest.TestCase):
         self.assertEqual(p.m, h.m)
         self.assertEqual(p.p, h.p)
         self.assertTrue(np.array_equal(p.reg, h.reg))
+        # Pickled in the 8-bit encoding, readable by older releases
+        state = h.__getstate__()
+        self.assertEqual(len(state), h.m + 1)
+        self.assertEqual(state[0], h.p)
+        # States in the 6-bit encoding can still be loaded
+        buf = bytearray(h.bytesize(6))
+        h.serialize(buf, 6)
+        p = self._class.__new__(self._class)
+        p.__setstate__(buf)
+        self.assertTrue(np.array_equal(p.reg, h.reg))
 
     def test_union(self):
         h1 = self._class(4, hashobj=FakeHash)
@@ -184,5 +235,108 @@ class TestHyperLogLogPlusPlus(TestHyperLogLog):
         self.assertEqual(h.reg[5], self._class._hash_range_bit - 4 - 3)
 
 
+class TestHyperLogLogPlusPlusSparse(unittest.TestCase):
+
+    def _data(self, n, prefix="item"):
+        return [("%s-%d" % (prefix, i)).encode("utf8") for i in range(n)]
+
+    def test_init(self):
+        h = HyperLogLogPlusPlus(8, sparse=True)
+        self.assertTrue(h.is_sparse())
+        self.assertTrue(h.is_empty())
+        self.assertEqual(h.count(), 0.0)
+        self.assertRaises(ValueError, HyperLogLogPlusPlus, 8, sparse=True,
+                sparse_p=8)
+        self.assertRaises(ValueError, HyperLogLogPlusPlus, 8, sparse=True,
+                sparse_p=27)
+
+    def test_update(self):
+        for n in (1, 10, 50, 1000):
+            d = HyperLogLogPlusPlus(8)
+            h1 = HyperLogLogPlusPlus(8, sparse=True)
+            h2 = HyperLogLogPlusPlus(8, sparse=True)
+            for v in self._data(n):
+                d.update(v)
+                h1.update(v)
+            h2.update_batch(self._data(n))
+            self.assertTrue(np.array_equal(h1.digest(), d.reg))
+            self.assertTrue(np.array_equal(h2.digest(), d.reg))
+            self.assertEqual(h1, d)
+            # Converted to dense past a quarter of the registers
+            self.assertEqual(h1.is_sparse(), n <= 64)
+            self.assertEqual(h2.is_sparse(), n <= 64)
+        h = HyperLogLogPlusPlus(8, sparse=True)
+        h.update_batch(self._data(50))
+        self.assertAlmostEqual(h.count(), 50, delta=1)
+        h.clear()
+        self.assertTrue(h.is_sparse())
+        self.assertTrue(h.is_empty())
+
+    def test_update_buffer(self):
+        d = HyperLogLogPlusPlus(14)
+        h = HyperLogLogPlusPlus(14, sparse=True)
+        for v in self._data(1000):
+            d.update(v)
+            h.update(v)
+            # New values are buffered in a small fixed-size array
+            self.assertLessEqual(len(h._tmp), 64)
+        self.assertTrue(h.is_sparse())
+        self.assertGreater(h._num_tmp, 0)
+        self.assertEqual(h, d)
+        c = h.copy()
+        h.update(b"another")
+        self.assertEqual(c, d)
+        self.assertFalse(c.is_empty())
+
+    def test_merge(self):
+        h1 = HyperLogLogPlusPlus(8, sparse=True)
+        h2 = HyperLogLogPlusPlus(8, sparse=True)
+        d = HyperLogLogPlusPlus(8)
+        h1.update_batch(self._data(20, "a"))
+        h2.update_batch(self._data(20, "b"))
+        d.update_batch(self._data(20, "a") + self._data(20, "b"))
+        h = HyperLogLogPlusPlus.union(h1, h2)
+        self.assertTrue(h.is_sparse())
+        self.assertEqual(h, d)
+        h1.merge(d)
+        self.assertFalse(h1.is_sparse())
+        self.assertEqual(h1, d)
+        d2 = HyperLogLogPlusPlus(8)
+        d2.merge(h2)
+        self.assertTrue(np.array_equal(d2.reg, h2.digest()))
+
+    def test_merge_buffered(self):
+        # The other sketch has more than m/4 pairs once its buffer is
+        # flushed, which converts it to dense during the merge
+        h1 = HyperLogLogPlusPlus(8, sparse=True)
+        h2 = HyperLogLogPlusPlus(8, sparse=True)
+        d = HyperLogLogPlusPlus(8)
+        h1.update_batch(self._data(1, "a"))
+        for v in self._data(100, "b"):
+            h2.update(v)
+        d.update_batch(self._data(1, "a") + self._data(100, "b"))
+        self.assertIsNone(h2.reg)
+        self.assertGreater(len(h2._sparse) + h2._num_tmp, h2.m // 4)
+        h = HyperLogLogPlusPlus.union(h1, h2)
+        self.assertEqual(h, d)
+        h1.merge(h2)
+        self.assertFalse(h1.is_sparse())
+        self.assertEqual(h1, d)
+
+    def test_serialize(self):
+        h = HyperLogLogPlusPlus(8, sparse=True)
+        h.update_batch(self._data(20))
+        buf = bytearray(h.bytesize())
+        h.serialize(buf)
+        self.assertLess(len(buf), h.m)
+        hd = HyperLogLogPlusPlus.deserialize(buf)
+        self.assertTrue(hd.is_sparse())
+        self.assertEqual(hd, h)
+        self.assertEqual(hd.count(), h.count())
+        p = pickle.loads(pickle.dumps(h))
+        self.assertTrue(p.is_sparse())
+        self.assertEqual(p, h)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -1,8 +1,9 @@
 import unittest
 from hashlib import sha1
 import pickle
+import threading
 import numpy as np
-from datasketch.lsh import MinHashLSH, WeightedMinHashLSH
+from datasketch.lsh import MinHashLSH, WeightedMinHashLSH, tune_param
 from datasketch.minhash import MinHash
 from datasketch.weighted_minhash import WeightedMinHashGenerator
 
@@ -89,6 +90,378 @@ class TestMinHashLSH(unittest.TestCase):
         result = lsh.query(m2)
         self.assertTrue("b" in result)
 
+    def test_pickle_old_state(self):
+        lsh = MinHashLSH(threshold=0.5, num_perm=16)
+        m1 = MinHash(16)
+        m1.update("a".encode("utf8"))
+        m2 = MinHash(16)
+        m2.update("b".encode("utf8"))
+        lsh.insert("a", m1)
+        lsh.insert("b", m2)
+        # The attributes pickled by older versions
+        state = dict((name, getattr(lsh, name)) for name in ("threshold",
+            "h", "b", "r", "hashtables", "hashranges", "keys"))
+        lsh2 = MinHashLSH.__new__(MinHashLSH)
+        lsh2.__setstate__(pickle.loads(pickle.dumps(state)))
+        self.assertEqual(lsh2.query(m1), ["a"])
+        self.assertEqual(lsh2.stats()["bucket_size_distribution"],
+                lsh.stats()["bucket_size_distribution"])
+        m3 = MinHash(16)
+        m3.update("c".encode("utf8"))
+        lsh2.insert("c", m3)
+        lsh2.remove("a")
+        self.assertEqual(lsh2.query(m3), ["c"])
+        lsh3 = pickle.loads(pickle.dumps(lsh2))
+        self.assertEqual(lsh3.query(m2), ["b"])
+
+    def test_stats(self):
+        # The bucket size distribution is counted on demand by default,
+        # and maintained incrementally with the optional features
+        for concurrent in (False, True):
+            lsh = MinHashLSH(threshold=0.5, num_perm=16,
+                    concurrent=concurrent)
+            stats = lsh.stats()
+            self.assertEqual(stats["num_keys"], 0)
+            self.assertEqual(stats["max_bucket_size"], 0)
+            m1 = MinHash(16)
+            m1.update("a".encode("utf8"))
+            m2 = MinHash(16)
+            m2.update("b".encode("utf8"))
+            lsh.insert("a", m1)
+            lsh.insert("b", m2)
+            lsh.insert("c", m1)
+            stats = lsh.stats(num_hot_buckets=2)
+            self.assertEqual(stats["num_keys"], 3)
+            self.assertEqual(stats["num_buckets"],
+                    [len(t) for t in lsh.hashtables])
+            self.assertEqual(stats["bucket_size_distribution"],
+                    {2 : lsh.b, 1 : lsh.b})
+            self.assertEqual(stats["max_bucket_size"], 2)
+            self.assertEqual(stats["hot_buckets"][0][1], 2)
+            self.assertEqual(len(stats["hot_buckets"]), 2)
+            self.assertTrue(stats["bytesize"]["hashtables"] > 0)
+            self.assertTrue(stats["bytesize"]["keys"] > 0)
+            lsh.remove("a")
+            lsh.remove("b")
+            self.assertEqual(lsh.stats()["bucket_size_distribution"],
+                    {1 : lsh.b})
+
+    def test_bucket_cap(self):
+        m1 = MinHash(16)
+        m1.update("a".encode("utf8"))
+        m2 = MinHash(16)
+        m2.update("b".encode("utf8"))
+        for overflow, expected in [("sample", 4), ("stop", 0)]:
+            lsh = MinHashLSH(threshold=0.5, num_perm=16, bucket_cap=4,
+                    overflow=overflow)
+            for i in range(10):
+                lsh.insert(i, m1)
+            lsh.insert("b", m2)
+            result = lsh.query(m1)
+            self.assertTrue(len(result) <= expected)
+            result, overflowed = lsh.query(m1, return_overflow=True)
+            self.assertEqual(overflowed, list(range(lsh.b)))
+            result, overflowed = lsh.query(m2, return_overflow=True)
+            self.assertEqual((result, overflowed), (["b"], []))
+            self.assertEqual(lsh.stats()["num_overflowed_buckets"], lsh.b)
+        lsh = MinHashLSH(threshold=0.5, num_perm=16, bucket_cap=4)
+        for i in range(10):
+            lsh.insert(i, m1)
+        self.assertEqual(len(lsh.query(m1)), 4)
+        self.assertRaises(ValueError, MinHashLSH, 0.5, 16, bucket_cap=0)
+        self.assertRaises(ValueError, MinHashLSH, 0.5, 16, overflow="x")
+
+    def test_self_join(self):
+        lsh = MinHashLSH(threshold=0.5, num_perm=16)
+        minhashes = {}
+        for key, values in [("a", "xyz"), ("b", "xyz"), ("c", "xyz"),
+                            ("d", "pq"), ("e", "pq"), ("f", "k")]:
+            m = MinHash(16)
+            for v in values:
+                m.update(v.encode("utf8"))
+            lsh.insert(key, m)
+            minhashes[key] = m
+        pairs = list(lsh.self_join())
+        self.assertEqual(len(pairs), len(set(pairs)))
+        self.assertEqual(set(tuple(sorted(p)) for p in pairs),
+                set([("a", "b"), ("a", "c"), ("b", "c"), ("d", "e")]))
+        pairs = list(lsh.self_join(minhashes))
+        self.assertEqual(len(pairs), 4)
+        clusters = sorted(sorted(c) for c in lsh.clusters())
+        self.assertEqual(clusters, [["a", "b", "c"], ["d", "e"], ["f"]])
+        clusters = sorted(sorted(c) for c in lsh.clusters(minhashes))
+        self.assertEqual(clusters, [["a", "b", "c"], ["d", "e"], ["f"]])
+
+    def test_ttl(self):
+        lsh = MinHashLSH(threshold=0.5, num_perm=16, ttl=10)
+        minhashes = []
+        for i in range(4):
+            m = MinHash(16)
+            m.update(str(i).encode("utf8"))
+            minhashes.append(m)
+        lsh.insert(0, minhashes[0], timestamp=100)
+        lsh.insert(1, minhashes[1], timestamp=105)
+        lsh.insert(2, minhashes[0], timestamp=109)
+        self.assertEqual(len(lsh.keys), 3)
+        # The slice of key 0 ends at 101, so it expires at 111
+        lsh.insert(3, minhashes[3], timestamp=111)
+        self.assertTrue(0 not in lsh)
+        self.assertEqual(lsh.query(minhashes[0]), [2])
+        lsh.remove(1)
+        lsh.expire(now=200)
+        self.assertEqual(len(lsh.keys), 0)
+        for table in lsh.hashtables:
+            self.assertEqual(len(table), 0)
+        self.assertEqual(lsh.stats()["bucket_size_distribution"], {})
+        self.assertRaises(ValueError, MinHashLSH(0.5, 16).expire)
+
+    def test_max_size(self):
+        lsh = MinHashLSH(threshold=0.5, num_perm=16, max_size=20)
+        m = MinHash(16)
+        m.update("a".encode("utf8"))
+        for i in range(100):
+            lsh.insert(i, m)
+            self.assertTrue(len(lsh.keys) <= 20)
+        # Keys are evicted in slices of 2 keys, oldest first
+        self.assertEqual(sorted(lsh.query(m)), list(range(80, 100)))
+        lsh.remove(99)
+        lsh.insert(99, m)
+        self.assertTrue(99 in lsh)
+
+    def test_cache(self):
+        lsh = MinHashLSH(threshold=0.5, num_perm=16, cache_size=2)
+        m1 = MinHash(16)
+        m1.update("a".encode("utf8"))
+        m2 = MinHash(16)
+        m2.update("b".encode("utf8"))
+        m3 = MinHash(16)
+        m3.update("c".encode("utf8"))
+        lsh.insert("a", m1)
+        self.assertEqual(lsh.query(m1), ["a"])
+        self.assertEqual(lsh.query(m1), ["a"])
+        self.assertEqual(lsh.cache_info(), (1, 1, 2, 1))
+        # Inserting into the buckets of a cached query invalidates it
+        lsh.insert("a2", m1)
+        self.assertEqual(sorted(lsh.query(m1)), ["a", "a2"])
+        self.assertEqual(lsh.cache_info(), (1, 2, 2, 1))
+        # Inserting elsewhere does not
+        lsh.insert("b", m2)
+        self.assertEqual(sorted(lsh.query(m1)), ["a", "a2"])
+        self.assertEqual(lsh.cache_info()[0], 2)
+        lsh.remove("a2")
+        self.assertEqual(lsh.query(m1), ["a"])
+        # Least recently used results are evicted
+        lsh.query(m2)
+        lsh.query(m3)
+        self.assertEqual(lsh.cache_info()[3], 2)
+        self.assertEqual(len(lsh._cache_deps), 2 * lsh.b)
+        stats = lsh.stats()
+        self.assertEqual(stats["cache_hits"], lsh.cache_hits)
+        lsh2 = pickle.loads(pickle.dumps(lsh))
+        self.assertEqual(lsh2.cache_info(), (0, 0, 2, 0))
+
+    def test_probes(self):
+        lsh = MinHashLSH(threshold=0.5, num_perm=32)
+        lsh_probe = MinHashLSH(threshold=0.5, num_perm=32, probes=1,
+                cache_size=10)
+        self.assertTrue(lsh_probe.b < lsh.b)
+        r = lsh_probe.r
+        hv = np.arange(1, 33)
+        m1 = MinHash(32, hashvalues=hv)
+        # Differs in the last, probed, hash value of every band
+        hv2 = hv.copy()
+        hv2[r-1::r] += 100
+        m2 = MinHash(32, hashvalues=hv2)
+        # Differs in the first hash value of every band
+        hv3 = hv.copy()
+        hv3[0::r] += 100
+        m3 = MinHash(32, hashvalues=hv3)
+        lsh_probe.insert("a", m1)
+        self.assertEqual(lsh_probe.query(m1), ["a"])
+        lsh_probe.insert("b", m2)
+        lsh_probe.insert("c", m3)
+        self.assertEqual(sorted(lsh_probe.query(m1)), ["a", "b"])
+        self.assertEqual(sorted(lsh_probe.query(m2)), ["a", "b"])
+        self.assertEqual(sorted(lsh_probe.query(m3)), ["c"])
+        self.assertEqual(sorted(map(sorted, lsh_probe.clusters())),
+                [["a", "b"], ["c"]])
+        lsh_probe.remove("b")
+        self.assertEqual(lsh_probe.query(m1), ["a"])
+        self.assertRaises(ValueError, MinHashLSH, 0.5, 16, probes=16)
+
+    def test_probes_bytesize(self):
+        lsh = MinHashLSH(threshold=0.5, num_perm=128)
+        lsh_probe = MinHashLSH(threshold=0.5, num_perm=128, probes=1)
+        hashvalues = np.random.RandomState(1).randint(0, 2**32,
+                size=(500, 128))
+        for i, hv in enumerate(hashvalues):
+            m = MinHash(128, hashvalues=hv)
+            lsh.insert(i, m)
+            lsh_probe.insert(i, m)
+        self.assertTrue(sum(lsh_probe.stats()["bytesize"].values()) <
+                sum(lsh.stats()["bytesize"].values()))
+
+    def test_params(self):
+        lsh = MinHashLSH(threshold=0.5, num_perm=16, params=(4, 3))
+        self.assertEqual((lsh.b, lsh.r), (4, 3))
+        self.assertEqual(len(lsh.hashtables), 4)
+        self.assertRaises(ValueError, MinHashLSH, 0.5, 16, params=(4, 5))
+
+    def test_tune_param(self):
+        minhashes = []
+        for i in range(20):
+            # Pairs of near-duplicates
+            for j in range(2):
+                m = MinHash(32)
+                for k in range(20):
+                    m.update(("%d-%d" % (i, k)).encode("utf8"))
+                m.update(("%d-%d-extra" % (i, j)).encode("utf8"))
+                minhashes.append(m)
+        result = tune_param(minhashes, 0.8, recall=0.9, num_keys=1000)
+        self.assertTrue(result["recall"] >= 0.9)
+        self.assertTrue(result["b"] * result["r"] <= 32)
+        self.assertTrue(result["candidates"] >= 0.0)
+        self.assertTrue(result["bytesize"] > 0)
+        lsh = MinHashLSH(0.8, 32, params=(result["b"], result["r"]))
+        for i, m in enumerate(minhashes):
+            lsh.insert(i, m)
+        found = sum(1 for i in range(0, 40, 2)
+                    if i + 1 in lsh.query(minhashes[i]))
+        self.assertTrue(found >= 15)
+        self.assertRaises(ValueError, tune_param, minhashes[:1], 0.8)
+
+    def test_query_limit(self):
+        lsh = MinHashLSH(threshold=0.5, num_perm=16, cache_size=10)
+        m1 = MinHash(16)
+        m1.update("a".encode("utf8"))
+        m2 = MinHash(16)
+        m2.update("b".encode("utf8"))
+        for i in range(10):
+            lsh.insert(i, m1)
+        self.assertEqual(len(lsh.query(m1, limit=3)), 3)
+        # Partial results are not cached
+        self.assertEqual(lsh.cache_info()[3], 0)
+        self.assertEqual(len(lsh.query(m1, limit=20)), 10)
+        self.assertEqual(len(lsh.query(m1, limit=3)), 3)
+        self.assertRaises(ValueError, lsh.query, m1, limit=0)
+        self.assertTrue(lsh.any_match(m1))
+        self.assertFalse(lsh.any_match(m2))
+        it = lsh.query_iter(m1)
+        self.assertTrue(next(it) in range(10))
+        self.assertEqual(sorted(lsh.query_iter(m1)), list(range(10)))
+        self.assertEqual(list(lsh.query_iter(m2)), [])
+        self.assertRaises(ValueError, lambda : list(lsh.query_iter(MinHash(18))))
+
+    def test_merge(self):
+        lsh1 = MinHashLSH(threshold=0.5, num_perm=16)
+        lsh2 = MinHashLSH(threshold=0.5, num_perm=16)
+        m1 = MinHash(16)
+        m1.update("a".encode("utf8"))
+        m2 = MinHash(16)
+        m2.update("b".encode("utf8"))
+        m3 = MinHash(16)
+        m3.update("c".encode("utf8"))
+        lsh1.insert("a", m1)
+        lsh2.insert("b", m2)
+        lsh2.insert("c", m3)
+        lsh = MinHashLSH.from_partials(lsh1, lsh2)
+        self.assertTrue("a" in lsh)
+        self.assertTrue("b" in lsh)
+        # The partial indexes are left unchanged
+        self.assertTrue("b" not in lsh1)
+        self.assertTrue("a" not in lsh2)
+        self.assertEqual(lsh2.query(m1), [])
+        self.assertTrue("a" in lsh.query(m1))
+        self.assertTrue("b" in lsh.query(m2))
+        for i, H in enumerate(lsh.keys["a"]):
+            self.assertTrue("a" in lsh.hashtables[i][H])
+        self.assertEqual(sum(lsh.stats()["bucket_size_distribution"].values()),
+                sum(len(t) for t in lsh.hashtables))
+
+        lsh3 = MinHashLSH(threshold=0.5, num_perm=16)
+        lsh3.insert("c", m3)
+        lsh1.merge(lsh3)
+        self.assertTrue("c" in lsh1.query(m3))
+        self.assertRaises(ValueError, lsh1.merge, lsh3)
+        lsh4 = MinHashLSH(threshold=0.8, num_perm=16)
+        self.assertRaises(ValueError, lsh1.merge, lsh4)
+
+    def test_build_parallel(self):
+        entries = []
+        for i in range(20):
+            m = MinHash(16)
+            m.update(str(i).encode("utf8"))
+            entries.append((i, m))
+        # The constructor options are forwarded
+        for kwargs in ({}, {"probes" : 1, "cache_size" : 10},
+                {"bucket_cap" : 2, "concurrent" : True}):
+            lsh = MinHashLSH.build_parallel(entries, processes=2,
+                    threshold=0.5, num_perm=16, **kwargs)
+            expected = MinHashLSH(threshold=0.5, num_perm=16, **kwargs)
+            for key, m in entries:
+                expected.insert(key, m)
+            for key, m in entries:
+                self.assertTrue(key in lsh)
+                self.assertEqual(sorted(lsh.query(m)),
+                        sorted(expected.query(m)))
+                self.assertEqual(lsh.keys[key], expected.keys[key])
+            self.assertEqual(lsh.hashtables, expected.hashtables)
+            self.assertEqual(lsh._probed, expected._probed)
+            self.assertEqual(lsh.stats()["bucket_size_distribution"],
+                    expected.stats()["bucket_size_distribution"])
+            self.assertEqual(lsh.cache_size, expected.cache_size)
+            self.assertEqual(lsh.bucket_cap, expected.bucket_cap)
+        self.assertRaises(ValueError, MinHashLSH.build_parallel,
+                entries + [(0, entries[0][1])], processes=2,
+                threshold=0.5, num_perm=16)
+        self.assertRaises(ValueError, MinHashLSH.build_parallel, entries,
+                processes=2, threshold=0.5, num_perm=16, ttl=10)
+
+    def test_concurrent(self):
+        lsh = MinHashLSH(threshold=0.5, num_perm=16, concurrent=True)
+        minhashes = []
+        for i in range(50):
+            m = MinHash(16)
+            m.update(str(i).encode("utf8"))
+            minhashes.append(m)
+        for i in range(25):
+            lsh.insert(i, minhashes[i])
+        errors = []
+        done = threading.Event()
+
+        def reader():
+            try:
+                while not done.is_set():
+                    for i in range(25):
+                        if i not in lsh.query(minhashes[i]):
+                            errors.append(i)
+            except Exception as e:
+                errors.append(e)
+
+        def writer():
+            try:
+                for _ in range(20):
+                    for i in range(25, 50):
+                        lsh.insert(i, minhashes[i])
+                    for i in range(25, 50):
+                        lsh.remove(i)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                done.set()
+
+        threads = [threading.Thread(target=reader) for _ in range(4)]
+        threads.append(threading.Thread(target=writer))
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(lsh.keys), 25)
+        lsh2 = pickle.loads(pickle.dumps(lsh))
+        self.assertTrue(lsh2.concurrent)
+        self.assertTrue(0 in lsh2.query(minhashes[0]))
+
 
 class TestWeightedMinHashLSH(unittest.TestCase):
 
@@ -140,6 +513,20 @@ class TestWeightedMinHashLSH(unittest.TestCase):
         m3 = mg.minhash(np.random.uniform(1, 10, 10))
         self.assertRaises(ValueError, lsh.query, m3)
 
+    def test_build_parallel(self):
+        mg = WeightedMinHashGenerator(10, 4)
+        entries = [(i, mg.minhash(np.random.uniform(1, 10, 10)))
+                   for i in range(10)]
+        lsh = WeightedMinHashLSH.build_parallel(entries, processes=2,
+                threshold=0.5, sample_size=4)
+        expected = WeightedMinHashLSH(threshold=0.5, sample_size=4)
+        for key, m in entries:
+            expected.insert(key, m)
+        self.assertEqual(lsh.hashtables, expected.hashtables)
+        self.assertEqual(lsh.keys, expected.keys)
+        for key, m in entries:
+            self.assertTrue(key in lsh.query(m))
+
     def test_remove(self):
         lsh = WeightedMinHashLSH(threshold=0.5, sample_size=4)
         mg = WeightedMinHashGenerator(10, 4)
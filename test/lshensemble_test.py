@@ -0,0 +1,55 @@
+import unittest
+import numpy as np
+from datasketch.lshensemble import MinHashLSHEnsemble
+from datasketch.minhash import MinHash
+
+
+class TestMinHashLSHEnsemble(unittest.TestCase):
+
+    def _data(self, count):
+        sizes = np.random.RandomState(1).randint(10, 500, size=count)
+        for i, size in enumerate(sizes):
+            m = MinHash(128)
+            for j in range(size):
+                m.update(("%d-%d" % (i, j)).encode("utf8"))
+            yield ("key", i), m, int(size)
+
+    def test_init(self):
+        self.assertRaises(ValueError, MinHashLSHEnsemble, threshold=1.5)
+        self.assertRaises(ValueError, MinHashLSHEnsemble, num_part=0)
+        self.assertRaises(ValueError, MinHashLSHEnsemble, m=0)
+        lsh = MinHashLSHEnsemble(threshold=0.8)
+        self.assertTrue(lsh.is_empty())
+
+    def test_index(self):
+        lsh = MinHashLSHEnsemble(threshold=0.8, num_part=4)
+        data = list(self._data(40))
+        lsh.index(data)
+        self.assertEqual(len(lsh.indexes), 4)
+        self.assertEqual(lsh.uppers, sorted(lsh.uppers))
+        for key, _, _ in data:
+            self.assertTrue(key in lsh)
+        self.assertRaises(ValueError, lsh.index, data)
+        lsh = MinHashLSHEnsemble(threshold=0.8)
+        self.assertRaises(ValueError, lsh.index, data + data[:1])
+        self.assertRaises(ValueError, lsh.index,
+                [(data[0][0], MinHash(16), 10)])
+
+    def test_query(self):
+        lsh = MinHashLSHEnsemble(threshold=0.8, num_part=4)
+        data = list(self._data(40))
+        lsh.index(data)
+        for key, minhash, size in data:
+            self.assertTrue(key in lsh.query(minhash, size))
+        # A query set that is a subset of a large set
+        key, _, size = max(data, key=lambda e : e[2])
+        q = MinHash(128)
+        for j in range(size // 2):
+            q.update(("%d-%d" % (key[1], j)).encode("utf8"))
+        self.assertTrue(key in lsh.query(q, size // 2))
+        self.assertRaises(ValueError, lsh.query, MinHash(16), 10)
+        self.assertRaises(ValueError, lsh.query, q, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
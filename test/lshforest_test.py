@@ -1,4 +1,5 @@
 import unittest
+import threading
 from hashlib import sha1
 import pickle
 import numpy as np
@@ -33,7 +34,7 @@ class TestMinHashLSHForest(unittest.TestCase):
         m2.update("b".encode("utf8"))
         forest.add("a", m1)
         forest.add("b", m2)
-        self.assertTrue(forest.is_empty())
+        self.assertFalse(forest.is_empty())
         for t in forest.hashtables:
             self.assertTrue(len(t) >= 1)
             items = []
@@ -64,6 +65,236 @@ class TestMinHashLSHForest(unittest.TestCase):
         m3 = MinHash(18)
         self.assertRaises(ValueError, forest.query, m3, 1)
 
+    def test_query_k(self):
+        forest = self._setup()
+        m1 = MinHash()
+        for s in ["a", "b", "c"]:
+            m1.update(s.encode("utf8"))
+        for k in (1, 2, 3):
+            result = forest.query(m1, k)
+            self.assertEqual(len(result), k)
+            self.assertEqual(len(set(result)), k)
+        self.assertTrue("a" in forest.query(m1, 1))
+        result = forest.query(m1, 1000)
+        self.assertEqual(len(result), len(set(result)))
+        self.assertTrue(set(["a", "b", "c"]).issubset(result))
+
+    def test_query_ranked(self):
+        forest = MinHashLSHForest(store_signatures=True)
+        d = "abcdefghijklmnopqrstuvwxyz"
+        minhashes = dict()
+        for i in range(len(d)-5):
+            m = MinHash()
+            for s in d[i:i+6]:
+                m.update(s.encode("utf8"))
+            forest.add(d[i], m)
+            minhashes[d[i]] = m
+        forest.index()
+        q = minhashes["a"]
+        result = forest.query(q, 3, ranked=True)
+        self.assertEqual(len(result), 3)
+        self.assertEqual(result[0], ("a", 1.0))
+        jaccards = [j for _, j in result]
+        self.assertEqual(jaccards, sorted(jaccards, reverse=True))
+        for key, j in result:
+            self.assertAlmostEqual(j, q.jaccard(minhashes[key]))
+        self.assertRaises(ValueError, forest.query, q, 3, ranked=True,
+                overfetch=0)
+        self.assertRaises(ValueError, self._setup().query, q, 3,
+                ranked=True)
+
+    def test_incremental_index(self):
+        forest = self._setup()
+        m = MinHash()
+        for s in ["1", "2", "3"]:
+            m.update(s.encode("utf8"))
+        forest.add("new", m)
+        # The new key is searchable before index is called
+        self.assertTrue("new" in forest.query(m, 1))
+        self.assertEqual(forest.stats()["num_delta"], [1] * forest.l)
+        forest.index()
+        self.assertEqual(forest.stats()["num_delta"], [0] * forest.l)
+        for t, hashtable in zip(forest.sorted_hashtables, forest.hashtables):
+            self.assertTrue(np.array_equal(t,
+                np.array(sorted(hashtable.keys()), dtype=t.dtype)))
+        self.assertTrue("new" in forest.query(m, 1))
+
+    def test_sorted_delta(self):
+        # Adds interleaved with queries only sort the new band keys into
+        # the sorted copies of the delta runs
+        forest = self._setup()
+        for i in range(100):
+            m = MinHash()
+            m.update(str(i).encode("utf8"))
+            forest.add(i, m)
+            if i % 30 == 0:
+                self.assertTrue(i in forest.query(m, 1))
+        forest.add(100, m)
+        snapshot = forest._snapshot
+        for s, delta in zip(snapshot.get_sorted_delta(), snapshot.delta):
+            self.assertEqual(s, sorted(delta))
+        forest2 = pickle.loads(pickle.dumps(forest))
+        self.assertEqual(forest2._snapshot.get_sorted_delta(),
+                snapshot.get_sorted_delta())
+
+    def test_remove(self):
+        forest = MinHashLSHForest(store_signatures=True)
+        m1 = MinHash()
+        m1.update("a".encode("utf8"))
+        m2 = MinHash()
+        m2.update("b".encode("utf8"))
+        forest.add("a", m1)
+        forest.add("b", m2)
+        forest.index()
+        forest.remove("a")
+        self.assertFalse("a" in forest)
+        self.assertFalse("a" in forest.query(m1, 2))
+        self.assertTrue(all(len(t) == 1 for t in forest._tombstones))
+        self.assertRaises(ValueError, forest.remove, "a")
+        forest.index()
+        self.assertTrue(all(len(t) == 0 for t in forest._tombstones))
+        self.assertTrue(all(len(t) == 1 for t in forest.sorted_hashtables))
+        self.assertEqual(forest.query(m2, 1, ranked=True), [("b", 1.0)])
+        # Adding back a removed key reuses its band keys
+        forest.remove("b")
+        forest.add("b", m2)
+        self.assertTrue(all(len(t) == 0 for t in forest._tombstones))
+        self.assertEqual(forest.stats()["num_delta"], [0] * forest.l)
+        self.assertEqual(forest.query(m2, 1), ["b"])
+        forest.remove("b")
+        self.assertTrue(forest.is_empty())
+        # The signatures grow again after being compacted to no rows
+        forest.index()
+        forest.add("a", m1)
+        self.assertEqual(forest.query(m1, 1, ranked=True), [("a", 1.0)])
+
+    def test_query_batch(self):
+        forest = self._setup()
+        d = "abcdefghijklmnopqrstuvwxyz"
+        minhashes = []
+        for i in range(len(d)-2):
+            m = MinHash()
+            for s in d[i:i+3]:
+                m.update(s.encode("utf8"))
+            minhashes.append(m)
+        for k in (1, 3, 10):
+            results = forest.query_batch(minhashes, k)
+            self.assertEqual(len(results), len(minhashes))
+            for result, m in zip(results, minhashes):
+                self.assertEqual(sorted(result), sorted(forest.query(m, k)))
+        self.assertEqual(forest.query_batch([], 1), [])
+        self.assertRaises(ValueError, forest.query_batch, [MinHash(18)], 1)
+
+    def test_query_prefixes(self):
+        # Keys sharing prefixes of every length, with hash values ending in
+        # null bytes, in both the sorted arrays and the delta runs
+        np.random.seed(1)
+        base = np.random.randint(1, 2**32, 128).astype(np.uint64)
+        base[::3] &= 0xffffff00
+        forest = MinHashLSHForest()
+        minhashes = []
+        for i in range(60):
+            m = MinHash()
+            m.hashvalues = base.copy()
+            m.hashvalues[np.random.randint(0, 128, i % 20)] = i
+            minhashes.append(m)
+            forest.add(i, m)
+            if i == 30:
+                forest.index()
+        for k in (1, 5, 20):
+            results = forest.query_batch(minhashes, k)
+            for result, m in zip(results, minhashes):
+                self.assertEqual(sorted(forest.query(m, k)), sorted(result))
+
+    def test_num_threads(self):
+        self.assertRaises(ValueError, MinHashLSHForest, num_threads=0)
+        forest = self._setup()
+        parallel = MinHashLSHForest(num_threads=4)
+        d = "abcdefghijklmnopqrstuvwxyz"
+        minhashes = []
+        for i in range(len(d)-2):
+            m = MinHash()
+            for s in d[i:i+3]:
+                m.update(s.encode("utf8"))
+            parallel.add(d[i], m)
+            minhashes.append(m)
+        parallel.index()
+        for m in minhashes:
+            self.assertEqual(sorted(parallel.query(m, 3)),
+                    sorted(forest.query(m, 3)))
+        self.assertEqual([sorted(r) for r in parallel.query_batch(minhashes, 2)],
+                [sorted(r) for r in forest.query_batch(minhashes, 2)])
+        parallel2 = pickle.loads(pickle.dumps(parallel))
+        self.assertEqual(sorted(parallel2.query(minhashes[0], 3)),
+                sorted(parallel.query(minhashes[0], 3)))
+        parallel2.close()
+        self.assertEqual([sorted(r) for r in parallel2.query_batch(minhashes, 2)],
+                [sorted(r) for r in forest.query_batch(minhashes, 2)])
+        parallel.close()
+
+    def test_concurrent(self):
+        forest = MinHashLSHForest(num_perm=16, l=4)
+        minhashes = []
+        for i in range(60):
+            m = MinHash(16)
+            m.update(str(i).encode("utf8"))
+            minhashes.append(m)
+        for i in range(20):
+            forest.add(i, minhashes[i])
+        forest.index()
+        errors = []
+        done = threading.Event()
+
+        def reader():
+            try:
+                while not done.is_set():
+                    for i in range(20):
+                        if i not in forest.query(minhashes[i], 1):
+                            errors.append(i)
+                    forest.query_batch(minhashes, 2)
+            except Exception as e:
+                errors.append(e)
+
+        def writer():
+            try:
+                for _ in range(20):
+                    for i in range(20, 60):
+                        forest.add(i, minhashes[i])
+                    forest.index()
+                    for i in range(20, 60):
+                        forest.remove(i)
+                    forest.index()
+            except Exception as e:
+                errors.append(e)
+            finally:
+                done.set()
+
+        threads = [threading.Thread(target=reader) for _ in range(4)]
+        threads.append(threading.Thread(target=writer))
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(forest.stats()["num_indexed"], [20] * forest.l)
+
+    def test_stats(self):
+        forest = MinHashLSHForest()
+        m1 = MinHash()
+        m1.update("a".encode("utf8"))
+        forest.add("a", m1)
+        forest.add("b", m1)
+        stats = forest.stats(num_hot_buckets=1)
+        self.assertEqual(stats["num_keys"], 2)
+        self.assertEqual(stats["num_buckets"], [1] * forest.l)
+        self.assertEqual(stats["num_indexed"], [0] * forest.l)
+        self.assertEqual(stats["bucket_size_distribution"], {2 : forest.l})
+        self.assertEqual(stats["hot_buckets"], [(forest.l - 1, 2)])
+        forest.index()
+        stats = forest.stats()
+        self.assertEqual(stats["num_indexed"], [1] * forest.l)
+        self.assertTrue(stats["bytesize"]["sorted_hashtables"] > 0)
+
     def test_pickle(self):
         forest = MinHashLSHForest()
         m1 = MinHash()
@@ -79,5 +310,30 @@ class TestMinHashLSHForest(unittest.TestCase):
         result = forest.query(m2, 1)
         self.assertTrue("b" in result)
 
+    def test_pickle_old_state(self):
+        forest = self._setup()
+        m = MinHash()
+        for s in ["1", "2", "3"]:
+            m.update(s.encode("utf8"))
+        forest.add("new", m)
+        # The attributes pickled by older versions, with the band keys
+        # sorted in lists that miss the key added after index
+        state = dict((name, getattr(forest, name)) for name in ("l", "k",
+            "hashtables", "hashranges", "keys"))
+        state["sorted_hashtables"] = [sorted(H for H in hashtable
+            if "new" not in hashtable[H]) for hashtable in forest.hashtables]
+        forest2 = MinHashLSHForest.__new__(MinHashLSHForest)
+        forest2.__setstate__(pickle.loads(pickle.dumps(state)))
+        self.assertEqual(forest2.query(m, 1), ["new"])
+        self.assertEqual(sorted(forest2.query(m, 1000)),
+                sorted(forest.query(m, 1000)))
+        self.assertEqual(forest2.stats()["bucket_size_distribution"],
+                forest.stats()["bucket_size_distribution"])
+        forest2.remove("a")
+        forest2.index()
+        self.assertFalse("a" in forest2)
+        forest3 = pickle.loads(pickle.dumps(forest2))
+        self.assertEqual(forest3.query(m, 1), ["new"])
+
 if __name__ == "__main__":
     unittest.main()
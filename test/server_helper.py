@@ -0,0 +1,41 @@
+'''
+Coroutines used by server_test.py, kept in their own module as they are
+only valid syntax on Python 3.5 and above.
+'''
+import asyncio, json
+
+
+async def request(port, method, path, body=b''):
+    '''
+    Send one HTTP request and return the status code and the JSON payload.
+    '''
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(("%s %s HTTP/1.1\r\nContent-Length: %d\r\n"
+        "Connection: close\r\n\r\n" % (method, path, len(body))
+        ).encode('latin-1') + body)
+    status = (await reader.readline()).split()[1]
+    data = await reader.read()
+    writer.close()
+    return int(status), json.loads(data.split(b'\r\n\r\n', 1)[1])
+
+
+async def run_requests(server, rounds, timeout=10):
+    '''
+    Start the server and send rounds of `(method, path, body)` requests,
+    the requests of a round concurrently and the rounds one after another.
+    A round taking longer than `timeout` seconds fails with
+    `asyncio.TimeoutError`. The server is closed afterwards.
+
+    Returns:
+        `list` of rounds of `(status, payload)` responses.
+    '''
+    await server.start()
+    try:
+        responses = []
+        for requests in rounds:
+            responses.append(await asyncio.wait_for(asyncio.gather(*[
+                request(server.port, method, path, body)
+                for method, path, body in requests]), timeout))
+        return responses
+    finally:
+        await server.close()
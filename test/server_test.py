@@ -0,0 +1,102 @@
+import sys
+import unittest
+from datasketch.lsh import MinHashLSH
+from datasketch.lean_minhash import LeanMinHash
+from datasketch.minhash import MinHash
+if sys.version_info >= (3, 5):
+    import asyncio
+    from datasketch.server import QueryServer
+    from server_helper import run_requests
+
+
+class _FailingIndex(object):
+    '''
+    An index whose first query raises an unexpected error.
+    '''
+
+    def __init__(self, index):
+        self.index = index
+        self.failed = False
+
+    def query(self, minhash):
+        if not self.failed:
+            self.failed = True
+            raise KeyError("unexpected")
+        return self.index.query(minhash)
+
+
+@unittest.skipIf(sys.version_info < (3, 5), "Requires Python 3.5 or above")
+class TestQueryServer(unittest.TestCase):
+
+    def setUp(self):
+        self.lsh = MinHashLSH(threshold=0.5, num_perm=16)
+        self.minhashes = []
+        for i in range(10):
+            m = MinHash(16)
+            m.update(str(i).encode("utf8"))
+            self.lsh.insert(i, m)
+            self.minhashes.append(LeanMinHash(m))
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def _serialize(self, m):
+        buf = bytearray(m.bytesize())
+        m.serialize(buf)
+        return bytes(buf)
+
+    def test_query(self):
+        server = QueryServer(self.lsh, port=0, batch_window=0.01)
+        responses, [bad], [missing], [stats] = self.loop.run_until_complete(
+                run_requests(server, [
+                    [('POST', '/query', self._serialize(m))
+                        for m in self.minhashes * 2],
+                    [('POST', '/query', b'xx')],
+                    [('GET', '/x', b'')],
+                    [('GET', '/stats', b'')]]))
+        for i, (status, result) in enumerate(responses):
+            self.assertEqual(status, 200)
+            self.assertEqual(sorted(result),
+                    sorted(self.lsh.query(self.minhashes[i % 10])))
+        self.assertEqual(bad[0], 400)
+        self.assertEqual(missing[0], 404)
+        status, stats = stats
+        self.assertEqual(stats["requests"], 20)
+        self.assertTrue(stats["batches"] < 20)
+        # Identical signatures in the same batch are looked up once
+        self.assertTrue(10 <= stats["lookups"] <= 20)
+        self.assertTrue(stats["latency_p99"] >= stats["latency_p50"])
+
+    def test_query_error(self):
+        server = QueryServer(_FailingIndex(self.lsh), port=0)
+        body = self._serialize(self.minhashes[0])
+        [failed], [ok] = self.loop.run_until_complete(run_requests(server, [
+            [('POST', '/query', body)], [('POST', '/query', body)]]))
+        self.assertEqual(failed[0], 500)
+        # The batcher keeps serving after the error
+        self.assertEqual(ok, (200, self.lsh.query(self.minhashes[0])))
+
+    def test_max_body_size(self):
+        body = self._serialize(self.minhashes[0])
+        server = QueryServer(self.lsh, port=0, max_body_size=len(body) - 1)
+        [large], [ok] = self.loop.run_until_complete(run_requests(server, [
+            [('POST', '/query', body)], [('GET', '/stats', b'')]]))
+        self.assertEqual(large[0], 413)
+        self.assertEqual(ok[0], 200)
+        self.assertRaises(ValueError, QueryServer, self.lsh, max_body_size=-1)
+
+    def test_unserializable_keys(self):
+        lsh = MinHashLSH(threshold=0.5, num_perm=16)
+        lsh.insert(b"bytes", self.minhashes[0])
+        server = QueryServer(lsh, port=0)
+        body = self._serialize(self.minhashes[0])
+        [failed], [ok] = self.loop.run_until_complete(run_requests(server, [
+            [('POST', '/query', body)], [('GET', '/stats', b'')]]))
+        # The keys are not JSON serializable, and the server keeps serving
+        self.assertEqual(failed[0], 500)
+        self.assertEqual(ok[0], 200)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,63 @@
+import unittest
+import os
+import tempfile
+from datasketch.lsh import MinHashLSH
+from datasketch.shared_lsh import SharedMinHashLSH
+from datasketch.minhash import MinHash
+
+
+class TestSharedMinHashLSH(unittest.TestCase):
+
+    def _setup(self):
+        lsh = MinHashLSH(threshold=0.5, num_perm=16)
+        minhashes = []
+        for i in range(20):
+            m = MinHash(16)
+            for j in range(i, i + 5):
+                m.update(str(j).encode("utf8"))
+            lsh.insert(("key", i), m)
+            minhashes.append(m)
+        return lsh, minhashes
+
+    def test_serialize(self):
+        lsh, minhashes = self._setup()
+        buf = bytearray(SharedMinHashLSH.bytesize(lsh))
+        SharedMinHashLSH.serialize(lsh, buf)
+        view = SharedMinHashLSH(buf)
+        self.assertEqual(len(view), 20)
+        self.assertEqual((view.b, view.r), (lsh.b, lsh.r))
+        for m in minhashes:
+            self.assertEqual(set(view.query(m)), set(lsh.query(m)))
+        m = MinHash(16)
+        m.update("x".encode("utf8"))
+        self.assertEqual(view.query(m), [])
+        self.assertRaises(ValueError, view.query, MinHash(18))
+        self.assertRaises(ValueError, SharedMinHashLSH.serialize, lsh,
+                bytearray(10))
+
+    def test_empty(self):
+        lsh = MinHashLSH(threshold=0.5, num_perm=16)
+        buf = bytearray(SharedMinHashLSH.bytesize(lsh))
+        SharedMinHashLSH.serialize(lsh, buf)
+        view = SharedMinHashLSH(buf)
+        self.assertTrue(view.is_empty())
+        self.assertEqual(view.query(MinHash(16)), [])
+
+    def test_probes(self):
+        lsh = MinHashLSH(threshold=0.5, num_perm=16, probes=1)
+        self.assertRaises(ValueError, SharedMinHashLSH.bytesize, lsh)
+
+    def test_dump_load(self):
+        lsh, minhashes = self._setup()
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            SharedMinHashLSH.dump(lsh, path)
+            view = SharedMinHashLSH.load(path)
+            for m in minhashes:
+                self.assertEqual(set(view.query(m)), set(lsh.query(m)))
+        finally:
+            os.remove(path)
+
+if __name__ == "__main__":
+    unittest.main()
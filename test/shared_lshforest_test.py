@@ -0,0 +1,61 @@
+import unittest
+import os
+import tempfile
+from datasketch.lshforest import MinHashLSHForest
+from datasketch.shared_lshforest import SharedMinHashLSHForest
+from datasketch.minhash import MinHash
+
+
+class TestSharedMinHashLSHForest(unittest.TestCase):
+
+    def _setup(self):
+        forest = MinHashLSHForest(num_perm=16, l=4)
+        minhashes = []
+        for i in range(20):
+            m = MinHash(16)
+            for j in range(i, i + 5):
+                m.update(str(j).encode("utf8"))
+            forest.add(("key", i), m)
+            minhashes.append(m)
+        forest.index()
+        return forest, minhashes
+
+    def test_serialize(self):
+        forest, minhashes = self._setup()
+        buf = bytearray(SharedMinHashLSHForest.bytesize(forest))
+        SharedMinHashLSHForest.serialize(forest, buf)
+        view = SharedMinHashLSHForest(buf)
+        self.assertEqual(len(view), 20)
+        self.assertEqual((view.l, view.k), (forest.l, forest.k))
+        for m in minhashes:
+            for k in (1, 5, 20):
+                self.assertEqual(sorted(view.query(m, k)),
+                        sorted(forest.query(m, k)))
+        self.assertRaises(ValueError, view.query, MinHash(8), 1)
+        self.assertRaises(ValueError, view.query, minhashes[0], 0)
+        self.assertRaises(ValueError, SharedMinHashLSHForest.serialize,
+                forest, bytearray(10))
+
+    def test_empty(self):
+        forest = MinHashLSHForest(num_perm=16, l=4)
+        buf = bytearray(SharedMinHashLSHForest.bytesize(forest))
+        SharedMinHashLSHForest.serialize(forest, buf)
+        view = SharedMinHashLSHForest(buf)
+        self.assertTrue(view.is_empty())
+        self.assertEqual(view.query(MinHash(16), 1), [])
+
+    def test_dump_load(self):
+        forest, minhashes = self._setup()
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            SharedMinHashLSHForest.dump(forest, path)
+            view = SharedMinHashLSHForest.load(path)
+            for m in minhashes:
+                self.assertEqual(sorted(view.query(m, 3)),
+                        sorted(forest.query(m, 3)))
+        finally:
+            os.remove(path)
+
+if __name__ == "__main__":
+    unittest.main()